@@ -0,0 +1,647 @@
+# Asynchronous client
+# ===================
+#
+# Coroutine versions of the http helpers from `utils`, readers for the
+# streaming transports and a websocket client. Everything runs on a
+# single `IOLoop`, so thousands of SockJS sessions can be driven from
+# one process. The synchronous helpers in `utils` are thin wrappers
+# around this module.
+import base64
+import collections
+import hashlib
+import os
+import re
+import select
+import socket
+import struct
+import urlparse
+import framing
+import rfc6455
+from ioloop import IOStream, Future, Return, coroutine, TimeoutError
+from ioloop import StreamClosedError, monotonic
+from rfc6455 import OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG
+from rfc6455 import encode_frame
+
+
+class CaseInsensitiveDict(object):
+    def __init__(self, *args, **kwargs):
+        self.lower = {}
+        self.d = dict(*args, **kwargs)
+        for k in self.d:
+            self[k] = self.d[k]
+
+    def __getitem__(self, key, *args, **kwargs):
+        pkey = self.lower.setdefault(key.lower(), key)
+        return self.d.__getitem__(pkey, *args, **kwargs)
+
+    def __setitem__(self, key, *args, **kwargs):
+        pkey = self.lower.setdefault(key.lower(), key)
+        return self.d.__setitem__(pkey, *args, **kwargs)
+
+    def items(self):
+        for k in self.lower.values():
+            yield (k, self[k])
+
+    def __repr__(self): return repr(self.d)
+    def __str__(self): return str(self.d)
+
+    def get(self, key, *args, **kwargs):
+        pkey = self.lower.setdefault(key.lower(), key)
+        return self.d.get(pkey, *args, **kwargs)
+
+    def __contains__(self, key):
+        pkey = self.lower.setdefault(key.lower(), key)
+        return pkey in self.d
+
+class Response(object):
+    def __repr__(self):
+        return '<Response HTTP/%s %s %r %r>' % (
+            self.http, self.status, self.description, self.headers)
+
+    def __str__(self): return repr(self)
+
+    def __getitem__(self, key):
+        return self.headers.get(key)
+
+    def get(self, key, default):
+        return self.headers.get(key, default)
+
+
+# Idle keep-alive connections, grouped by scheme and `host:port`. A
+# connection is put back once its response was read in full, and is
+# dropped if the server closed it in the meantime.
+class ConnectionPool(object):
+    def __init__(self, max_idle=16):
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+        self.idle = {}
+
+    def get(self, key):
+        if self.pid != os.getpid():
+            # After a fork the sockets belong to the parent process.
+            self.pid = os.getpid()
+            self.idle = {}
+        conns = self.idle.get(key, [])
+        while conns:
+            conn, sock = conns.pop()
+            # An idle connection must not be readable. If it is, the
+            # server has closed it or sent something unexpected.
+            p = select.poll()
+            p.register(sock, select.POLLIN | select.POLLERR | select.POLLHUP)
+            if not p.poll(0):
+                return conn
+            conn.close()
+        return None
+
+    def put(self, key, conn, sock):
+        conns = self.idle.setdefault(key, [])
+        if len(conns) < self.max_idle:
+            conns.append((conn, sock))
+        else:
+            conn.close()
+
+    def clear(self):
+        for conns in self.idle.values():
+            for conn, _ in conns:
+                conn.close()
+        self.idle = {}
+
+pool = ConnectionPool()
+
+
+# Timings
+# -------
+#
+# Every response carries `r.timings`, the times of each step of its
+# request from `ioloop.monotonic()`: `connect_start`, `connect_end`,
+# `request_start` and `request_sent` (written), `first_byte`, `headers`
+# (parsed) and `body` (complete). The connect times are None on a
+# keep-alive connection, and `body` for a streaming response closed
+# before its end.
+#
+# Once a response is complete, or closed, its timings are passed to
+# the callables in `timing_hooks`:
+#
+#     def slow(timings):
+#         if timings.total() > 0.1:
+#             print timings.url, timings.phases()
+#     asyncclient.timing_hooks.append(slow)
+timing_hooks = []
+
+class Timings(object):
+    steps = ('connect_start', 'connect_end', 'request_start', 'request_sent',
+             'first_byte', 'headers', 'body')
+
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+        for name in self.steps:
+            setattr(self, name, None)
+        self.done = False
+
+    def mark(self, step):
+        setattr(self, step, monotonic())
+
+    def start(self):
+        return self.connect_start or self.request_start
+
+    def total(self):
+        return (self.body or self.headers) - self.start()
+
+    # Seconds spent connecting, sending the request, waiting for the
+    # server, reading the headers and the body. Steps that didn't
+    # happen count for nothing.
+    def phases(self):
+        def span(a, b):
+            return b - a if a is not None and b is not None else 0.0
+        return collections.OrderedDict([
+            ('connect', span(self.connect_start, self.connect_end)),
+            ('send', span(self.request_start, self.request_sent)),
+            ('wait', span(self.request_sent, self.first_byte)),
+            ('headers', span(self.first_byte, self.headers)),
+            ('transfer', span(self.headers, self.body)),
+        ])
+
+    def finish(self, complete=True):
+        if self.done:
+            return
+        self.done = True
+        if complete:
+            self.mark('body')
+        for hook in list(timing_hooks):
+            hook(self)
+
+    def __repr__(self):
+        return '<Timings %s %s %s>' % (self.method, self.url, ' '.join(
+            '%s=%.3fms' % (k, v * 1000) for k, v in self.phases().items()))
+
+
+# Traffic
+# -------
+#
+# Counts the bytes sent and received by the connections used while it
+# records, at the socket level, and how many of them were http headers.
+# It includes the websocket handshake and the frames sent after it:
+#
+#     with asyncclient.Traffic() as traffic:
+#         ...
+#     traffic.totals()  # -> {'sent': ..., 'header_sent': ..., ...}
+#
+# A connection is counted from the moment it's opened or taken from the
+# keep-alive `pool`, whatever it carried before doesn't count.
+recorders = []
+
+COUNTERS = ('sent', 'received', 'header_sent', 'header_received')
+
+def counters(conn):
+    return (conn.stream.written, conn.stream.received, conn.header_sent,
+            conn.header_received)
+
+class Traffic(object):
+    def __init__(self):
+        self.conns = {}
+        self.frozen = None
+
+    def __enter__(self):
+        recorders.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        recorders.remove(self)
+        self.frozen = self.totals()
+
+    # Connections taken more than once count from the first time.
+    def add(self, conn):
+        if conn not in self.conns:
+            self.conns[conn] = counters(conn)
+
+    def totals(self):
+        if self.frozen is not None:
+            return dict(self.frozen)
+        totals = dict.fromkeys(COUNTERS, 0)
+        for conn, start in self.conns.items():
+            for name, now, then in zip(COUNTERS, counters(conn), start):
+                totals[name] += now - then
+        return totals
+
+
+# Http
+# ----
+#
+# `header_sent` and `header_received` count the bytes of the request
+# and response heads, the stream counts everything.
+class HttpConnection(object):
+    def __init__(self, stream, connect_times=(None, None)):
+        self.stream = stream
+        # Only the first request on the connection waited for it.
+        self.connect_times = connect_times
+        self.header_sent = self.header_received = 0
+        for traffic in recorders:
+            traffic.add(self)
+
+    @coroutine
+    def request(self, method, url, headers={}, body=None, http="1.1"):
+        timings = Timings(method, url)
+        timings.connect_start, timings.connect_end = self.connect_times
+        self.connect_times = (None, None)
+        timings.mark('request_start')
+        headers = CaseInsensitiveDict(headers)
+        if method == 'POST':
+            body = (body or '').encode('utf-8')
+        u = urlparse.urlparse(url)
+        headers['Host'] = u.hostname + ':' + str(u.port) if u.port else u.hostname
+        if body is not None:
+            headers['Content-Length'] = str(len(body))
+
+        rel_url = url[ url.find(u.path): ]
+
+        req = ["%s %s HTTP/%s" % (method, rel_url, http)]
+        for k, v in headers.items():
+            req.append( "%s: %s" % (k, v) )
+        req.append('')
+        req.append('')
+        head = '\r\n'.join(req)
+        self.header_sent += len(head)
+        # A single write: a small body sent on its own waits on the ACK
+        # of the head, delayed by up to 40ms.
+        written = self.stream.write(head + body if body else head)
+        written.add_done_callback(lambda f: timings.mark('request_sent'))
+
+        yield self.stream.wait_for_data()
+        timings.mark('first_byte')
+        head = yield self.stream.read_until('\n')
+        self.header_received += len(head)
+        r = re.match(r'HTTP/(?P<version>\S+) (?P<status>\S+) (?P<description>.*)', head)
+
+        resp = Response()
+        resp.http = r.group('version')
+        resp.status = int(r.group('status'))
+        resp.description = r.group('description').rstrip('\r\n')
+
+        resp.headers = CaseInsensitiveDict()
+        while True:
+            header = yield self.stream.read_until('\n')
+            self.header_received += len(header)
+            if header in ['\n', '\r\n']:
+                break
+            k, _, v = header.partition(':')
+            resp.headers[k] = v.lstrip().rstrip('\r\n')
+        timings.mark('headers')
+        resp.timings = timings
+
+        raise Return(resp)
+
+    def read(self, size=None):
+        if size is None:
+            # Whatever arrived, a single packet usually.
+            return self.stream.read_some()
+        return self.stream.read_bytes(size)
+
+    def read_till_eof(self):
+        return self.stream.read_until_close()
+
+    @coroutine
+    def read_chunk(self):
+        line = yield self.stream.read_until('\n')
+        size = int(line.split(';')[0].strip(), 16)
+        data = yield self.stream.read_bytes(size + 2) # Additional \r\n
+        raise Return(data[:-2])
+
+    # Reads the body into `r.body`. Returns True if the connection may
+    # be reused: the end of the body is known without waiting for the
+    # server to close the connection.
+    @coroutine
+    def read_body(self, method, r, http="1.1"):
+        connection = [k.strip() for k in r.get('Connection', '').lower().split(',')]
+        persistent = (http == '1.1' and r.http == '1.1'
+                      and 'close' not in connection)
+        if r.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                chunk = yield self.read_chunk()
+                if len(chunk) == 0:
+                    break
+                chunks.append( chunk )
+            r.body = ''.join(chunks)
+        elif r.get('Content-Length', ''):
+            cl = int(r['Content-Length'])
+            r.body = yield self.read(cl)
+        elif 'close' in connection:
+            r.body = yield self.read_till_eof()
+        else:
+            # Whitelist statuses that may not need a response
+            if r.status in [101, 304, 204] or (r.status == 200 and method == 'OPTIONS'):
+                r.body = ''
+                persistent = persistent and r.status in [304, 204]
+            else:
+                raise Exception(str(r.status) + ' '+str(r.headers) + " No Transfer-Encoding:chunked nor Content-Length nor Connection:Close!")
+        raise Return(persistent)
+
+    def close(self):
+        self.stream.close()
+
+
+@coroutine
+def connect(url, timeout=None):
+    u = urlparse.urlparse(url)
+    assert u.scheme in ('http', 'ws'), "Unsupported scheme " + u.scheme
+    addresses = socket.getaddrinfo(u.hostname, u.port or 80, 0,
+                                   socket.SOCK_STREAM)
+    start = monotonic()
+    for i, (family, socktype, proto, _, address) in enumerate(addresses):
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = IOStream(sock, timeout=timeout)
+        try:
+            yield stream.connect(address)
+            break
+        except socket.error:
+            stream.close()
+            if i == len(addresses) - 1:
+                raise
+    raise Return(HttpConnection(stream, (start, monotonic())))
+
+
+# Issues a request and reads the whole response. Connections are
+# taken from and given back to the keep-alive `pool`.
+@coroutine
+def HttpRequest(method, url, keepalive=True, timeout=None, **kwargs):
+    u = urlparse.urlparse(url)
+    key = (u.scheme, u.netloc)
+    c = pool.get(key) if keepalive else None
+    try:
+        if c is not None:
+            c.stream.set_timeout(timeout)
+            for traffic in recorders:
+                traffic.add(c)
+            written = c.stream.written
+            try:
+                r = yield c.request(method, url, **kwargs)
+            except TimeoutError:
+                raise
+            except socket.error:
+                # The server may have closed the idle connection before
+                # it got the request. Only a request it can't have acted
+                # upon is sent again, a POST could be delivered twice.
+                if c.stream.written != written and \
+                        method not in ('GET', 'HEAD', 'OPTIONS'):
+                    raise
+                c.close()
+                c = None
+        if c is None:
+            c = yield connect(url, timeout)
+            r = yield c.request(method, url, **kwargs)
+        persistent = yield c.read_body(method, r, kwargs.get('http', '1.1'))
+    except:
+        if c is not None:
+            c.close()
+        raise
+    r.timings.finish()
+    if keepalive and persistent and not len(c.stream.buf):
+        pool.put(key, c, c.stream.socket)
+    else:
+        c.close()
+    raise Return(r)
+
+def GET(url, **kwargs):
+    return HttpRequest('GET', url, **kwargs)
+
+def POST(url, **kwargs):
+    return HttpRequest('POST', url, **kwargs)
+
+def OPTIONS(url, **kwargs):
+    return HttpRequest('OPTIONS', url, **kwargs)
+
+# Issues a request and returns once the headers are there. The body
+# is read piece by piece with `r.read()`.
+@coroutine
+def StreamingHttpRequest(method, url, timeout=None, **kwargs):
+    c = yield connect(url, timeout)
+    r = yield c.request(method, url, **kwargs)
+    whole = False
+    if r.get('Transfer-Encoding', '').lower() == 'chunked':
+        read = c.read_chunk
+    elif r.get('Content-Length', ''):
+        cl = int(r['Content-Length'])
+        read = lambda: c.read(cl)
+        whole = True
+    elif ('close' in [k.strip() for k in r.get('Connection', '').lower().split(',')]
+          or r.status == 101):
+        read = c.read
+    else:
+        c.close()
+        raise Exception(str(r.status) + ' '+str(r.headers) + " No Transfer-Encoding:chunked nor Content-Length nor Connection:Close!")
+
+    # The body is complete with the empty piece that ends it, or the
+    # only one given a `Content-Length`.
+    @coroutine
+    def read_timed():
+        data = yield read()
+        if whole or not data:
+            r.timings.finish()
+        raise Return(data)
+
+    def close():
+        r.timings.finish(complete=False)
+        c.close()
+    r.read = read_timed
+    r.conn = c
+    r.close = close
+    raise Return(r)
+
+def GET_async(url, **kwargs):
+    return StreamingHttpRequest('GET', url, **kwargs)
+
+def POST_async(url, **kwargs):
+    return StreamingHttpRequest('POST', url, **kwargs)
+
+
+# Streaming transports
+# --------------------
+#
+# Reads SockJS frames (`o`, `h`, `a[...]` and `c[...]`) from the body
+# of an `xhr_streaming`, `eventsource` or `htmlfile` response, as
+# `framing.Frame`s. Frames may be split across or packed within the
+# chunks.
+class StreamReader(object):
+    def __init__(self, response, transport):
+        self.response = response
+        self.decoder = framing.decoder(transport)
+        self.frames = collections.deque()
+
+    @coroutine
+    def read_frame(self):
+        while not self.frames:
+            chunk = yield self.response.read()
+            if not chunk:
+                raise Return(None)
+            self.frames.extend(self.decoder.feed(chunk))
+        raise Return(self.frames.popleft())
+
+    def close(self):
+        self.response.close()
+
+@coroutine
+def open_stream(session_url, transport, **kwargs):
+    if transport == 'xhr_streaming':
+        r = yield POST_async(session_url + '/xhr_streaming', **kwargs)
+    elif transport == 'eventsource':
+        r = yield GET_async(session_url + '/eventsource', **kwargs)
+    elif transport == 'htmlfile':
+        r = yield GET_async(session_url + '/htmlfile?c=callback', **kwargs)
+    else:
+        assert False, "Unsupported transport " + transport
+    raise Return(StreamReader(r, transport))
+
+
+# WebSocket
+# ---------
+#
+# Frames are encoded and decoded by `rfc6455`. Messages longer than
+# `fragment_size` are sent in as many frames, fragmented ones are
+# received whole. Given `deflate`, a dict of parameters, the client
+# offers `permessage-deflate` with them; `WebSocket.deflate` is then
+# the `rfc6455.Deflate` in use, or None if the server declined.
+# `bytes_sent` and `bytes_received` count the frames on the wire.
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+class HandshakeError(Exception): pass
+
+class WebSocket(object):
+    class ConnectionClosedException(Exception): pass
+
+    def __init__(self, conn, response, fragment_size=None, deflate=None):
+        self.conn = conn
+        self.stream = conn.stream
+        self.response = response
+        self.fragment_size = fragment_size
+        self.deflate = deflate
+        self.decoder = rfc6455.Decoder(deflate)
+        self.messages = collections.deque()
+        self.close_sent = False
+        self.bytes_sent = self.bytes_received = 0
+
+    def send(self, data, binary=False):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        opcode = OP_BINARY if binary else OP_TEXT
+        return self.write(rfc6455.encode_message(
+            opcode, data, fragment_size=self.fragment_size,
+            deflate=self.deflate))
+
+    def write(self, frames):
+        self.bytes_sent += len(frames)
+        return self.stream.write(frames)
+
+    # Returns the next text (as unicode) or binary message. When the
+    # connection is closed, raises `ConnectionClosedException` with
+    # `code` and `reason`.
+    @coroutine
+    def recv(self):
+        while True:
+            try:
+                opcode, payload = yield self.read_message()
+            except TimeoutError:
+                raise
+            except socket.error:
+                raise self.closed_exception(1006, '')
+            except rfc6455.ProtocolError as e:
+                self.close(1002)
+                raise self.closed_exception(1002, unicode(e))
+            if opcode == OP_TEXT:
+                raise Return(self.decode(payload))
+            elif opcode == OP_BINARY:
+                raise Return(payload)
+            elif opcode == OP_PING:
+                self.write(encode_frame(OP_PONG, payload))
+            elif opcode == OP_CLOSE:
+                code, reason = 1005, u''
+                if len(payload) >= 2:
+                    code = struct.unpack('!H', payload[:2])[0]
+                    reason = self.decode(payload[2:])
+                # 1005 only says there was no code, it isn't sent.
+                self.close(None if code == 1005 else code)
+                raise self.closed_exception(code, reason)
+
+    # Text that isn't valid UTF-8 fails the connection.
+    def decode(self, data):
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            self.close(1007)
+            raise self.closed_exception(1007, u'Invalid UTF-8')
+
+    # The next message or control frame, as `(opcode, payload)`.
+    @coroutine
+    def read_message(self):
+        while not self.messages:
+            data = yield self.stream.read_some()
+            if not data:
+                raise StreamClosedError('Connection closed')
+            self.bytes_received += len(data)
+            self.messages.extend(self.decoder.feed(data))
+        raise Return(self.messages.popleft())
+
+    def closed_exception(self, code, reason):
+        ce = self.ConnectionClosedException()
+        (ce.code, ce.reason) = (code, reason)
+        return ce
+
+    # Sends a close frame, the connection is closed once it's written.
+    # Returns a future resolved then. Without a `code` the frame is
+    # empty.
+    def close(self, code=1000, reason=''):
+        done = Future()
+        if not self.stream.closed and not self.close_sent:
+            self.close_sent = True
+            payload = ''
+            if code is not None:
+                payload = struct.pack('!H', code) + reason.encode('utf-8')
+            f = self.write(encode_frame(OP_CLOSE, payload))
+            def written(f):
+                self.stream.close()
+                done.set_result(None)
+            f.add_done_callback(written)
+        else:
+            self.stream.close()
+            done.set_result(None)
+        return done
+
+@coroutine
+def websocket_connect(url, timeout=None, headers={}, fragment_size=None,
+                      deflate=None):
+    assert url.startswith('ws:'), "Unsupported scheme " + url
+    http_url = 'http:' + url[len('ws:'):]
+    conn = yield connect(http_url, timeout)
+    key = base64.b64encode(os.urandom(16))
+    h = {'Upgrade': 'websocket',
+         'Connection': 'Upgrade',
+         'Sec-WebSocket-Key': key,
+         'Sec-WebSocket-Version': '13'}
+    if deflate is not None:
+        h['Sec-WebSocket-Extensions'] = rfc6455.format_extension(
+            rfc6455.DEFLATE, deflate)
+    h.update(headers)
+    r = yield conn.request('GET', http_url, headers=h)
+    accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+    if r.status != 101 or r['Sec-WebSocket-Accept'] != accept:
+        conn.close()
+        raise HandshakeError(str(r.status) + ' ' + str(r.headers))
+    r.timings.finish(complete=False)
+    try:
+        extension = accept_extensions(deflate, r['Sec-WebSocket-Extensions'])
+    except rfc6455.NegotiationError as e:
+        conn.close()
+        raise HandshakeError(str(e))
+    raise Return(WebSocket(conn, r, fragment_size, extension))
+
+# The `Deflate` agreed on, if any. The server may only pick what was
+# offered.
+def accept_extensions(deflate, header):
+    extensions = rfc6455.parse_extensions(header or '')
+    if not extensions:
+        return None
+    [(name, params)] = extensions[:1]
+    if len(extensions) > 1 or name != rfc6455.DEFLATE or deflate is None:
+        raise rfc6455.NegotiationError('Extensions not offered: ' + header)
+    return rfc6455.Deflate(rfc6455.accept_deflate(deflate, params))
@@ -0,0 +1,272 @@
+# Benchmark runner
+# ================
+#
+# The benchmarks are laid out like the protocol suite: a class per
+# transport, with `bench_*` methods instead of `test_*` ones. A
+# method runs a number of measurements and reports each one with
+# `record()`. The results are printed as they come and can be saved
+# as json, to compare runs or server implementations:
+#
+#     ./venv/bin/python sockjs-benchmark.py Websocket --json ws.json
+import argparse
+import inspect
+import json
+import os
+import sys
+import traceback
+import client
+from loadgen import raise_fd_limit
+from ioloop import IOLoop, Future, coroutine, Return, monotonic
+
+
+test_top_url = os.environ.get('SOCKJS_URL', 'http://localhost:8081')
+
+
+# An echo session with futures: `open()` resolves when the session is
+# open, `roundtrip(msgs)` once all the messages have been echoed.
+class EchoSession(object):
+    def __init__(self, transport, base_url, timeout=None):
+        self.conn = client.CLIENTS[transport](base_url, timeout=timeout)
+        self.conn.on_open = self.on_open
+        self.conn.on_message = self.on_message
+        self.conn.on_close = self.on_close
+        self.opened = Future()
+        self.waiting = None
+        self.pending = 0
+        self.received = []
+
+    def open(self):
+        self.conn.start()
+        return self.opened
+
+    def roundtrip(self, msgs):
+        assert self.waiting is None, 'a roundtrip is already running'
+        self.waiting = Future()
+        self.pending = len(msgs)
+        self.received = []
+        self.conn.send_many(msgs)
+        return self.waiting
+
+    def on_open(self):
+        if not self.opened.done():
+            self.opened.set_result(True)
+
+    def on_message(self, msg):
+        self.received.append(msg)
+        self.pending -= 1
+        if self.pending == 0 and self.waiting:
+            f, self.waiting = self.waiting, None
+            f.set_result(self.received)
+
+    def on_close(self, code, reason):
+        e = Exception('Session closed: %s %s' % (code, reason))
+        for f in (self.opened, self.waiting):
+            if f and not f.done():
+                f.set_exception(e)
+        self.waiting = None
+
+    def close(self):
+        self.conn.close()
+
+
+# A session that only listens. It keeps the time of the last frame,
+# and records the gaps between frames (the opening frame and the
+# heartbeats) in microseconds into `gaps`. `open()` resolves to
+# whether the session could be opened in time.
+class IdleSession(object):
+    def __init__(self, transport, base_url, gaps, loop):
+        self.conn = client.CLIENTS[transport](base_url)
+        self.conn.on_open = self.on_open
+        self.conn.on_heartbeat = self.on_heartbeat
+        self.conn.on_close = self.on_close
+        self.gaps = gaps
+        self.loop = loop
+        self.opened = Future()
+        self.last = None
+        self.heartbeats = 0
+        self.closed = False
+
+    def open(self, timeout):
+        handle = self.loop.call_later(timeout, self.on_close, 1006, 'timeout')
+        self.opened.add_done_callback(lambda f: self.loop.remove_timeout(handle))
+        self.conn.start()
+        return self.opened
+
+    def on_open(self):
+        self.last = self.loop.time()
+        if not self.opened.done():
+            self.opened.set_result(True)
+
+    def on_heartbeat(self):
+        now = self.loop.time()
+        self.gaps.record((now - self.last) * 1000000)
+        self.last = now
+        self.heartbeats += 1
+
+    def on_close(self, code, reason):
+        self.closed = True
+        self.conn.close()
+        if not self.opened.done():
+            self.opened.set_result(False)
+
+    def close(self):
+        self.conn.close()
+
+
+# Resident memory of a process, in kB, from `/proc/<pid>/status`.
+# Takes a pid or a path to the `/proc/<pid>` directory.
+def read_rss(pid_or_path):
+    path = str(pid_or_path)
+    if path.isdigit():
+        path = '/proc/' + path
+    with open(os.path.join(path, 'status')) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+# Cpu time used by a process so far, in seconds, from
+# `/proc/<pid>/stat`.
+def read_cpu(pid_or_path):
+    path = str(pid_or_path)
+    if path.isdigit():
+        path = '/proc/' + path
+    with open(os.path.join(path, 'stat')) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return float(int(fields[11]) + int(fields[12])) / \
+        os.sysconf('SC_CLK_TCK')
+
+
+def explicit(method):
+    method._explicit = True
+    return method
+
+
+# Classes only meant to be subclassed set `abstract = True`.
+class Benchmark(object):
+    abstract = True
+    transport = None
+    sizes = (16, 256, 4096, 65536)
+    batches = (1, 10, 100)
+
+    def __init__(self, options, results):
+        self.options = options
+        self.results = results
+        self.base_url = options.url + '/echo'
+        self.loop = IOLoop.instance()
+        self.current = type(self).__name__
+        if options.sizes:
+            self.sizes = options.sizes
+        if options.batches:
+            self.batches = options.batches
+
+    def run_sync(self, future, timeout=None):
+        return self.loop.run_sync(future, timeout=timeout)
+
+    def record(self, **fields):
+        fields['benchmark'] = self.current
+        self.results.append(fields)
+        # Parameters first, measurements (`*_per_sec`) last.
+        names = sorted((k for k in fields if k != 'benchmark'),
+                       key=lambda k: ('_per_' in k, k))
+        print '%-36s %s' % (self.current, '  '.join(
+            format_field(k, fields[k]) for k in names))
+        sys.stdout.flush()
+
+    # Sends batches of `batch` messages of `size` bytes, one batch at a
+    # time, for `seconds`. Returns `(messages, elapsed)`.
+    @coroutine
+    def echo_rate(self, session, size, batch, seconds):
+        msgs = ['x' * size] * batch
+        yield session.roundtrip(msgs)
+        count = 0
+        t0 = monotonic()
+        deadline = t0 + seconds
+        while monotonic() < deadline:
+            yield session.roundtrip(msgs)
+            count += batch
+        raise Return((count, monotonic() - t0))
+
+
+def format_field(name, value):
+    if isinstance(value, float):
+        return '%s=%.1f' % (name, value)
+    return '%s=%s' % (name, value)
+
+
+def find_benchmarks(module):
+    found = []
+    for name in dir(module):
+        cls = getattr(module, name)
+        if isinstance(cls, type) and issubclass(cls, Benchmark) and \
+                not cls.__dict__.get('abstract'):
+            cls_line = inspect.getsourcelines(cls)[1]
+            for m in dir(cls):
+                if m.startswith('bench_'):
+                    line = getattr(cls, m).im_func.func_code.co_firstlineno
+                    found.append((cls_line, line, name, m))
+    return [(name, m) for _, _, name, m in sorted(found)]
+
+# Benchmarks marked as `explicit` take a long time, they are run only
+# when asked for with `Class.bench_method` or just `bench_method`.
+def selected(cls, name, method, patterns):
+    full = name + '.' + method
+    if getattr(getattr(cls, method), '_explicit', False):
+        return full in patterns or method in patterns
+    return not patterns or any(p in (name, full, method) for p in patterns)
+
+
+def int_list(value):
+    return tuple(int(v) for v in value.split(','))
+
+def main(module='__main__', argv=None):
+    if isinstance(module, basestring):
+        module = sys.modules[module]
+    parser = argparse.ArgumentParser(description=module.__doc__)
+    parser.add_argument('names', nargs='*', metavar='Class[.bench_method]')
+    parser.add_argument('--url', default=test_top_url)
+    parser.add_argument('-s', '--seconds', type=float, default=2,
+                        help='duration of a single measurement')
+    parser.add_argument('--sizes', type=int_list,
+                        help='message sizes to sweep, comma separated')
+    parser.add_argument('--batches', type=int_list,
+                        help='batch sizes to sweep, comma separated')
+    parser.add_argument('--sessions', type=int, default=10000,
+                        help='idle sessions to ramp up to')
+    parser.add_argument('--step', type=int, default=1000,
+                        help='idle sessions added at every step')
+    parser.add_argument('--hold', type=float, default=30,
+                        help='seconds to hold the idle sessions at every step')
+    parser.add_argument('--heartbeat', type=float, default=25,
+                        help='heartbeat interval of the server, in seconds')
+    parser.add_argument('--connect-timeout', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='sessions being opened at the same time')
+    parser.add_argument('--server-rss', metavar='PID_OR_PATH',
+                        help='server process to read the memory and cpu '
+                        'usage of')
+    parser.add_argument('--flood', type=int, default=64, metavar='MIB',
+                        help='most data pushed to a slow consumer')
+    parser.add_argument('--json', metavar='FILE',
+                        help='save the results to FILE')
+    options = parser.parse_args(argv)
+    raise_fd_limit()
+
+    results, failed = [], 0
+    for name, method in find_benchmarks(module):
+        cls = getattr(module, name)
+        if not selected(cls, name, method, options.names):
+            continue
+        b = cls(options, results)
+        b.current = '%s.%s' % (name, method)
+        try:
+            getattr(b, method)()
+        except Exception:
+            failed += 1
+            print '%-36s ERROR' % (b.current,)
+            traceback.print_exc()
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    sys.exit(1 if failed else 0)
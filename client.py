@@ -0,0 +1,225 @@
+# SockJS clients
+# ==============
+#
+# Minimal SockJS clients, one per transport, running on the event
+# loop. They are used by the load tools, the protocol suite talks to
+# the server directly. Like in `client.coffee`, a client reports what
+# happens by calling `on_open()`, `on_message(msg)`, `on_heartbeat()`
+# and `on_close(code, reason)`.
+import urllib
+import uuid
+from ioloop import coroutine
+import asyncclient
+import escaping
+import framing
+
+
+class GenericClient(object):
+    def __init__(self, base_url, timeout=None):
+        self.base_url = base_url
+        self.url = base_url + '/000/' + str(uuid.uuid4())
+        self.timeout = timeout
+        self.buffer = []
+        self.sending = False
+        self.is_closed = False
+
+    def on_open(self): pass
+    def on_message(self, msg): pass
+    def on_heartbeat(self): pass
+    def on_close(self, code, reason): pass
+
+    def start(self):
+        self._run(self._recv_loop)
+
+    # Runs a coroutine, a failure closes the client.
+    @coroutine
+    def _run(self, func, *args):
+        try:
+            yield func(*args)
+        except Exception as e:
+            if not self.is_closed:
+                self._closed(1006, '%s: %s' % (type(e).__name__, e))
+
+    def _closed(self, code, reason):
+        self.is_closed = True
+        self.on_close(code, reason)
+
+    def _got_frame(self, frame):
+        if frame.type == 'o':
+            self.on_open()
+        elif frame.type == 'h':
+            self.on_heartbeat()
+        elif frame.type == 'a':
+            for m in frame.messages():
+                if self.is_closed:
+                    break
+                self.on_message(m)
+        elif frame.type == 'c':
+            self._closed(*frame.close_reason())
+
+    def send(self, msg):
+        self.send_many([msg])
+
+    def send_many(self, msgs):
+        self.buffer.extend(msgs)
+        if not self.sending and not self.is_closed:
+            self._run(self._send_loop)
+
+    # Messages queued while a send is in flight go out together, as
+    # one json-encoded array.
+    @coroutine
+    def _send_loop(self):
+        self.sending = True
+        try:
+            while self.buffer and not self.is_closed:
+                payload, self.buffer = escaping.client.dumps(self.buffer), []
+                yield self._send(payload)
+        finally:
+            self.sending = False
+
+    @coroutine
+    def _send(self, payload):
+        r = yield asyncclient.POST(self.url + '/xhr_send', body=payload,
+                                   timeout=self.timeout)
+        if r.status != 204:
+            raise Exception('xhr_send: %s %r' % (r.status, r.body))
+
+    def close(self):
+        self.is_closed = True
+
+
+class XhrPollingClient(GenericClient):
+    @coroutine
+    def _recv_loop(self):
+        while not self.is_closed:
+            r = yield asyncclient.POST(self.url + '/xhr')
+            for frame in framing.decoder('xhr').feed(r.body):
+                if not self.is_closed:
+                    self._got_frame(frame)
+
+
+class JsonpPollingClient(GenericClient):
+    @coroutine
+    def _recv_loop(self):
+        while not self.is_closed:
+            r = yield asyncclient.GET(self.url + '/jsonp?c=c')
+            frames = framing.decoder('jsonp').feed(r.body)
+            if len(frames) != 1:
+                raise Exception('jsonp: %s %r' % (r.status, r.body))
+            self._got_frame(frames[0])
+
+    @coroutine
+    def _send(self, payload):
+        r = yield asyncclient.POST(
+            self.url + '/jsonp_send', body='d=' + urllib.quote(payload),
+            headers={'Content-Type': 'application/x-www-form-urlencoded'},
+            timeout=self.timeout)
+        if r.status != 200:
+            raise Exception('jsonp_send: %s %r' % (r.status, r.body))
+
+
+# Streaming requests are closed by the server after enough data was
+# sent, a new one is opened for the same session.
+class StreamingClient(GenericClient):
+    transport = None
+
+    def __init__(self, *args, **kwargs):
+        super(StreamingClient, self).__init__(*args, **kwargs)
+        self.stream = None
+
+    @coroutine
+    def _recv_loop(self):
+        while not self.is_closed:
+            self.stream = yield asyncclient.open_stream(self.url, self.transport)
+            while not self.is_closed:
+                frame = yield self.stream.read_frame()
+                if frame is None:
+                    break
+                self._got_frame(frame)
+            self.stream.close()
+
+    def close(self):
+        super(StreamingClient, self).close()
+        if self.stream:
+            self.stream.close()
+
+class XhrStreamingClient(StreamingClient):
+    transport = 'xhr_streaming'
+
+class EventSourceClient(StreamingClient):
+    transport = 'eventsource'
+
+class HtmlFileClient(StreamingClient):
+    transport = 'htmlfile'
+
+
+class WebsocketClient(GenericClient):
+    def __init__(self, *args, **kwargs):
+        super(WebsocketClient, self).__init__(*args, **kwargs)
+        self.ws = None
+
+    def ws_url(self):
+        return 'ws:' + self.url.split(':', 1)[1] + '/websocket'
+
+    @coroutine
+    def _recv_loop(self):
+        self.ws = yield asyncclient.websocket_connect(self.ws_url())
+        self._connected()
+        while not self.is_closed:
+            try:
+                msg = yield self.ws.recv()
+            except self.ws.ConnectionClosedException as e:
+                if not self.is_closed:
+                    self._closed(e.code, e.reason)
+                return
+            self._got_message(msg)
+
+    def _got_message(self, msg):
+        self._got_frame(framing.parse(msg))
+
+    def _connected(self):
+        msgs, self.buffer = self.buffer, []
+        if msgs:
+            self._write(msgs)
+
+    def _write(self, msgs):
+        self.ws.send(escaping.client.dumps(msgs))
+
+    def send_many(self, msgs):
+        if self.ws is None:
+            self.buffer.extend(msgs)
+        elif not self.is_closed:
+            self._write(msgs)
+
+    def close(self):
+        super(WebsocketClient, self).close()
+        if self.ws:
+            self.ws.close()
+
+# Raw websocket has no SockJS framing at all, the connection is open
+# once the handshake is done.
+class RawWebsocketClient(WebsocketClient):
+    def ws_url(self):
+        return 'ws:' + self.base_url.split(':', 1)[1] + '/websocket'
+
+    def _connected(self):
+        super(RawWebsocketClient, self)._connected()
+        self.on_open()
+
+    def _got_message(self, msg):
+        self.on_message(msg)
+
+    def _write(self, msgs):
+        for msg in msgs:
+            self.ws.send(msg)
+
+
+CLIENTS = {
+    'xhr': XhrPollingClient,
+    'jsonp': JsonpPollingClient,
+    'xhr_streaming': XhrStreamingClient,
+    'eventsource': EventSourceClient,
+    'htmlfile': HtmlFileClient,
+    'websocket': WebsocketClient,
+    'raw_websocket': RawWebsocketClient,
+}
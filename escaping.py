@@ -0,0 +1,108 @@
+# JSON escaping
+# =============
+#
+# The sets of characters that SockJS clients and servers must escape
+# in json strings, and lookup tables to do so. The sets are defined as
+# regex character classes, as the protocol suite always had them, but
+# their members are read off the parsed regex instead of matching it
+# against every code point. Encoding goes through
+# `unicode.translate()`, a table lookup per character, and strings
+# with nothing to escape are returned as they are after a single scan:
+#
+#     client.escape(u'\u2028')    # -> u'\\u2028'
+#     client.dumps([u'a', u'b'])  # -> '["a","b"]'
+import json
+import re
+import sre_constants
+import sre_parse
+
+
+# The browser must escape quite a list of chars, this is due to
+# browser mangling outgoing chars on transports like XHR.
+escapable_by_client = u"[\\\"\x00-\x1f\x7f-\x9f\u00ad\u0600-\u0604\u070f\u17b4\u17b5\u2000-\u20ff\ufeff\ufff0-\uffff\x00-\x1f\ufffe\uffff\u0300-\u0333\u033d-\u0346\u034a-\u034c\u0350-\u0352\u0357-\u0358\u035c-\u0362\u0374\u037e\u0387\u0591-\u05af\u05c4\u0610-\u0617\u0653-\u0654\u0657-\u065b\u065d-\u065e\u06df-\u06e2\u06eb-\u06ec\u0730\u0732-\u0733\u0735-\u0736\u073a\u073d\u073f-\u0741\u0743\u0745\u0747\u07eb-\u07f1\u0951\u0958-\u095f\u09dc-\u09dd\u09df\u0a33\u0a36\u0a59-\u0a5b\u0a5e\u0b5c-\u0b5d\u0e38-\u0e39\u0f43\u0f4d\u0f52\u0f57\u0f5c\u0f69\u0f72-\u0f76\u0f78\u0f80-\u0f83\u0f93\u0f9d\u0fa2\u0fa7\u0fac\u0fb9\u1939-\u193a\u1a17\u1b6b\u1cda-\u1cdb\u1dc0-\u1dcf\u1dfc\u1dfe\u1f71\u1f73\u1f75\u1f77\u1f79\u1f7b\u1f7d\u1fbb\u1fbe\u1fc9\u1fcb\u1fd3\u1fdb\u1fe3\u1feb\u1fee-\u1fef\u1ff9\u1ffb\u1ffd\u2000-\u2001\u20d0-\u20d1\u20d4-\u20d7\u20e7-\u20e9\u2126\u212a-\u212b\u2329-\u232a\u2adc\u302b-\u302c\uaab2-\uaab3\uf900-\ufa0d\ufa10\ufa12\ufa15-\ufa1e\ufa20\ufa22\ufa25-\ufa26\ufa2a-\ufa2d\ufa30-\ufa6d\ufa70-\ufad9\ufb1d\ufb1f\ufb2a-\ufb36\ufb38-\ufb3c\ufb3e\ufb40-\ufb41\ufb43-\ufb44\ufb46-\ufb4e]"
+
+# The server is able to send much more chars verbatim. But, it can't
+# send Unicode surrogates over Websockets, also various \u2xxxx chars
+# get mangled.
+escapable_by_server = u"[\x00-\x1f\u200c-\u200f\u2028-\u202f\u2060-\u206f\ufff0-\uffff]"
+
+
+# Code points of a single character class, like the ones above.
+def code_points(pattern):
+    [(op, items)] = sre_parse.parse(pattern)
+    if op != sre_constants.IN:
+        raise ValueError('Not a character class: %r' % (pattern[:32],))
+    points = set()
+    for kind, value in items:
+        if kind == sre_constants.LITERAL:
+            points.add(value)
+        elif kind == sre_constants.RANGE:
+            points.update(xrange(value[0], value[1] + 1))
+        else:
+            raise ValueError('Unsupported %s in %r' % (kind, pattern[:32]))
+    return points
+
+
+# Sorted code points, as `(first, last)` ranges.
+def ranges(points):
+    first = last = None
+    for i in sorted(points):
+        if last is not None and i == last + 1:
+            last = i
+            continue
+        if first is not None:
+            yield first, last
+        first = last = i
+    if first is not None:
+        yield first, last
+
+
+# The tables are built on first use.
+class Escaper(object):
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def __getattr__(self, name):
+        if name not in ('points', 'table', 'search'):
+            raise AttributeError(name)
+        self.build()
+        return getattr(self, name)
+
+    def build(self):
+        self.points = frozenset(code_points(self.pattern))
+        self.table = dict((i, u'\\u%04x' % i) for i in self.points)
+        # Whatever the set, json needs these escaped.
+        self.table.setdefault(ord('"'), u'\\"')
+        self.table.setdefault(ord('\\'), u'\\\\')
+        self.search = re.compile(u'[%s]' % u''.join(
+            re.escape(unichr(a)) + u'-' + re.escape(unichr(b))
+            for a, b in ranges(self.table)), re.UNICODE).search
+
+    def __contains__(self, char):
+        return ord(char) in self.points
+
+    # Body of a json string, without the quotes.
+    def escape(self, s):
+        if isinstance(s, str):
+            s = s.decode('utf-8')
+        if self.search(s) is None:
+            return s
+        return s.translate(self.table)
+
+    # A json string with every character of the set from `start` on,
+    # each escaped.
+    def killer_string(self, start=0):
+        return '"' + ''.join(r'\u%04x' % i for i in sorted(self.points)
+                             if i >= start) + '"'
+
+    # A list of strings as json, utf-8 encoded.
+    def dumps(self, messages):
+        return ('[' + u','.join(u'"%s"' % self.escape(m) for m in messages) +
+                ']').encode('utf-8')
+
+def unescape(s):
+    return json.loads('"' + s + '"')
+
+
+client = Escaper(escapable_by_client)
+server = Escaper(escapable_by_server)
@@ -0,0 +1,78 @@
+# Fixtures
+# ========
+#
+# Test data that takes a while to build is declared as a fixture: a
+# function called on first use only, so that running a single test
+# doesn't pay for data of all the others. The result is kept on disk,
+# under a key made of the function name and whatever the data derives
+# from, and reused by the next runs until that changes:
+#
+#     @fixtures.fixture(escaping.escapable_by_client)
+#     def client_killer_string_esc():
+#         return ...
+#
+#     client_killer_string_esc()
+#
+# Values must be json serializable. The cache lives in `.fixtures`
+# next to the suite, `SOCKJS_FIXTURES` points it elsewhere and
+# `SOCKJS_FIXTURES=` (empty) turns it off.
+import hashlib
+import json
+import os
+import tempfile
+
+
+cache_dir = os.environ.get('SOCKJS_FIXTURES', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.fixtures'))
+
+
+class Fixture(object):
+    def __init__(self, func, key):
+        self.func = func
+        self.name = func.__name__
+        self.key = key
+        self.computed = False
+        self.value = None
+
+    def __call__(self):
+        if not self.computed:
+            self.value = self.load()
+            self.computed = True
+        return self.value
+
+    def path(self):
+        digest = hashlib.sha1(json.dumps([self.name] + list(self.key)))
+        return os.path.join(cache_dir, '%s-%s.json' % (
+            self.name, digest.hexdigest()[:16]))
+
+    def load(self):
+        if not cache_dir:
+            return self.func()
+        path = self.path()
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            pass
+        value = self.func()
+        self.save(path, value)
+        return value
+
+    # Written to a temporary file first, parallel runs may race to it.
+    def save(self, path, value):
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+
+# `key` is anything json serializable the value depends on.
+def fixture(*key):
+    def decorate(func):
+        return Fixture(func, key)
+    return decorate
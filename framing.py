@@ -0,0 +1,190 @@
+# Frame decoding
+# ==============
+#
+# Incremental decoders for the framing of the http transports. Data is
+# fed as it comes off the socket, in pieces of any size (str,
+# bytearray or memoryview), and comes out as complete frames, the rest
+# is kept for the next piece:
+#
+#     decoder = framing.decoder('eventsource')
+#     for frame in decoder.feed(data):
+#         if frame.type == 'a':
+#             messages = frame.messages()
+#
+# Pending data sits in a `ReceiveBuffer`, where it is only copied
+# once, and the search for the end of a frame resumes where the last
+# one stopped. A large frame arriving in many small pieces costs
+# about as much as one arriving at once.
+import collections
+import json
+from ioloop import ReceiveBuffer
+
+
+# `type` is one of `o`, `h`, `a` and `c`, `data` is what follows it:
+# json for `a` and `c` frames, nothing for the others.
+class Frame(collections.namedtuple('Frame', 'type data')):
+    def messages(self):
+        return json.loads(self.data) if self.type == 'a' else []
+
+    def close_reason(self):
+        code, reason = json.loads(self.data)
+        return code, reason
+
+    def __str__(self):
+        return self.type + self.data
+
+def parse(frame):
+    if not frame or frame[0] not in 'ohac':
+        raise ValueError('Bad frame %r' % (frame[:32],))
+    return Frame(frame[0], frame[1:])
+
+
+# Undoes the chunked transfer encoding. `feed()` returns the pieces of
+# the body as memoryviews into the data it was given.
+class ChunkedDecoder(object):
+    def __init__(self):
+        self.line = ReceiveBuffer(64)
+        self.remaining = 0
+        self.done = False
+
+    def feed(self, data):
+        data = memoryview(data)
+        pos, pieces = 0, []
+        while pos < len(data) and not self.done:
+            if self.remaining > 2:
+                n = min(self.remaining - 2, len(data) - pos)
+                pieces.append(data[pos:pos + n])
+            elif self.remaining:
+                # The `\r\n` after the chunk.
+                n = min(self.remaining, len(data) - pos)
+            else:
+                head = data[pos:pos + 64].tobytes()
+                i = head.find('\n')
+                n = len(head) if i == -1 else i + 1
+                self.line.feed(head[:n])
+                if i != -1:
+                    line = self.line.take(len(self.line))
+                    size = int(line.split(';')[0].strip(), 16)
+                    self.done = size == 0
+                    self.remaining = size + 2 if size else 0
+                pos += n
+                continue
+            self.remaining -= n
+            pos += n
+        return pieces
+
+
+# The buffering shared by the decoders. A subclass gives `next()`, which
+# returns the next complete frame or None.
+class Decoder(object):
+    def __init__(self, chunked=False):
+        self.buf = ReceiveBuffer(4096)
+        self.chunks = ChunkedDecoder() if chunked else None
+        self.scanned = 0
+        self.started = False
+
+    def feed(self, data):
+        if self.chunks:
+            for piece in self.chunks.feed(data):
+                self.buf.feed(piece)
+        else:
+            self.buf.feed(data)
+        frames = []
+        while True:
+            frame = self.next()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    # Offset of `sep` in the pending data, or -1. A failed search is
+    # picked up where it left off on the next call.
+    def find(self, sep):
+        i = self.buf.find(sep, self.scanned)
+        if i == -1:
+            self.scanned = max(len(self.buf) - len(sep) + 1, 0)
+        else:
+            self.scanned = 0
+        return i
+
+    # Takes data up to `sep`, and drops `sep`.
+    def take_until(self, sep):
+        i = self.find(sep)
+        if i == -1:
+            return None
+        data = self.buf.take(i)
+        self.buf.skip(len(sep))
+        return data
+
+
+# A frame per line, also used for the body of an `xhr` poll.
+class XhrDecoder(Decoder):
+    def next(self):
+        line = self.take_until('\n')
+        while line == '':
+            line = self.take_until('\n')
+        return None if line is None else parse(line)
+
+# After a prelude of 2KiB `h` and a new line.
+class XhrStreamingDecoder(XhrDecoder):
+    def next(self):
+        if not self.started:
+            if self.take_until('\n') is None:
+                return None
+            self.started = True
+        return XhrDecoder.next(self)
+
+# `data: <frame>\r\n\r\n`, after a `\r\n` prelude.
+class EventSourceDecoder(Decoder):
+    def next(self):
+        if not self.started:
+            if len(self.buf) < 2:
+                return None
+            self.buf.skip(2)
+            self.started = True
+        event = self.take_until('\r\n\r\n')
+        if event is None:
+            return None
+        if not event.startswith('data: '):
+            raise ValueError('Bad event %r' % (event[:32],))
+        return parse(event[len('data: '):])
+
+# Frames are json encoded, between a `start` and an `end` marker.
+class WrappedDecoder(Decoder):
+    start = end = None
+
+    def next(self):
+        if not self.started:
+            if self.take_until(self.start) is None:
+                return None
+            self.started = True
+        data = self.take_until(self.end)
+        if data is None:
+            return None
+        self.started = False
+        return parse(json.loads(data).encode('utf-8'))
+
+# `<script>\np(<json encoded frame>);\n</script>\r\n`, after the html
+# page prelude.
+class HtmlFileDecoder(WrappedDecoder):
+    start = '<script>\np('
+    end = ');\n</script>\r\n'
+
+# `/**/callback(<json encoded frame>);\r\n`, older servers don't send
+# the `/**/`.
+class JsonpDecoder(WrappedDecoder):
+    start = '('
+    end = ');\r\n'
+
+
+DECODERS = {
+    'xhr': XhrDecoder,
+    'xhr_streaming': XhrStreamingDecoder,
+    'eventsource': EventSourceDecoder,
+    'htmlfile': HtmlFileDecoder,
+    'jsonp': JsonpDecoder,
+}
+
+# `chunked` for data read straight off the socket, with the transfer
+# encoding still on.
+def decoder(transport, chunked=False):
+    return DECODERS[transport](chunked)
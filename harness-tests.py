@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+
+# Harness tests
+# =============
+#
+# The protocol suite trusts its own event loop and http clients. These
+# tests check them, on socket pairs where they can and against the
+# server under test otherwise:
+#
+#     ./venv/bin/python harness-tests.py --server -v
+#
+# They tell nothing about the server.
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+import unittest2 as unittest
+import asyncclient
+import escaping
+import framing
+import harness
+import histogram
+import rfc6455
+import runner
+import utils
+from ioloop import IOLoop, IOStream, TimeoutError, sleep
+
+test_top_url = runner.test_top_url()
+base_url = test_top_url + '/echo'
+
+
+class Loop(unittest.TestCase):
+    def setUp(self):
+        self.loop = IOLoop.instance()
+
+    def test_call_later_order(self):
+        calls = []
+        self.loop.call_later(0.02, calls.append, 2)
+        self.loop.call_later(0.01, calls.append, 1)
+        removed = self.loop.call_later(0.01, calls.append, 3)
+        self.loop.remove_timeout(removed)
+        self.loop.run_sync(sleep(0.05))
+        self.assertEqual(calls, [1, 2])
+
+    def test_run_sync_timeout(self):
+        with self.assertRaises(TimeoutError):
+            self.loop.run_sync(sleep(1), timeout=0.05)
+
+
+class Stream(unittest.TestCase):
+    def setUp(self):
+        self.loop = IOLoop.instance()
+        a, self.peer = socket.socketpair()
+        self.stream = IOStream(a, timeout=0.1)
+
+    def tearDown(self):
+        self.stream.close()
+        self.peer.close()
+
+    def run_sync(self, future):
+        return self.loop.run_sync(future, timeout=2)
+
+    def test_reads(self):
+        self.peer.sendall('line\r\nabcdef')
+        self.assertEqual(self.run_sync(self.stream.read_until('\n')),
+                         'line\r\n')
+        self.assertEqual(self.run_sync(self.stream.read_bytes(4)), 'abcd')
+        self.peer.close()
+        self.assertEqual(self.run_sync(self.stream.read_until_close()), 'ef')
+
+    def test_timeout(self):
+        with self.assertRaises(TimeoutError):
+            self.run_sync(self.stream.read_bytes(1))
+        self.assertTrue(self.stream.closed)
+
+    # A stream kept idle past its timeout, like a pooled connection,
+    # must not time out once the timeout is lifted.
+    def test_set_timeout(self):
+        self.peer.sendall('x')
+        self.assertEqual(self.run_sync(self.stream.read_bytes(1)), 'x')
+        self.run_sync(sleep(0.2))
+        self.stream.set_timeout(None)
+        self.loop.call_later(0.2, self.peer.sendall, 'y')
+        self.assertEqual(self.run_sync(self.stream.read_bytes(1)), 'y')
+
+
+class Histogram(unittest.TestCase):
+    # Three significant digits: every percentile is within 0.1%.
+    def test_percentiles(self):
+        h = histogram.Histogram()
+        for v in xrange(1, 100001):
+            h.record(v)
+        for p in (1, 50, 90, 99, 99.9):
+            expected = p * 1000
+            self.assertLessEqual(abs(h.percentile(p) - expected),
+                                 expected / 1000.0)
+        self.assertEqual(h.percentile(100), 100000)
+        self.assertEqual((h.min, h.max, h.count), (1, 100000, 100000))
+        self.assertAlmostEqual(h.mean(), 50000.5)
+
+    def test_merge(self):
+        a, b, both = [histogram.Histogram() for i in range(3)]
+        for v in xrange(0, 20000, 7):
+            a.record(v)
+            both.record(v)
+        for v in xrange(5, 900000, 311):
+            b.record(v, 2)
+            both.record(v, 2)
+        a.add(b)
+        self.assertEqual(list(a.buckets()), list(both.buckets()))
+        self.assertEqual((a.count, a.min, a.max),
+                         (both.count, both.min, both.max))
+        self.assertEqual(a.percentile(99), both.percentile(99))
+        with self.assertRaises(ValueError):
+            a.add(histogram.Histogram(significant=2))
+
+    # Out of range values land in the first and last buckets, `min` and
+    # `max` keep them exact.
+    def test_out_of_range(self):
+        h = histogram.Histogram(highest=1000)
+        h.record(-3)
+        h.record(5000)
+        self.assertEqual((h.count, h.min, h.max), (2, 0, 5000))
+        buckets = list(h.buckets())
+        self.assertEqual(buckets[0], (0, 0, 1))
+        self.assertLessEqual(buckets[-1][0], 1000)
+        self.assertGreaterEqual(buckets[-1][1], 1000)
+        self.assertEqual(h.percentile(50), 0)
+        self.assertEqual(h.percentile(100), 5000)
+
+
+FRAMES = ['o', 'h', 'a["x","\\u2028 y"]', 'a["' + 'z' * 5000 + '"]',
+          'c[3000,"Go away!"]']
+
+# The body of each transport, for `FRAMES`.
+def encode(transport):
+    if transport == 'xhr':
+        return ''.join(f + '\n' for f in FRAMES)
+    if transport == 'xhr_streaming':
+        return 'h' * 2048 + '\n' + encode('xhr')
+    if transport == 'eventsource':
+        return '\r\n' + ''.join('data: ' + f + '\r\n\r\n' for f in FRAMES)
+    if transport == 'htmlfile':
+        return '<!doctype html>\n' + ' ' * 1024 + '\r\n\r\n' + ''.join(
+            '<script>\np(' + json.dumps(f) + ');\n</script>\r\n'
+            for f in FRAMES)
+    return ''.join('/**/c(' + json.dumps(f) + ');\r\n' for f in FRAMES)
+
+# In chunks of uneven sizes.
+def chunked(body):
+    chunks, pos = [], 0
+    for size in [5, 300, 1, 4096] * (len(body) // 4402 + 1):
+        if pos < len(body):
+            chunks.append('%x;x=y\r\n%s\r\n' % (len(body[pos:pos + size]),
+                                                 body[pos:pos + size]))
+            pos += size
+    return ''.join(chunks) + '0\r\n\r\n'
+
+
+class Framing(unittest.TestCase):
+    def feed(self, transport, data, piece, chunked=False):
+        decoder = framing.decoder(transport, chunked)
+        frames = []
+        for i in xrange(0, len(data), piece):
+            frames.extend(decoder.feed(data[i:i + piece]))
+        return frames
+
+    def verify(self, chunked_encoding):
+        expected = [framing.parse(f) for f in FRAMES]
+        for transport in sorted(framing.DECODERS):
+            body = encode(transport)
+            if chunked_encoding:
+                body = chunked(body)
+            for piece in (1, 7, len(body)):
+                frames = self.feed(transport, body, piece, chunked_encoding)
+                self.assertEqual(frames, expected, (transport, piece))
+        self.assertEqual(expected[2].messages(), [u'x', u'\u2028 y'])
+        self.assertEqual(expected[4].close_reason(), (3000, u'Go away!'))
+
+    def test_pieces(self):
+        self.verify(False)
+
+    def test_chunked(self):
+        self.verify(True)
+
+    def test_bad_frame(self):
+        with self.assertRaises(ValueError):
+            self.feed('xhr', 'x\n', 1)
+
+
+class Escaping(unittest.TestCase):
+    # The tables hold what the regexes match, as the killer strings
+    # were built from them before.
+    def test_regex(self):
+        for escaper, start in ((escaping.client, 0), (escaping.server, 255)):
+            regex = re.compile(escaper.pattern)
+            old = '"' + ''.join([r'\u%04x' % (i) for i in range(start, 65536)
+                                 if regex.match(unichr(i))]) + '"'
+            self.assertEqual(escaper.killer_string(start), old)
+
+    def test_escape(self):
+        everything = u''.join(unichr(i) for i in xrange(65536))
+        for escaper in (escaping.client, escaping.server):
+            escaped = escaper.escape(everything)
+            self.assertEqual(escaping.unescape(escaped), everything)
+            self.assertEqual([c for c in escaped if c in escaper], [])
+            self.assertNotIn(u'"', escaped.replace(u'\\"', u''))
+        plain = u'abc \xe9'
+        self.assertIs(escaping.server.escape(plain), plain)
+        self.assertEqual(escaping.client.escape(u'a"\u2028'),
+                         u'a\\u0022\\u2028')
+        self.assertEqual(escaping.server.escape(u'a"\u2028'),
+                         u'a\\"\\u2028')
+        self.assertEqual(escaping.server.dumps([u'a', u'\u2028']),
+                         '["a","\\u2028"]')
+
+
+class Rfc6455(unittest.TestCase):
+    def decode(self, data, piece=1):
+        decoder = rfc6455.Decoder()
+        messages = []
+        for i in xrange(0, len(data), piece):
+            messages.extend(decoder.feed(data[i:i + piece]))
+        return messages
+
+    # Short and long payloads are masked differently, the same way.
+    def test_mask(self):
+        key = '\x01\x80\xfe\x7f'
+        for size in (0, 3, 63, 64, 65, 1000):
+            data = os.urandom(size)
+            expected = ''.join(chr(ord(c) ^ ord(key[i % 4]))
+                               for i, c in enumerate(data))
+            self.assertEqual(rfc6455.mask(key, data), expected)
+            self.assertEqual(rfc6455.mask(key, expected), data)
+
+    def test_lengths(self):
+        for size in (0, 125, 126, 65535, 65536):
+            data = os.urandom(size)
+            for masked in (True, False):
+                frame = rfc6455.encode_frame(rfc6455.OP_BINARY, data, masked)
+                self.assertEqual(self.decode(frame, piece=4096),
+                                 [(rfc6455.OP_BINARY, data)])
+
+    # A fragmented message comes out whole, the control frames sent in
+    # between it first.
+    def test_fragmented(self):
+        data = u'Hello world!\uffff '.encode('utf-8') * 20
+        frames = rfc6455.encode_message(rfc6455.OP_TEXT, data,
+                                        fragment_size=16)
+        headers, ends = [], [0]
+        while ends[-1] < len(frames):
+            header = rfc6455.parse_header(frames, ends[-1], len(frames))
+            headers.append(header[:3])
+            ends.append(ends[-1] + header[5] + header[4])
+        self.assertEqual(len(headers), (len(data) + 15) // 16)
+        self.assertEqual(headers[0], (False, 0, rfc6455.OP_TEXT))
+        self.assertEqual(headers[-1], (True, 0, rfc6455.OP_CONTINUATION))
+        ping = rfc6455.encode_frame(rfc6455.OP_PING, 'x')
+        i = ends[1]
+        self.assertEqual(self.decode(frames[:i] + ping + frames[i:]),
+                         [(rfc6455.OP_PING, 'x'), (rfc6455.OP_TEXT, data)])
+
+    def test_protocol_errors(self):
+        frames = [
+            # Reserved bits, without an extension to use them.
+            rfc6455.encode_frame(rfc6455.OP_TEXT, 'x', rsv=rfc6455.RSV1),
+            rfc6455.encode_frame(rfc6455.OP_TEXT, 'x', rsv=2),
+            # Fragmented control frame.
+            rfc6455.encode_frame(rfc6455.OP_PING, 'x', fin=False),
+            rfc6455.encode_frame(rfc6455.OP_CONTINUATION, 'x'),
+            rfc6455.encode_frame(0x3, 'x'),
+        ]
+        for frame in frames:
+            with self.assertRaises(rfc6455.ProtocolError):
+                self.decode(frame)
+
+
+class Deflate(unittest.TestCase):
+    def negotiate(self, header):
+        return rfc6455.negotiate_deflate(rfc6455.parse_extensions(header))
+
+    # The server takes the first offer it can, as it was made.
+    def test_negotiate(self):
+        D = rfc6455.DEFLATE
+        self.assertEqual(self.negotiate(D), {})
+        self.assertEqual(
+            self.negotiate('x-foo, ' + D + '; client_max_window_bits'), {})
+        self.assertEqual(self.negotiate(
+            D + '; server_no_context_takeover; client_max_window_bits=10'),
+            {'server_no_context_takeover': None,
+             'client_max_window_bits': '10'})
+        self.assertEqual(self.negotiate(
+            D + '; server_max_window_bits=8, ' +
+            D + '; server_max_window_bits="9"'),
+            {'server_max_window_bits': '9'})
+        for header in ('', 'x-foo', D + '; x=1',
+                       D + '; server_max_window_bits',
+                       D + '; client_no_context_takeover=1',
+                       D + '; client_max_window_bits=16'):
+            self.assertIsNone(self.negotiate(header), header)
+
+    # The client holds the server to its offer.
+    def test_accept(self):
+        accept = rfc6455.accept_deflate
+        offer = {'server_no_context_takeover': None,
+                 'server_max_window_bits': '10',
+                 'client_max_window_bits': None}
+        for params in (dict(offer, client_max_window_bits='9'),
+                       {'server_no_context_takeover': None,
+                        'server_max_window_bits': '9'}):
+            self.assertEqual(accept(offer, params), params)
+        for params in ({'server_max_window_bits': '10'},
+                       {'server_no_context_takeover': None},
+                       {'server_no_context_takeover': None,
+                        'server_max_window_bits': '11'},
+                       dict(offer, client_max_window_bits='8'),
+                       dict(offer, client_max_window_bits=None),
+                       dict(offer, x=None)):
+            with self.assertRaises(rfc6455.NegotiationError):
+                accept(offer, params)
+        with self.assertRaises(rfc6455.NegotiationError):
+            accept({}, {'client_max_window_bits': '10'})
+
+    def test_compression(self):
+        for params in ({}, {'server_no_context_takeover': None,
+                            'client_no_context_takeover': None,
+                            'client_max_window_bits': '9'}):
+            client = rfc6455.Deflate(params)
+            server = rfc6455.Deflate(params, client=False)
+            msg = '["' + 'abc' * 1000 + '"]'
+            frames = [rfc6455.encode_message(rfc6455.OP_TEXT, msg,
+                                             fragment_size=16, deflate=client)
+                      for i in range(2)]
+            for frame in frames:
+                decoder = rfc6455.Decoder(server)
+                self.assertEqual(decoder.feed(frame), [(rfc6455.OP_TEXT, msg)])
+            # Without context takeover, the same message compresses the
+            # same every time.
+            takeover = params == {}
+            self.assertEqual(len(frames[1]) < len(frames[0]), takeover)
+
+
+# A websocket client on one end of a socket pair.
+class WebsocketClient(unittest.TestCase):
+    def setUp(self):
+        a, self.peer = socket.socketpair()
+        conn = asyncclient.HttpConnection(IOStream(a, timeout=1))
+        self.ws = asyncclient.WebSocket(conn, None)
+
+    def tearDown(self):
+        self.ws.stream.close()
+        self.peer.close()
+
+    # The close frame the client answers `frame` with.
+    def close_reply(self, frame, code):
+        self.peer.sendall(frame)
+        with self.assertRaises(self.ws.ConnectionClosedException) as cm:
+            IOLoop.instance().run_sync(self.ws.recv(), timeout=2)
+        self.assertEqual(cm.exception.code, code)
+        self.peer.settimeout(2)
+        data = ''
+        while True:
+            chunk = self.peer.recv(4096)
+            if not chunk:
+                return rfc6455.Decoder().feed(data)
+            data += chunk
+
+    def test_close(self):
+        frame = rfc6455.encode_frame(rfc6455.OP_CLOSE, '\x0b\xb8bye',
+                                     masked=False)
+        self.assertEqual(self.close_reply(frame, 3000),
+                         [(rfc6455.OP_CLOSE, '\x0b\xb8')])
+
+    # 1005 is never sent, a close without a code is answered with none.
+    def test_close_without_code(self):
+        frame = rfc6455.encode_frame(rfc6455.OP_CLOSE, '', masked=False)
+        self.assertEqual(self.close_reply(frame, 1005),
+                         [(rfc6455.OP_CLOSE, '')])
+
+    # Text that isn't UTF-8 fails the connection with 1007.
+    def test_invalid_text(self):
+        frame = rfc6455.encode_frame(rfc6455.OP_TEXT, '\xff', masked=False)
+        self.assertEqual(self.close_reply(frame, 1007),
+                         [(rfc6455.OP_CLOSE, '\x03\xef')])
+
+    def test_invalid_reason(self):
+        frame = rfc6455.encode_frame(rfc6455.OP_CLOSE, '\x03\xe8\xff',
+                                     masked=False)
+        self.assertEqual(self.close_reply(frame, 1007),
+                         [(rfc6455.OP_CLOSE, '\x03\xef')])
+
+
+OK = 'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'
+
+# Serves `responses` in turn, over as few connections as it can: None
+# closes the connection instead of answering. Records the method of
+# each request, and whether the client closed the last connection.
+class ScriptedServer(object):
+    def __init__(self, responses):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(4)
+        self.url = 'http://127.0.0.1:%d/' % (self.sock.getsockname()[1],)
+        self.responses = responses
+        self.methods = []
+        self.closed = None
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        s = None
+        for response in self.responses:
+            if s is None:
+                s, _ = self.sock.accept()
+                s.settimeout(2)
+            data = ''
+            while '\r\n\r\n' not in data:
+                data += s.recv(4096)
+            self.methods.append(data.split(' ', 1)[0])
+            if response is None:
+                s.close()
+                s = None
+            else:
+                s.sendall(response)
+        if s is not None:
+            try:
+                self.closed = s.recv(1) == ''
+            except socket.timeout:
+                self.closed = False
+            s.close()
+        self.sock.close()
+
+    def join(self):
+        self.thread.join(2)
+
+
+class Client(unittest.TestCase):
+    def run_sync(self, future):
+        return IOLoop.instance().run_sync(future, timeout=2)
+
+    # A response the client can't read ends the request and its
+    # connection.
+    def test_error_closes(self):
+        server = ScriptedServer(['HTTP/1.1 200 OK\r\n\r\n'])
+        with self.assertRaises(Exception):
+            self.run_sync(asyncclient.GET(server.url))
+        server.join()
+        self.assertTrue(server.closed)
+
+    # A pooled connection closed by the server is replaced, and a GET
+    # sent again on the new one.
+    def test_pooled_retry(self):
+        server = ScriptedServer([OK, None, OK])
+        self.run_sync(asyncclient.GET(server.url))
+        self.assertEqual(self.run_sync(asyncclient.GET(server.url)).status,
+                         200)
+        self.assertEqual(server.methods, ['GET', 'GET', 'GET'])
+
+    # But a POST the server may have acted upon isn't.
+    def test_pooled_no_resend(self):
+        server = ScriptedServer([OK, None, OK])
+        self.run_sync(asyncclient.POST(server.url))
+        with self.assertRaises(socket.error):
+            self.run_sync(asyncclient.POST(server.url))
+        self.assertEqual(server.methods, ['POST', 'POST'])
+
+    # The connection of a request with a timeout goes back to the pool,
+    # and is taken by one without.
+    def test_pooled_timeout(self):
+        loop = IOLoop.instance()
+        url = base_url + '/000/' + str(uuid.uuid4())
+        self.assertEqual(utils.POST(url + '/xhr').body, 'o\n')
+        poll = asyncclient.POST(url + '/xhr', timeout=None)
+        loop.call_later(1.2, lambda: asyncclient.POST(
+            url + '/xhr_send', body='["x"]', keepalive=False))
+        t0 = time.time()
+        r = loop.run_sync(poll, timeout=5)
+        self.assertEqual(r.body, 'a["x"]\n')
+        self.assertGreater(time.time() - t0, 1)
+
+    # `HttpResponse` loads a single chunk of a chunked body, the
+    # connection mustn't be reused after that.
+    def test_httplib_pool_chunked(self):
+        url = test_top_url + '/close/000/' + str(uuid.uuid4())
+        r = utils.HttpResponse('POST', url + '/xhr_streaming')
+        self.assertEqual(r.status, 200)
+        r = utils.HttpResponse('GET', base_url)
+        self.assertEqual(r.body, 'Welcome to SockJS!\n')
+
+    # The whole of a chunked body, a little at a time through
+    # `readinto()` and `readview()`.
+    def test_httplib_chunked_reads(self):
+        body = 'h' * 2048 + '\n' + 'o\n' + 'c[3000,"Go away!"]\n'
+        def read_all(read):
+            url = test_top_url + '/close/000/' + str(uuid.uuid4())
+            r = utils.old_POST_async(url + '/xhr_streaming')
+            self.assertTrue(r.res.chunked)
+            data = []
+            for piece in iter(lambda: read(r.res), ''):
+                data.append(piece)
+            self.assertTrue(r.res.isclosed())
+            r.close()
+            return ''.join(data)
+        buf = bytearray(100)
+        def readinto(res):
+            return str(buf[:res.readinto(buf)])
+        self.assertEqual(read_all(readinto), body)
+        self.assertEqual(read_all(lambda res: res.readview(7).tobytes()), body)
+
+    # A connection taken from the pool is counted from then on.
+    def test_traffic_pooled(self):
+        loop = IOLoop.instance()
+        loop.run_sync(asyncclient.GET(base_url))
+        with asyncclient.Traffic() as traffic:
+            r = loop.run_sync(asyncclient.GET(base_url))
+        t = traffic.totals()
+        self.assertEqual(r.body, 'Welcome to SockJS!\n')
+        self.assertEqual(t['received'] - t['header_received'], len(r.body))
+        self.assertEqual(t['sent'], t['header_sent'])
+
+
+# The Latency tests of the protocol suite blame the server for any
+# stall, so the clients they use must answer at once, see `harness.py`.
+class Harness(unittest.TestCase):
+    def test_latency(self):
+        for name, p50, top, ok in harness.check(rounds=10):
+            self.assertTrue(ok, '%s adds %.1fms (max %.1fms)' % (
+                name, p50, top))
+
+
+if __name__ == '__main__':
+    runner.main()
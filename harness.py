@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Harness latency
+# ===============
+#
+# Before blaming a server for slow responses, make sure the clients
+# aren't the ones taking the time. This times small POSTs, like the
+# `xhr_send` ones, from each http client of the harness to a server
+# that answers at once, over loopback and on a keep-alive connection:
+#
+#     ./venv/bin/python harness.py
+#
+# Whatever a roundtrip takes here adds to every measurement made with
+# that client. Tens of milliseconds are a stall, usually Nagle's
+# algorithm holding back part of a request until the delayed ACK of
+# the rest comes in.
+import socket
+import sys
+import threading
+import asyncclient
+import utils
+from ioloop import IOLoop, monotonic
+
+
+RESPONSE = 'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'
+
+# Medians above that, in milliseconds, are latency added by the client.
+THRESHOLD = 5.0
+
+
+# Reads requests and answers each one with an empty response, a thread
+# per connection.
+class NullServer(object):
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.url = 'http://127.0.0.1:%d' % (self.sock.getsockname()[1],)
+        self.spawn(self.serve)
+
+    def spawn(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        try:
+            while True:
+                s, _ = self.sock.accept()
+                self.spawn(self.handle, s)
+        except socket.error:
+            self.sock.close()
+
+    # Wakes the accepting thread up, which closes the socket.
+    def close(self):
+        self.sock.shutdown(socket.SHUT_RDWR)
+
+    def handle(self, s):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = utils.SocketBuffer(s)
+        try:
+            while True:
+                length = 0
+                line = buf.readline()
+                while line not in ('\r\n', '\n', ''):
+                    name, _, value = line.partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                    line = buf.readline()
+                if not line:
+                    return
+                buf.read(length)
+                s.sendall(RESPONSE)
+        except socket.error:
+            pass
+        finally:
+            s.close()
+
+
+BODY = u'["x"]'
+
+# Each client gives a roundtrip function, and one closing whatever
+# connection it kept open.
+def raw_client(url):
+    c = utils.RawHttpConnection(url)
+    return lambda: c.request('POST', url, body=BODY), c.close
+
+def httplib_client(url):
+    return (lambda: utils.HttpResponse('POST', url, body=BODY),
+            utils.httplib_pool.clear)
+
+def async_client(url):
+    loop = IOLoop.instance()
+    return (lambda: loop.run_sync(asyncclient.POST(url, body=BODY), timeout=5),
+            asyncclient.pool.clear)
+
+CLIENTS = [('RawHttpConnection', raw_client),
+           ('httplib', httplib_client),
+           ('asyncclient', async_client)]
+
+
+# Roundtrip times in milliseconds, sorted. The first request opens the
+# connection and isn't counted.
+def measure(roundtrip, rounds):
+    roundtrip()
+    samples = []
+    for i in xrange(rounds):
+        t0 = monotonic()
+        roundtrip()
+        samples.append((monotonic() - t0) * 1000)
+    return sorted(samples)
+
+# `[(client, p50, max, ok), ...]`
+def check(rounds=50):
+    server = NullServer()
+    results = []
+    try:
+        for name, make in CLIENTS:
+            roundtrip, close = make(server.url + '/')
+            try:
+                samples = measure(roundtrip, rounds)
+            finally:
+                close()
+            p50 = samples[len(samples) // 2]
+            results.append((name, p50, samples[-1], p50 <= THRESHOLD))
+    finally:
+        server.close()
+    return results
+
+def report(results):
+    for name, p50, top, ok in results:
+        print ' [*] harness %-17s p50=%.3fms max=%.3fms%s' % (
+            name, p50, top, '' if ok else '  <- adds latency')
+    return all(ok for _, _, _, ok in results)
+
+
+if __name__ == '__main__':
+    sys.exit(0 if report(check()) else 1)
@@ -0,0 +1,144 @@
+# Latency histogram
+# =================
+#
+# A histogram in the spirit of HdrHistogram: values are integers
+# (microseconds, for the load tools) counted in log-linear buckets.
+# Values below `sub_count` have a bucket each, above that every power
+# of two is split into `sub_count / 2` buckets, so the value reported
+# for a bucket is off by less than one part in `sub_count / 2`. With
+# the default three significant digits that's 0.1%.
+#
+# Memory is fixed by the highest trackable value, about 23k counters
+# for an hour in microseconds. Histograms with the same layout can be
+# merged, which is how results of several workers are put together.
+import array
+import math
+
+
+class Histogram(object):
+    def __init__(self, highest=3600 * 1000 * 1000, significant=3):
+        self.highest = highest
+        self.significant = significant
+        self.sub_bits = int(math.ceil(math.log(2 * 10 ** significant, 2)))
+        self.sub_count = 1 << self.sub_bits
+        self.half_count = self.sub_count >> 1
+        self.counts = array.array('L', [0]) * (self.index(highest) + 1)
+        self.reset()
+
+    def reset(self):
+        for i in xrange(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.sum_sq = 0.0
+
+    def index(self, value):
+        if value < self.sub_count:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        return self.sub_count + (shift - 1) * self.half_count + \
+            (value >> shift) - self.half_count
+
+    # Range of values `[low, high]` counted in the bucket `i`.
+    def bucket_range(self, i):
+        if i < self.sub_count:
+            return i, i
+        shift = (i - self.sub_count) // self.half_count + 1
+        sub = (i - self.sub_count) % self.half_count + self.half_count
+        return sub << shift, ((sub + 1) << shift) - 1
+
+    # Values above `highest` are counted in the last bucket, only
+    # `max` keeps them exact.
+    def record(self, value, count=1):
+        value = max(int(value), 0)
+        self.counts[self.index(min(value, self.highest))] += count
+        self.count += count
+        self.sum += float(value) * count
+        self.sum_sq += float(value) * value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def add(self, other):
+        if (other.highest, other.significant) != \
+                (self.highest, self.significant):
+            raise ValueError('histograms have different layouts')
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] += c
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        for v in (other.min, other.max):
+            if v is not None:
+                if self.min is None or v < self.min:
+                    self.min = v
+                if self.max is None or v > self.max:
+                    self.max = v
+        return self
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.sum / self.count
+
+    def stddev(self):
+        if self.count == 0:
+            return None
+        mean = self.mean()
+        return math.sqrt(max(self.sum_sq / self.count - mean * mean, 0.0))
+
+    # Smallest recorded value (well, the top of its bucket) that at
+    # least `p` percent of the values are equal to or below.
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        target = max(int(math.ceil(self.count * min(p, 100.0) / 100.0)), 1)
+        if target >= self.count:
+            return self.max
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return min(self.bucket_range(i)[1], self.max)
+        return self.max
+
+    # Non-empty buckets, as `(low, high, count)`.
+    def buckets(self):
+        for i, c in enumerate(self.counts):
+            if c:
+                low, high = self.bucket_range(i)
+                yield low, high, c
+
+    # Percentile distribution in the `.hgrm` format of HdrHistogram,
+    # which its plotter understands. Percentiles get denser towards
+    # the tail, `ticks` rows for every halving of the distance to
+    # 100%. Values are divided by `scale`.
+    def write_percentiles(self, f, scale=1.0, ticks=5):
+        f.write('%12s %14s %10s %14s\n\n' % (
+            'Value', 'Percentile', 'TotalCount', '1/(1-Percentile)'))
+        cumulative = []
+        seen = 0
+        for c in self.counts:
+            seen += c
+            cumulative.append(seen)
+        p = 0.0
+        while self.count:
+            value = self.percentile(p)
+            below = cumulative[self.index(min(value, self.highest))]
+            if below >= self.count:
+                f.write('%12.3f %2.12f %10d\n' % (value / scale, 1.0, below))
+                break
+            f.write('%12.3f %2.12f %10d %14.2f\n' % (
+                value / scale, p / 100.0, below, 100.0 / (100.0 - p)))
+            halvings = int(math.log(100.0 / (100.0 - p), 2)) + 1
+            p += 100.0 / (2 ** halvings) / ticks
+        f.write('#[Mean    = %12.3f, StdDeviation   = %12.3f]\n' % (
+            (self.mean() or 0) / scale, (self.stddev() or 0) / scale))
+        f.write('#[Max     = %12.3f, Total count    = %12d]\n' % (
+            (self.max or 0) / scale, self.count))
+        f.write('#[Buckets = %12d, SubBuckets     = %12d]\n' % (
+            len(self.counts), self.sub_count))
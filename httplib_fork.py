@@ -67,6 +67,7 @@ Req-sent-unread-response       _CS_REQ_SENT       <response_class>
 """
 
 from array import array
+import errno
 import os
 import socket
 from sys import py3kwarning
@@ -212,6 +213,9 @@ responses = {
 # maximal amount of data to read at one time in _safe_read
 MAXAMOUNT = 1048576
 
+# size of the buffer chunked bodies are read into
+_CHUNK_BUFFER = 65536 + 1024
+
 # maximal line length when calling readline().
 _MAXLINE = 65536
 
@@ -344,6 +348,9 @@ class HTTPResponse:
             # response, which make be read via a recv() on the underlying
             # socket.
             self.fp = sock.makefile('rb', 0)
+        # Unbuffered, the file object never reads ahead and the socket
+        # can be read from directly.
+        self._sock = None if buffering else sock
         self.debuglevel = debuglevel
         self.strict = strict
         self._method = method
@@ -357,6 +364,9 @@ class HTTPResponse:
 
         self.chunked = _UNKNOWN         # is "chunked" being used?
         self.chunk_left = _UNKNOWN      # bytes left to read in current chunk
+        self._cbuf = None               # buffer for chunked bodies
+        self._cstart = self._cend = 0   # unread data in self._cbuf
+        self._crlf = False              # CRLF after a chunk not read yet
         self.length = _UNKNOWN          # number of bytes left in response
         self.will_close = _UNKNOWN      # conn will close at end of response
 
@@ -517,6 +527,7 @@ class HTTPResponse:
         if self.fp:
             self.fp.close()
             self.fp = None
+        self._cbuf = None
 
     def isclosed(self):
         # NOTE: it is possible that we will not ever call self.close(). This
@@ -565,92 +576,208 @@ class HTTPResponse:
                 self.close()
         return s
 
+    def readinto(self, b):
+        """Read up to len(b) bytes into the writable buffer b.
+
+        Returns the number of bytes read, 0 at the end of the response.
+        Like read(), a chunked response is read at most one chunk at a
+        time.
+        """
+        if self.fp is None:
+            return 0
+
+        if self._method == 'HEAD':
+            self.close()
+            return 0
+
+        if self.chunked:
+            view = memoryview(b)
+            n = 0
+            while True:
+                data = self._chunk_view(len(view) - n)
+                view[n:n + len(data)] = data
+                n += len(data)
+                if not data or n == len(view) or self.chunk_left is None:
+                    return n
+
+        if self.length is not None and len(b) > self.length:
+            # clip the read to the "end of response"
+            b = memoryview(b)[:self.length]
+        n = self._fp_readinto(b)
+        if not n and len(b):
+            self.close()
+        elif self.length is not None:
+            self.length -= n
+            if not self.length:
+                self.close()
+        return n
+
+    def readview(self, amt=None):
+        """Return a memoryview of the next piece of a chunked body.
+
+        The view points into a buffer of the response and is only valid
+        until the next read.  It holds whatever part of the current chunk
+        is available, at most amt bytes, and is empty at the end of the
+        body.
+        """
+        assert self.chunked, 'readview() needs a chunked response'
+        if self.fp is None:
+            return memoryview('')
+        return self._chunk_view(amt, partial=True)
+
     def _read_chunked(self, amt):
         assert self.chunked != _UNKNOWN
-        chunk_left = self.chunk_left
-        value = []
-        while True:
-            if chunk_left is None:
-                line = self.fp.readline(_MAXLINE + 1)
-                if len(line) > _MAXLINE:
-                    raise LineTooLong("chunk size")
-                i = line.find(';')
-                if i >= 0:
-                    line = line[:i] # strip chunk-extensions
-                try:
-                    chunk_left = int(line, 16)
-                except ValueError:
-                    # close the connection as protocol synchronisation is
-                    # probably lost
-                    self.close()
-                    raise IncompleteRead(''.join(value))
-                if chunk_left == 0:
+        data = self._chunk_view(amt)
+        if self.chunk_left is None or not data:
+            return data.tobytes()
+        # the rest of the chunk (or of amt) isn't there yet
+        want = self.chunk_left + len(data)
+        if amt is not None:
+            want = min(want, amt)
+        b = bytearray(want)
+        b[:len(data)] = data
+        n = len(data)
+        view = memoryview(b)
+        while n < want:
+            data = self._chunk_view(want - n)
+            view[n:n + len(data)] = data
+            n += len(data)
+        return str(b)
+
+    # Chunked bodies are read with recv_into() into a buffer of the
+    # response's own.  Size lines are parsed in place and the data is
+    # handed out as memoryviews of the buffer.  Reading ahead is safe:
+    # nothing may follow the last chunk until another request is sent.
+    def _chunk_view(self, amt, partial=False):
+        if self._cbuf is None:
+            self._cbuf = bytearray(_CHUNK_BUFFER)
+            self._cstart = self._cend = 0
+        if self.chunk_left is None:
+            if self._crlf:
+                self._skip(2)   # toss the CRLF at the end of the chunk
+                self._crlf = False
+            self.chunk_left = self._read_chunk_size()
+            if self.chunk_left == 0:
+                self._read_trailer()
+                # we read everything; close the "file"
+                self.close()
+                return memoryview('')
+        want = self.chunk_left if amt is None else min(amt, self.chunk_left)
+        if not partial:
+            want = min(want, len(self._cbuf))
+        while self._cend - self._cstart < want:
+            if not self._fill(want - (self._cend - self._cstart)):
+                if self._cend - self._cstart and partial:
                     break
-            if amt is None:
-                value.append(self._safe_read(chunk_left))
-            elif amt < chunk_left:
-                value.append(self._safe_read(amt))
-                self.chunk_left = chunk_left - amt
-                return ''.join(value)
-            elif amt == chunk_left:
-                value.append(self._safe_read(amt))
-                self._safe_read(2)  # toss the CRLF at the end of the chunk
-                self.chunk_left = None
-                return ''.join(value)
-            else:
-                value.append(self._safe_read(chunk_left))
-                amt -= chunk_left
-
-            # we read the whole chunk, get another
-            self._safe_read(2)      # toss the CRLF at the end of the chunk
-            chunk_left = None
-            return ''.join(value)
+                raise IncompleteRead(self._cbuf[self._cstart:self._cend],
+                                     want)
+            if partial:
+                break
+        n = min(want, self._cend - self._cstart)
+        view = memoryview(self._cbuf)[self._cstart:self._cstart + n]
+        self._cstart += n
+        self.chunk_left -= n
+        if not self.chunk_left:
+            self.chunk_left = None
+            self._crlf = True
+        return view
+
+    def _read_chunk_size(self):
+        line = self._read_chunk_line("chunk size")
+        i = line.find(';')
+        if i >= 0:
+            line = line[:i] # strip chunk-extensions
+        try:
+            return int(line, 16)
+        except ValueError:
+            # close the connection as protocol synchronisation is
+            # probably lost
+            self.close()
+            raise IncompleteRead('')
 
+    def _read_trailer(self):
         # read and discard trailer up to the CRLF terminator
         ### note: we shouldn't have any trailers!
         while True:
-            line = self.fp.readline(_MAXLINE + 1)
-            if len(line) > _MAXLINE:
-                raise LineTooLong("trailer line")
-            if not line:
+            try:
+                line = self._read_chunk_line("trailer line")
+            except IncompleteRead:
                 # a vanishingly small number of sites EOF without
                 # sending the trailer
                 break
             if line == '\r\n':
                 break
 
-        # we read everything; close the "file"
-        self.close()
-
-        return ''.join(value)
+    def _read_chunk_line(self, what):
+        scanned = 0
+        while True:
+            i = self._cbuf.find('\n', self._cstart + scanned, self._cend)
+            if i >= 0:
+                line = str(self._cbuf[self._cstart:i + 1])
+                self._cstart = i + 1
+                return line
+            scanned = self._cend - self._cstart
+            if scanned > _MAXLINE:
+                raise LineTooLong(what)
+            if not self._fill():
+                raise IncompleteRead('')
+
+    def _skip(self, amt):
+        while self._cend - self._cstart < amt:
+            if not self._fill(amt - (self._cend - self._cstart)):
+                raise IncompleteRead('', amt)
+        self._cstart += amt
+
+    # Makes room at the end of the chunk buffer, moving what's left to
+    # the front, and reads into it.  A buffered file object blocks until
+    # it has all it was asked for, it's only asked for the `need` bytes
+    # that are known to come.
+    def _fill(self, need=1):
+        buf = self._cbuf
+        if self._cstart == self._cend:
+            self._cstart = self._cend = 0
+        elif self._cend == len(buf):
+            if not self._cstart:
+                raise LineTooLong("chunk buffer")
+            pending = self._cend - self._cstart
+            buf[:pending] = buf[self._cstart:self._cend]
+            self._cstart, self._cend = 0, pending
+        view = memoryview(buf)[self._cend:]
+        if self._sock is None:
+            view = view[:need]
+        n = self._fp_readinto(view)
+        self._cend += n
+        return n
+
+    def _fp_readinto(self, b):
+        # socket._fileobject has no readinto()
+        if self._sock is None:
+            data = self.fp.read(len(b))
+            b[:len(data)] = data
+            return len(data)
+        while True:
+            try:
+                return self._sock.recv_into(b, len(b))
+            except socket.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
 
     def _safe_read(self, amt):
         """Read the number of bytes requested, compensating for partial reads.
 
-        Normally, we have a blocking socket, but a read() can be interrupted
-        by a signal (resulting in a partial read).
-
-        Note that we cannot distinguish between EOF and an interrupt when zero
-        bytes have been read. IncompleteRead() will be raised in this
-        situation.
-
         This function should be used when <amt> bytes "should" be present for
         reading. If the bytes are truly not available (due to EOF), then the
         IncompleteRead exception can be used to detect the problem.
         """
-        # NOTE(gps): As of svn r74426 socket._fileobject.read(x) will never
-        # return less than x bytes unless EOF is encountered.  It now handles
-        # signal interruptions (socket.error EINTR) internally.  This code
-        # never caught that exception anyways.  It seems largely pointless.
-        # self.fp.read(amt) will work fine.
-        s = []
-        while amt > 0:
-            chunk = self.fp.read(min(amt, MAXAMOUNT))
-            if not chunk:
-                raise IncompleteRead(''.join(s), amt)
-            s.append(chunk)
-            amt -= len(chunk)
-        return ''.join(s)
+        b = bytearray(amt)
+        view = memoryview(b)
+        n = 0
+        while n < amt:
+            got = self._fp_readinto(view[n:n + min(amt - n, MAXAMOUNT)])
+            if not got:
+                raise IncompleteRead(str(b[:n]), amt - n)
+            n += got
+        return str(b)
 
     def fileno(self):
         return self.fp.fileno()
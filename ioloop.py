@@ -0,0 +1,672 @@
+# Event loop
+# ==========
+#
+# A small single-threaded event loop, used by the asynchronous client
+# and the load tools. Python 2 has no asyncio, so coroutines are plain
+# generators decorated with `coroutine`. They yield `Future`s (or lists
+# of them) and return values by raising `Return`, the same convention
+# as in Tornado or Trollius:
+#
+#     @coroutine
+#     def echo(stream, data):
+#         yield stream.write(data)
+#         reply = yield stream.read_bytes(len(data))
+#         raise Return(reply)
+import collections
+import errno
+import functools
+import heapq
+import itertools
+import os
+import select
+import socket
+import sys
+import time
+import traceback
+
+
+class TimeoutError(socket.timeout): pass
+
+class StreamClosedError(socket.error): pass
+
+class Return(Exception):
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+
+# Seconds from `CLOCK_MONOTONIC`, for durations that mustn't jump with
+# the wall clock. Python 2 has no `time.monotonic()`, it's called
+# through ctypes where librt has it, and is `time.time()` elsewhere.
+def _monotonic_clock():
+    try:
+        import ctypes
+        import ctypes.util
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    byref = ctypes.byref
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, byref(t)):
+            errno_ = ctypes.get_errno()
+            raise OSError(errno_, os.strerror(errno_))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _monotonic_clock()
+
+
+def _run_callback(callback, *args):
+    try:
+        callback(*args)
+    except Exception:
+        traceback.print_exc()
+
+
+class Future(object):
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        assert self._done, "Future is not done yet"
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        assert self._done, "Future is not done yet"
+        return self._exc_info[1] if self._exc_info else None
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exc):
+        self.set_exc_info((type(exc), exc, None))
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._set_done()
+
+    def _set_done(self):
+        assert not self._done, "Future is already done"
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, None
+        for callback in callbacks:
+            _run_callback(callback, self)
+
+    def add_done_callback(self, callback):
+        if self._done:
+            _run_callback(callback, self)
+        else:
+            self._callbacks.append(callback)
+
+
+def gather(futures):
+    result = Future()
+    pending = set(futures)
+    if not pending:
+        result.set_result([])
+    def done(f):
+        pending.discard(f)
+        if result.done():
+            return
+        if f.exception() is not None:
+            result.set_exc_info(f._exc_info)
+        elif not pending:
+            result.set_result([f.result() for f in futures])
+    for f in futures:
+        f.add_done_callback(done)
+    return result
+
+
+# Drives a generator. Futures that are already done are consumed in a
+# loop, so reading buffered data doesn't go through the event loop.
+class _Runner(object):
+    def __init__(self, gen, future):
+        self.gen = gen
+        self.future = future
+        self.run(None, None)
+
+    def run(self, value, exc_info):
+        while True:
+            try:
+                if exc_info:
+                    yielded = self.gen.throw(*exc_info)
+                else:
+                    yielded = self.gen.send(value)
+            except (Return, StopIteration) as e:
+                self.future.set_result(getattr(e, 'value', None))
+                return
+            except Exception:
+                self.future.set_exc_info(sys.exc_info())
+                return
+            if isinstance(yielded, list):
+                yielded = gather(yielded)
+            if not yielded.done():
+                yielded.add_done_callback(self.wakeup)
+                return
+            value, exc_info = yielded._result, yielded._exc_info
+
+    def wakeup(self, f):
+        self.run(f._result, f._exc_info)
+
+def coroutine(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        future = Future()
+        try:
+            gen = func(*args, **kwargs)
+        except Return as e:
+            future.set_result(e.value)
+            return future
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+            return future
+        if hasattr(gen, 'send'):
+            _Runner(gen, future)
+        else:
+            future.set_result(gen)
+        return future
+    return wrapper
+
+
+class _EPoll(object):
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.register = self.epoll.register
+        self.modify = self.epoll.modify
+        self.unregister = self.epoll.unregister
+
+    def poll(self, timeout):
+        return self.epoll.poll(timeout)
+
+class _Poll(object):
+    def __init__(self):
+        self.p = select.poll()
+        self.register = self.p.register
+        self.modify = self.p.modify
+        self.unregister = self.p.unregister
+
+    def poll(self, timeout):
+        return self.p.poll(timeout * 1000 if timeout >= 0 else None)
+
+
+class IOLoop(object):
+    READ = select.POLLIN
+    WRITE = select.POLLOUT
+    ERROR = select.POLLERR | select.POLLHUP
+
+    _instance = None
+
+    # One loop per process. A forked child gets a loop of its own.
+    @classmethod
+    def instance(cls):
+        if cls._instance is None or cls._instance.pid != os.getpid():
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.poller = _EPoll() if hasattr(select, 'epoll') else _Poll()
+        self.handlers = {}
+        self.callbacks = []
+        self.timeouts = []
+        self.cancelled = 0
+        self.seq = itertools.count()
+        self.running = False
+
+    def time(self):
+        return monotonic()
+
+    def add_handler(self, fd, handler, events):
+        self.handlers[fd] = handler
+        self.poller.register(fd, events | self.ERROR)
+
+    def update_handler(self, fd, events):
+        self.poller.modify(fd, events | self.ERROR)
+
+    def remove_handler(self, fd):
+        self.handlers.pop(fd, None)
+        try:
+            self.poller.unregister(fd)
+        except (KeyError, IOError, OSError, ValueError):
+            pass
+
+    def add_callback(self, callback, *args):
+        self.callbacks.append((callback, args))
+
+    def call_at(self, deadline, callback, *args):
+        timeout = [deadline, next(self.seq), callback, args]
+        heapq.heappush(self.timeouts, timeout)
+        return timeout
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    # Cancelled timeouts are dropped lazily, unless there are many.
+    def remove_timeout(self, timeout):
+        if timeout[2] is not None:
+            timeout[2] = None
+            self.cancelled += 1
+            if self.cancelled > 512 and self.cancelled > len(self.timeouts) / 2:
+                self.timeouts = [t for t in self.timeouts if t[2] is not None]
+                heapq.heapify(self.timeouts)
+                self.cancelled = 0
+
+    def stop(self):
+        self.running = False
+
+    def start(self):
+        assert not self.running, "Loop is already running"
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def run_once(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, args in callbacks:
+            _run_callback(callback, *args)
+
+        now = self.time()
+        while self.timeouts:
+            timeout = self.timeouts[0]
+            if timeout[2] is None:
+                heapq.heappop(self.timeouts)
+                self.cancelled -= 1
+            elif timeout[0] <= now:
+                heapq.heappop(self.timeouts)
+                callback, timeout[2] = timeout[2], None
+                _run_callback(callback, *timeout[3])
+            else:
+                break
+
+        if self.callbacks or not self.running:
+            poll_timeout = 0
+        elif self.timeouts:
+            poll_timeout = max(0, self.timeouts[0][0] - self.time())
+        else:
+            poll_timeout = -1
+        try:
+            events = self.poller.poll(poll_timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, event in events:
+            handler = self.handlers.get(fd)
+            if handler:
+                _run_callback(handler, fd, event)
+
+    # Runs the loop until the future is done and returns its result.
+    def run_sync(self, future, timeout=None):
+        if not future.done():
+            finished = []
+            def finish(_=None):
+                if not finished:
+                    finished.append(True)
+                    self.stop()
+            future.add_done_callback(finish)
+            handle = timeout and self.call_later(timeout, finish)
+            self.start()
+            if handle:
+                self.remove_timeout(handle)
+            if not future.done():
+                raise TimeoutError('timed out')
+        return future.result()
+
+
+def sleep(delay, loop=None):
+    future = Future()
+    (loop or IOLoop.instance()).call_later(delay, future.set_result, None)
+    return future
+
+
+# Receive buffer: data is read with `recv_into` straight into a
+# preallocated bytearray, and taken out only once a full line or
+# message is there. It starts small, so that many idle connections
+# are cheap, and doubles when what's pending fills more than half of
+# it.
+class ReceiveBuffer(object):
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.start = self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def find(self, sub, offset=0):
+        i = self.buf.find(sub, self.start + offset, self.end)
+        return i if i == -1 else i - self.start
+
+    def take(self, size):
+        data = memoryview(self.buf)[self.start:self.start + size].tobytes()
+        self.start += size
+        return data
+
+    def skip(self, size):
+        self.start += size
+
+    # Makes room for at least `size` more bytes at the end, moving the
+    # pending data to the front before growing the buffer.
+    def reserve(self, size):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start and len(self.buf) - self.end < size and \
+                self.end - self.start + size <= len(self.buf) // 2:
+            pending = self.end - self.start
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+        if len(self.buf) - self.end < size:
+            self.buf.extend(bytearray(max(len(self.buf), size)))
+
+    def recv_into(self, s):
+        self.reserve(1)
+        n = s.recv_into(memoryview(self.buf)[self.end:])
+        self.end += n
+        return n
+
+    # Appends data read elsewhere: a str, bytearray or memoryview.
+    def feed(self, data):
+        n = len(data)
+        self.reserve(n)
+        self.buf[self.end:self.end + n] = data
+        self.end += n
+
+
+_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Non-blocking socket with a receive buffer. Only one read may be
+# pending at a time, the socket is polled for reading only while there
+# is one. If `timeout` is set, a connect, read or write making no
+# progress for that long fails with `TimeoutError` and closes the
+# stream.
+class IOStream(object):
+    def __init__(self, sock, loop=None, timeout=None):
+        sock.setblocking(False)
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.loop = loop or IOLoop.instance()
+        self.timeout = timeout
+        self.buf = ReceiveBuffer(4096)
+        self.closed = False
+        self.eof = False
+        self.error = None
+        self.close_callback = None
+
+        self.connect_future = None
+        self.read_kind = self.read_arg = self.read_future = None
+        self.read_scanned = 0
+        self.wbuf = collections.deque()
+        self.wbuf_offset = 0
+        self.written = self.queued = 0
+        self.received = 0
+        self.write_futures = collections.deque()
+
+        self.events = 0
+        self.registered = True
+        self.deadline = None
+        self.timer = None
+        self.loop.add_handler(self.fd, self._handle_events, 0)
+
+    def set_close_callback(self, callback):
+        self.close_callback = callback
+
+    # Replaces the timeout, counting from now. The timer of the previous
+    # one is dropped, a pooled connection would be closed by it.
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+        if self.timer:
+            self.loop.remove_timeout(self.timer)
+            self.timer = None
+        self.deadline = None
+        self._progress()
+        if not self.closed:
+            self._update()
+
+    def connect(self, address):
+        future = self.connect_future = Future()
+        self._progress()
+        err = self.socket.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._close(socket.error(err, os.strerror(err)))
+        else:
+            self._update()
+        return future
+
+    def write(self, data):
+        future = Future()
+        if self.closed:
+            future.set_exception(self._closed_error())
+            return future
+        if not self.wbuf:
+            self._progress()
+        if data:
+            self.wbuf.append(data)
+            self.queued += len(data)
+        self.write_futures.append((self.queued, future))
+        if not self.connect_future:
+            self._handle_write()
+        if not self.closed:
+            self._update()
+        return future
+
+    def read_until(self, delimiter):
+        return self._start_read('until', delimiter)
+
+    def read_bytes(self, size):
+        return self._start_read('bytes', size)
+
+    def read_some(self):
+        return self._start_read('some', None)
+
+    def read_until_close(self):
+        return self._start_read('close', None)
+
+    # Resolves to None once there is data to read, without taking it.
+    def wait_for_data(self):
+        return self._start_read('data', None)
+
+    # Drops the pending read without resolving it, whatever was read
+    # stays in the buffer for the next one.
+    def cancel_read(self):
+        self.read_kind = self.read_arg = self.read_future = None
+        if not self.closed:
+            self._update()
+
+    def close(self):
+        self._close(None)
+
+    def _closed_error(self):
+        return self.error or StreamClosedError('Stream is closed')
+
+    def _start_read(self, kind, arg):
+        assert self.read_future is None, "Already reading"
+        future = Future()
+        self.read_kind, self.read_arg, self.read_future = kind, arg, future
+        self.read_scanned = 0
+        self._progress()
+        if not self._try_read():
+            if self.closed:
+                self._finish_read(exc=self._closed_error())
+            else:
+                self._update()
+        return future
+
+    def _try_read(self):
+        kind, buf = self.read_kind, self.buf
+        if kind == 'until':
+            delimiter = self.read_arg
+            i = buf.find(delimiter, self.read_scanned)
+            if i != -1:
+                return self._finish_read(buf.take(i + len(delimiter)))
+            self.read_scanned = max(0, len(buf) - len(delimiter) + 1)
+        elif kind == 'bytes':
+            if len(buf) >= self.read_arg:
+                return self._finish_read(buf.take(self.read_arg))
+        elif kind == 'some':
+            if len(buf) or self.eof:
+                return self._finish_read(buf.take(len(buf)))
+        elif kind == 'close':
+            if self.eof:
+                return self._finish_read(buf.take(len(buf)))
+        elif kind == 'data':
+            if len(buf):
+                return self._finish_read(None)
+        if self.eof:
+            return self._finish_read(exc=self._closed_error())
+        return False
+
+    def _finish_read(self, data=None, exc=None):
+        future = self.read_future
+        self.read_kind = self.read_arg = self.read_future = None
+        if not self.closed:
+            self._update()
+        if exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(data)
+        return True
+
+    def _handle_events(self, fd, events):
+        if events & IOLoop.WRITE or (events & IOLoop.ERROR and self.connect_future):
+            if self.connect_future:
+                self._handle_connect()
+            else:
+                self._handle_write()
+        if self.closed:
+            return
+        if events & (IOLoop.READ | IOLoop.ERROR):
+            # Without a pending read, the socket is polled only for
+            # errors and hang ups. Whatever is left is read in full.
+            self._handle_read(drain=bool(events & IOLoop.ERROR
+                                         or not self.read_future))
+        if not self.closed:
+            self._update()
+
+    def _handle_connect(self):
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._close(socket.error(err, os.strerror(err)))
+            return
+        future, self.connect_future = self.connect_future, None
+        self._progress()
+        future.set_result(self)
+        if self.wbuf:
+            self._handle_write()
+
+    def _handle_write(self):
+        while self.wbuf:
+            data = self.wbuf[0]
+            try:
+                if self.wbuf_offset:
+                    n = self.socket.send(memoryview(data)[self.wbuf_offset:])
+                else:
+                    n = self.socket.send(data)
+            except socket.error as e:
+                if e.args[0] in _WOULDBLOCK:
+                    break
+                self._close(e)
+                return
+            self._progress()
+            self.written += n
+            self.wbuf_offset += n
+            if self.wbuf_offset == len(data):
+                self.wbuf.popleft()
+                self.wbuf_offset = 0
+        while self.write_futures and self.write_futures[0][0] <= self.written:
+            self.write_futures.popleft()[1].set_result(None)
+
+    def _handle_read(self, drain=False):
+        try:
+            while not self.eof:
+                n = self.buf.recv_into(self.socket)
+                if n == 0:
+                    self.eof = True
+                    break
+                self.received += n
+                self._progress()
+                if not drain:
+                    break
+        except socket.error as e:
+            if e.args[0] not in _WOULDBLOCK:
+                self._close(e)
+                return
+        if self.read_future:
+            self._try_read()
+
+    def _update(self):
+        events = 0
+        if self.read_future and not self.eof:
+            events |= IOLoop.READ
+        if self.wbuf or self.connect_future:
+            events |= IOLoop.WRITE
+        if self.eof and not events:
+            # Nothing to wait for. A hung up socket would otherwise keep
+            # the poller busy.
+            if self.registered:
+                self.registered = False
+                self.loop.remove_handler(self.fd)
+        elif not self.registered:
+            self.registered = True
+            self.loop.add_handler(self.fd, self._handle_events, events)
+        elif events != self.events:
+            self.loop.update_handler(self.fd, events)
+        self.events = events
+        if self.timeout and events and self.timer is None:
+            self.timer = self.loop.call_at(self.deadline, self._check_timeout)
+
+    def _progress(self):
+        if self.timeout:
+            self.deadline = self.loop.time() + self.timeout
+
+    def _check_timeout(self):
+        self.timer = None
+        if self.closed or not self.events:
+            return
+        if self.loop.time() >= self.deadline:
+            self._close(TimeoutError('timed out'))
+        else:
+            self.timer = self.loop.call_at(self.deadline, self._check_timeout)
+
+    def _close(self, error):
+        if self.closed:
+            return
+        self.closed = True
+        self.error = error
+        self.loop.remove_handler(self.fd)
+        if self.timer:
+            self.loop.remove_timeout(self.timer)
+            self.timer = None
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+        exc = self._closed_error()
+        if self.connect_future:
+            future, self.connect_future = self.connect_future, None
+            future.set_exception(exc)
+        if self.read_future:
+            if not error and self.read_kind in ('some', 'close'):
+                self._finish_read(self.buf.take(len(self.buf)))
+            else:
+                self._finish_read(exc=exc)
+        while self.write_futures:
+            self.write_futures.popleft()[1].set_exception(exc)
+        if self.close_callback:
+            callback, self.close_callback = self.close_callback, None
+            _run_callback(callback)
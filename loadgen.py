@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# Load generator
+# ==============
+#
+# Python version of `smoke-test.coffee`, for every transport. Opens
+# `--clients` sessions to the echo service and has each of them send
+# `--hz` messages a second for `--seconds`. Every message carries its
+# send time, the round trip is measured when the echo comes back:
+#
+#     ./venv/bin/python loadgen.py -t websocket -c 500 --hz 1 -s 20
+#
+# With `--hz 0` a client sends the next message as soon as the
+# previous one is echoed, which is what drives a server to
+# saturation.
+#
+# Waiting for the echo means a stalled server also stalls the
+# clients, and the latency measured hides the time messages would
+# have been queued for. With `--open-loop` every client sends `--hz`
+# messages a second on a fixed schedule, whatever comes back, and the
+# latency is taken from the time the message was meant to be sent.
+#
+# With `--timings` the http requests made while the load runs are
+# broken down into connect, send, wait (for the server), headers and
+# transfer times, to tell where a slow server spends them.
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import traceback
+import asyncclient
+import client
+import harness
+from histogram import Histogram
+from ioloop import IOLoop, Future, TimeoutError, gather
+
+
+test_top_url = os.environ.get('SOCKJS_URL', 'http://localhost:8081')
+
+
+class Stats(object):
+    def __init__(self):
+        self.latency = Histogram()
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.started = None
+        self.finished = None
+        self.phases = {}
+
+    def elapsed(self):
+        return (self.finished or 0) - (self.started or 0)
+
+    def add(self, other):
+        self.latency.add(other.latency)
+        self.sent += other.sent
+        self.received += other.received
+        self.errors += other.errors
+        started = filter(None, [self.started, other.started])
+        self.started = min(started) if started else None
+        self.finished = max(self.finished, other.finished)
+        for name, h in other.phases.items():
+            self.phase(name).add(h)
+
+    def phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = Histogram()
+        return self.phases[name]
+
+    # An `asyncclient.timing_hooks` hook.
+    def record_timings(self, timings):
+        for name, seconds in timings.phases().items():
+            self.phase(name).record(int(seconds * 1000000))
+
+
+# A single client: sends a message, waits for the echo, waits
+# `1/hz` seconds, sends the next one. Stops sending at `deadline`.
+class Session(object):
+    def __init__(self, conn, options, stats, loop):
+        self.conn = conn
+        self.options = options
+        self.stats = stats
+        self.loop = loop
+        self.padding = 'x' * options.size
+        self.deadline = None
+        self.opened = Future()
+        self.finished = Future()
+        conn.on_open = self.on_open
+        conn.on_message = self.on_message
+        conn.on_close = self.on_close
+
+    def start(self, deadline):
+        self.deadline = deadline
+        self.send()
+
+    def send(self):
+        if self.loop.time() >= self.deadline:
+            self.finish()
+            return
+        self.send_stamped(self.loop.time())
+
+    def send_stamped(self, t):
+        self.stats.sent += 1
+        self.conn.send('%.6f %s' % (t, self.padding))
+
+    def on_open(self):
+        if not self.opened.done():
+            self.opened.set_result(True)
+
+    def on_message(self, msg):
+        self.got_echo(msg)
+        if self.options.hz:
+            self.loop.call_later(1.0 / self.options.hz, self.send)
+        else:
+            self.send()
+
+    def got_echo(self, msg):
+        t0 = float(msg.split(' ', 1)[0])
+        self.stats.received += 1
+        self.stats.latency.record((self.loop.time() - t0) * 1000000)
+
+    def on_close(self, code, reason):
+        self.stats.errors += 1
+        print >> sys.stderr, 'ERROR', code, reason
+        if not self.opened.done():
+            self.opened.set_result(False)
+        self.finish()
+
+    def finish(self):
+        if not self.finished.done():
+            self.conn.close()
+            self.finished.set_result(None)
+
+
+# Open loop client: messages are sent every `1/hz` seconds, starting
+# at a random offset so that clients don't send all at once. If the
+# loop falls behind, the messages that are due are sent together,
+# each stamped with the time it was due.
+class OpenLoopSession(Session):
+    def __init__(self, *args, **kwargs):
+        super(OpenLoopSession, self).__init__(*args, **kwargs)
+        self.interval = 1.0 / self.options.hz
+        self.outstanding = 0
+        self.sending = False
+
+    def start(self, deadline):
+        self.deadline = deadline
+        self.sending = True
+        self.next = self.loop.time() + random.random() * self.interval
+        self.loop.call_at(self.next, self.tick)
+
+    def tick(self):
+        if self.finished.done():
+            return
+        now = self.loop.time()
+        while self.next <= now and self.next < self.deadline:
+            self.outstanding += 1
+            self.send_stamped(self.next)
+            self.next += self.interval
+        if self.next < self.deadline:
+            self.loop.call_at(self.next, self.tick)
+        else:
+            self.sending = False
+            if not self.outstanding:
+                self.finish()
+
+    def on_message(self, msg):
+        self.got_echo(msg)
+        self.outstanding -= 1
+        if not self.sending and not self.outstanding:
+            self.finish()
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def connect(options, clients, loop):
+    # Every client keeps a receiving and a sending connection.
+    asyncclient.pool.max_idle = max(asyncclient.pool.max_idle, 2 * clients)
+    stats = Stats()
+    sessions = []
+    session_class = OpenLoopSession if options.open_loop else Session
+    for i in range(clients):
+        conn = client.CLIENTS[options.transport](options.url)
+        sessions.append(session_class(conn, options, stats, loop))
+        conn.start()
+    try:
+        loop.run_sync(gather([s.opened for s in sessions]),
+                      timeout=options.connect_timeout)
+    except TimeoutError:
+        print >> sys.stderr, 'ERROR timed out connecting'
+    for s in sessions:
+        if not s.opened.done():
+            s.on_close(1006, 'Connect timeout')
+    return stats, sessions
+
+def drive(options, stats, sessions, loop):
+    if options.timings:
+        asyncclient.timing_hooks.append(stats.record_timings)
+    stats.started = loop.time()
+    deadline = stats.started + options.seconds
+    for s in sessions:
+        if s.opened.result():
+            s.start(deadline)
+        else:
+            s.finish()
+    # Wait for the last echos, but not forever.
+    try:
+        loop.run_sync(gather([s.finished for s in sessions]),
+                      timeout=options.seconds + options.connect_timeout)
+    except TimeoutError:
+        print >> sys.stderr, 'ERROR timed out waiting for the last echos'
+    finally:
+        if options.timings:
+            asyncclient.timing_hooks.remove(stats.record_timings)
+    stats.finished = loop.time()
+    return stats
+
+def run(options, loop=None):
+    loop = loop or IOLoop.instance()
+    stats, sessions = connect(options, options.clients, loop)
+    print ' [*] All connected. Starting'
+    return drive(options, stats, sessions, loop)
+
+
+# Worker processes
+# ----------------
+#
+# One process can only use one core. With `--workers` the sessions are
+# split between forked processes, each with its own loop. The
+# coordinator waits for all of them to be connected, starts them at
+# once and merges the stats they send back over a pipe.
+def readable(pipe, loop):
+    future = Future()
+    def ready(fd, events):
+        loop.remove_handler(fd)
+        future.set_result(None)
+    loop.add_handler(pipe.fileno(), ready, IOLoop.READ)
+    return future
+
+def worker(options, clients, pipe):
+    try:
+        loop = IOLoop.instance()
+        stats, sessions = connect(options, clients, loop)
+        pipe.send(('connected', None))
+        # Keep the sessions going while waiting for the others.
+        loop.run_sync(readable(pipe, loop))
+        pipe.recv()
+        pipe.send(('done', drive(options, stats, sessions, loop)))
+    except Exception:
+        pipe.send(('error', traceback.format_exc()))
+    finally:
+        pipe.close()
+
+def run_workers(options):
+    procs, pipes = [], []
+    for i in range(options.workers):
+        clients = options.clients // options.workers + \
+            (i < options.clients % options.workers)
+        parent, child = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=worker,
+                                    args=(options, clients, child))
+        p.start()
+        child.close()
+        procs.append(p)
+        pipes.append(parent)
+
+    def collect(expected):
+        results = []
+        for pipe in pipes:
+            try:
+                kind, value = pipe.recv()
+            except EOFError:
+                kind, value = 'error', 'worker died'
+            if kind == 'error':
+                raise Exception('Worker failed:\n' + value)
+            assert kind == expected, kind
+            results.append(value)
+        return results
+
+    try:
+        collect('connected')
+        print ' [*] All connected. Starting'
+        for pipe in pipes:
+            pipe.send(('start', None))
+        stats = Stats()
+        for s in collect('done'):
+            stats.add(s)
+        return stats
+    except:
+        # The others would wait for a start that never comes.
+        for p in procs:
+            p.terminate()
+        raise
+    finally:
+        for pipe in pipes:
+            pipe.close()
+        for p in procs:
+            p.join()
+
+
+# Latencies are recorded in microseconds, and reported in
+# milliseconds.
+def report(stats, options):
+    elapsed = stats.elapsed()
+    print ' [*] Done. %d messages sent, %d received in %.1fs (%.1f msg/s), %d errors' % (
+        stats.sent, stats.received, elapsed,
+        stats.received / elapsed if elapsed else 0, stats.errors)
+    h = stats.latency
+    if not h.count:
+        return
+    print '     latency avg=%.3fms dev=%.3fms (%d data points)' % (
+        h.mean() / 1000, h.stddev() / 1000, h.count)
+    print '     ' + ' '.join('p%s=%.3fms' % (p, h.percentile(p) / 1000.0)
+                             for p in (50, 90, 99, 99.9, 99.99)) + \
+        ' max=%.3fms' % (h.max / 1000.0,)
+    if options.buckets:
+        print
+        print '%12s %12s %10s %9s' % ('From (ms)', 'To (ms)', 'Count', 'Cumul %')
+        seen = 0
+        for low, high, count in h.buckets():
+            seen += count
+            print '%12.3f %12.3f %10d %9.4f' % (
+                low / 1000.0, (high + 1) / 1000.0, count, 100.0 * seen / h.count)
+    if options.hgrm:
+        with open(options.hgrm, 'w') as f:
+            h.write_percentiles(f, scale=1000.0)
+    if stats.phases:
+        print '     http requests (%d):' % (stats.phases['wait'].count,)
+        for name in ('connect', 'send', 'wait', 'headers', 'transfer'):
+            h = stats.phases[name]
+            print '     %-9s avg=%.3fms p50=%.3fms p99=%.3fms max=%.3fms' % (
+                name, h.mean() / 1000, h.percentile(50) / 1000.0,
+                h.percentile(99) / 1000.0, h.max / 1000.0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SockJS load generator.')
+    parser.add_argument('url', nargs='?', default=test_top_url + '/echo',
+                        help='base url of the echo service')
+    parser.add_argument('-t', '--transport', default='xhr',
+                        choices=sorted(client.CLIENTS))
+    parser.add_argument('-c', '--clients', type=int, default=500)
+    parser.add_argument('--hz', type=float, default=1,
+                        help='messages a second per client, 0 for no pause')
+    parser.add_argument('--open-loop', action='store_true',
+                        help='send on a fixed schedule, without waiting '
+                        'for the echos')
+    parser.add_argument('-s', '--seconds', type=float, default=20)
+    parser.add_argument('--size', type=int, default=0,
+                        help='bytes of padding added to every message')
+    parser.add_argument('--connect-timeout', type=float, default=10)
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='worker processes to split the clients between')
+    parser.add_argument('--buckets', action='store_true',
+                        help='print the latency histogram buckets')
+    parser.add_argument('--hgrm', metavar='FILE',
+                        help='write the latency percentile distribution, '
+                        'in HdrHistogram format')
+    parser.add_argument('--timings', action='store_true',
+                        help='break the http requests down into connect, '
+                        'send, wait, headers and transfer times')
+    parser.add_argument('--check-harness', action='store_true',
+                        help='time the http clients against a local '
+                        'server first, to see what latency they add')
+    options = parser.parse_args(argv)
+    if options.open_loop and options.hz <= 0:
+        parser.error('--open-loop needs a positive --hz')
+
+    raise_fd_limit()
+    if options.check_harness:
+        harness.report(harness.check())
+    print ' [*] Connecting to %s (transport:%s, count:%d, hz:%g, seconds:%g%s)' % (
+        options.url, options.transport, options.clients, options.hz,
+        options.seconds, ', open loop' if options.open_loop else '')
+    if options.workers > 1:
+        stats = run_workers(options)
+    else:
+        stats = run(options)
+    report(stats, options)
+    return 1 if stats.errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,317 @@
+# RFC 6455 frames
+# ===============
+#
+# Encoding and decoding of websocket frames, for the clients and the
+# reference server alike. Data is fed to a `Decoder` as it comes off the
+# socket and comes out as whole messages, fragmented ones put back
+# together, with control frames passed on as soon as they arrive:
+#
+#     decoder = rfc6455.Decoder()
+#     for opcode, payload in decoder.feed(data):
+#         ...
+#
+# Headers are parsed in place, from the decoder's buffer, and payloads
+# are copied out of it once. Masking works on the whole payload at a
+# time: the bytes of each of the four lanes of the key are run through
+# `str.translate()` with a table xoring them with that key byte, tens
+# of times faster than xoring byte by byte in python. That is still
+# done for short payloads, where setting up the lanes costs more.
+#
+# The `permessage-deflate` extension (RFC 7692) is supported on both
+# ends, see below.
+import os
+import struct
+import zlib
+from ioloop import ReceiveBuffer
+
+
+OP_CONTINUATION, OP_TEXT, OP_BINARY = 0x0, 0x1, 0x2
+OP_CLOSE, OP_PING, OP_PONG = 0x8, 0x9, 0xa
+
+CONTROL_OPCODES = (OP_CLOSE, OP_PING, OP_PONG)
+DATA_OPCODES = (OP_TEXT, OP_BINARY)
+
+# The reserved bit of `permessage-deflate`, as `parse_header()` gives it.
+RSV1 = 0x4
+
+class ProtocolError(Exception): pass
+
+
+# `TABLES[k]` maps every byte to itself xored with `k`.
+TABLES = [''.join(chr(i ^ k) for i in xrange(256)) for k in xrange(256)]
+
+SHORT_PAYLOAD = 64
+
+def mask(key, data):
+    if len(data) < SHORT_PAYLOAD:
+        key = bytearray(key)
+        data = bytearray(data)
+        for i in xrange(len(data)):
+            data[i] ^= key[i & 3]
+        return bytes(data)
+    if not isinstance(data, str):
+        data = bytes(data)
+    out = bytearray(data)
+    for i in xrange(4):
+        out[i::4] = data[i::4].translate(TABLES[ord(key[i])])
+    return bytes(out)
+
+
+# Frames from the client are masked, frames from the server aren't.
+def encode_frame(opcode, data, masked=True, fin=True, rsv=0):
+    n = len(data)
+    b1 = (0x80 if fin else 0) | rsv << 4 | opcode
+    b2 = 0x80 if masked else 0
+    if n < 126:
+        header = struct.pack('!BB', b1, b2 | n)
+    elif n < 65536:
+        header = struct.pack('!BBH', b1, b2 | 126, n)
+    else:
+        header = struct.pack('!BBQ', b1, b2 | 127, n)
+    if not masked:
+        return header + data
+    key = os.urandom(4)
+    return header + key + mask(key, data)
+
+# A data message as frames of at most `fragment_size` bytes of payload,
+# or a single frame without it. Compressed first, given a `Deflate`.
+def encode_message(opcode, data, masked=True, fragment_size=None,
+                   deflate=None):
+    rsv = 0
+    if deflate:
+        data, rsv = deflate.compress(data), RSV1
+    if not fragment_size or len(data) <= fragment_size:
+        return encode_frame(opcode, data, masked, rsv=rsv)
+    frames = []
+    for pos in xrange(0, len(data), fragment_size):
+        first = pos == 0
+        frames.append(encode_frame(
+            opcode if first else OP_CONTINUATION,
+            data[pos:pos + fragment_size], masked,
+            fin=pos + fragment_size >= len(data), rsv=rsv if first else 0))
+    return ''.join(frames)
+
+
+# `(fin, rsv, opcode, key, length, header_size)` of the frame at
+# `offset` in `buf`, or None if its header isn't all there yet.
+def parse_header(buf, offset, end):
+    if end - offset < 2:
+        return None
+    b1, b2 = struct.unpack_from('!BB', buf, offset)
+    length, size = b2 & 0x7f, 2
+    if length == 126:
+        if end - offset < 4:
+            return None
+        length = struct.unpack_from('!H', buf, offset + 2)[0]
+        size = 4
+    elif length == 127:
+        if end - offset < 10:
+            return None
+        length = struct.unpack_from('!Q', buf, offset + 2)[0]
+        size = 10
+    key = None
+    if b2 & 0x80:
+        if end - offset < size + 4:
+            return None
+        key = bytes(buf[offset + size:offset + size + 4])
+        size += 4
+    return (bool(b1 & 0x80), (b1 >> 4) & 0x7, b1 & 0x0f, key, length, size)
+
+
+# Given a `Deflate`, messages flagged with RSV1 are decompressed.
+class Decoder(object):
+    def __init__(self, deflate=None):
+        self.buf = ReceiveBuffer(4096)
+        self.deflate = deflate
+        self.fragments = []
+        self.message_opcode = None
+        self.compressed = False
+
+    # Returns the messages completed by `data`, as `(opcode, payload)`.
+    def feed(self, data):
+        self.buf.feed(data)
+        messages = []
+        while True:
+            message = self.next()
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def next(self):
+        while True:
+            buf = self.buf
+            header = parse_header(buf.buf, buf.start, buf.end)
+            if header is None:
+                return None
+            fin, rsv, opcode, key, length, size = header
+            if len(buf) < size + length:
+                # Room for the rest of the frame, in one go.
+                buf.reserve(size + length - len(buf))
+                return None
+            buf.skip(size)
+            payload = buf.take(length)
+            if key:
+                payload = mask(key, payload)
+            message = self.frame(fin, rsv, opcode, payload)
+            if message is not None:
+                return message
+
+    def frame(self, fin, rsv, opcode, payload):
+        if rsv and not (rsv == RSV1 and self.deflate and
+                        opcode in DATA_OPCODES):
+            raise ProtocolError('Unexpected reserved bits %d' % (rsv,))
+        if opcode in CONTROL_OPCODES:
+            if not fin or len(payload) > 125:
+                raise ProtocolError('Bad control frame %d' % (opcode,))
+            return opcode, payload
+        if opcode == OP_CONTINUATION:
+            if self.message_opcode is None:
+                raise ProtocolError('Continuation outside of a message')
+        elif opcode in DATA_OPCODES:
+            if self.message_opcode is not None:
+                raise ProtocolError('New message inside a fragmented one')
+            self.message_opcode = opcode
+            self.compressed = bool(rsv)
+        else:
+            raise ProtocolError('Unknown opcode %d' % (opcode,))
+        self.fragments.append(payload)
+        if not fin:
+            return None
+        opcode, data = self.message_opcode, ''.join(self.fragments)
+        self.fragments, self.message_opcode = [], None
+        if self.compressed:
+            try:
+                data = self.deflate.decompress(data)
+            except zlib.error as e:
+                raise ProtocolError('Bad compressed message: %s' % (e,))
+        return opcode, data
+
+
+# permessage-deflate
+# ------------------
+#
+# A message is compressed whole, as raw deflate data ending with an
+# empty stored block, whose `00 00 ff ff` tail isn't sent. With context
+# takeover the window is kept from one message to the next, otherwise
+# every message is compressed on its own.
+#
+# The parameters are kept as they appear in `Sec-WebSocket-Extensions`:
+# a dict of `server_no_context_takeover`, `client_no_context_takeover`,
+# `server_max_window_bits` and `client_max_window_bits`, with None for
+# the value of the flags. The client offers them with
+# `format_extension()` and checks the answer with `accept_deflate()`,
+# the server picks an offer with `negotiate_deflate()`.
+DEFLATE = 'permessage-deflate'
+DEFLATE_PARAMS = ('server_no_context_takeover', 'client_no_context_takeover',
+                  'server_max_window_bits', 'client_max_window_bits')
+DEFLATE_TAIL = '\x00\x00\xff\xff'
+
+class NegotiationError(ProtocolError): pass
+
+
+# `name; flag; param=value, other` as `[(name, params), ...]`.
+def parse_extensions(header):
+    extensions = []
+    for item in header.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            name, eq, value = part.partition('=')
+            params[name.strip().lower()] = \
+                value.strip().strip('"') if eq else None
+        extensions.append((parts[0].lower(), params))
+    return extensions
+
+def format_extension(name, params):
+    return '; '.join([name] + [k if v is None else '%s=%s' % (k, v)
+                               for k, v in sorted(params.items())])
+
+
+# zlib can't compress with a window of 256 bytes, only decompress.
+def window_bits(value, minimum=8):
+    if value is None:
+        return 15
+    if not value.isdigit() or not minimum <= int(value) <= 15:
+        raise NegotiationError('Bad window bits %r' % (value,))
+    return int(value)
+
+def check_deflate_params(params):
+    for name, value in params.items():
+        if name not in DEFLATE_PARAMS:
+            raise NegotiationError('Unknown parameter %r' % (name,))
+        if name.endswith('_no_context_takeover') and value is not None:
+            raise NegotiationError('%s takes no value' % (name,))
+        if name == 'server_max_window_bits' and value is None:
+            raise NegotiationError('%s takes a value' % (name,))
+
+# The client side: the parameters the server answered `offer` with, or
+# NegotiationError if they don't fit it.
+def accept_deflate(offer, params):
+    check_deflate_params(params)
+    if 'server_no_context_takeover' in offer and \
+            'server_no_context_takeover' not in params:
+        raise NegotiationError('server_no_context_takeover ignored')
+    if 'server_max_window_bits' in offer:
+        if window_bits(params.get('server_max_window_bits')) > \
+                window_bits(offer['server_max_window_bits']):
+            raise NegotiationError('server_max_window_bits ignored')
+    if 'client_max_window_bits' in params:
+        if 'client_max_window_bits' not in offer:
+            raise NegotiationError('client_max_window_bits not offered')
+        # Only the offer may leave the value out.
+        window_bits(params['client_max_window_bits'] or '', minimum=9)
+    return params
+
+# The server side: the parameters to answer the first acceptable offer
+# with, or None to decline them all. The client is held to what it
+# offered, and nothing more.
+def negotiate_deflate(offers):
+    for name, offer in offers:
+        if name != DEFLATE:
+            continue
+        try:
+            check_deflate_params(offer)
+            window_bits(offer.get('server_max_window_bits'), minimum=9)
+            if offer.get('client_max_window_bits') is not None:
+                window_bits(offer['client_max_window_bits'])
+        except NegotiationError:
+            continue
+        return dict((k, v) for k, v in offer.items()
+                    if k != 'client_max_window_bits' or v is not None)
+    return None
+
+
+# The compressor and decompressor of one end of a connection.
+class Deflate(object):
+    def __init__(self, params, client=True, level=zlib.Z_DEFAULT_COMPRESSION):
+        local, remote = ('client', 'server')[::1 if client else -1]
+        self.params = params
+        self.level = level
+        self.compress_takeover = \
+            local + '_no_context_takeover' not in params
+        self.decompress_takeover = \
+            remote + '_no_context_takeover' not in params
+        self.compress_bits = window_bits(
+            params.get(local + '_max_window_bits'), minimum=9)
+        self.compressor = self.decompressor = None
+
+    def compress(self, data):
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                               -self.compress_bits)
+        data = self.compressor.compress(data) + \
+            self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if not self.compress_takeover:
+            self.compressor = None
+        return data[:-len(DEFLATE_TAIL)]
+
+    # Whatever window the other end uses, 15 bits is enough.
+    def decompress(self, data):
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(-15)
+        data = self.decompressor.decompress(data + DEFLATE_TAIL)
+        if not self.decompress_takeover:
+            self.decompressor = None
+        return data
@@ -0,0 +1,256 @@
+# Parallel test runner
+# ====================
+#
+# Running the protocol suite is mostly waiting on sockets. As nearly
+# every test builds its own random session, test classes can be spread
+# across a pool of worker processes and their results merged into a
+# single report:
+#
+#     ./venv/bin/python sockjs-protocol.py -j 8
+#
+# Tests relying on timing (or otherwise unhappy to share the server
+# with other tests) can be marked with the `serial` decorator. They
+# are run in the main process, after the pool is done.
+#
+# With `--server` the tests run against the reference server from
+# `server.py`, started in a thread on an ephemeral port.
+import atexit
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import unittest2 as unittest
+
+
+def serial(obj):
+    obj._serial = True
+    return obj
+
+def is_serial(test):
+    method = getattr(test, test._testMethodName, None)
+    return getattr(type(test), '_serial', False) or \
+        getattr(method, '_serial', False)
+
+def iter_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in iter_tests(test):
+                yield t
+        else:
+            yield test
+
+# What unittest reports outside of a test, a failing `setUpClass` say,
+# has no method and goes by its id.
+def test_name(test):
+    method = getattr(test, '_testMethodName', None)
+    if method is None:
+        return test.id()
+    return '%s.%s' % (type(test).__name__, method)
+
+# Stands for a record of the workers that isn't a test of the suite.
+class RecordedName(object):
+    def __init__(self, name):
+        self.name = name
+
+    def id(self):
+        return self.name
+
+    def shortDescription(self):
+        return None
+
+    def __str__(self):
+        return self.name
+
+
+# Results are recorded as plain tuples `(name, outcome, details)`, so
+# they can be sent back from the worker processes.
+class RecordingResult(unittest.TestResult):
+    def __init__(self):
+        super(RecordingResult, self).__init__()
+        self.records = []
+
+    def record(self, test, outcome, details=''):
+        self.records.append((test_name(test), outcome, details))
+
+    def format_err(self, test, err):
+        return ''.join(traceback.format_exception(*err))
+
+    def addSuccess(self, test):
+        self.record(test, 'ok')
+
+    def addFailure(self, test, err):
+        self.record(test, 'FAIL', self.format_err(test, err))
+
+    def addError(self, test, err):
+        self.record(test, 'ERROR', self.format_err(test, err))
+
+    def addSkip(self, test, reason):
+        self.record(test, 'skip', reason)
+
+    def addExpectedFailure(self, test, err):
+        self.record(test, 'expected failure')
+
+    def addUnexpectedSuccess(self, test):
+        self.record(test, 'unexpected success')
+
+
+def run_names(module, names):
+    suite = unittest.defaultTestLoader.loadTestsFromNames(names, module)
+    result = RecordingResult()
+    suite(result)
+    return result.records
+
+# Worker processes are forked, so they inherit the test module.
+_module = None
+
+def _run_group(names):
+    try:
+        return run_names(_module, names)
+    except Exception:
+        details = traceback.format_exc()
+        return [(name, 'ERROR', details) for name in names]
+
+
+# The merged report looks like the one from `unittest.main()`.
+class MergedResult(unittest.TextTestResult):
+    def add_record(self, test, outcome, details):
+        # Like unittest, only count the tests themselves.
+        counted = not isinstance(test, RecordedName)
+        if counted:
+            self.startTest(test)
+        if outcome == 'ok':
+            self.addSuccess(test)
+        elif outcome in ('FAIL', 'ERROR'):
+            self.add_error_text(test, outcome, details)
+        elif outcome == 'skip':
+            self.addSkip(test, details)
+        elif outcome == 'expected failure':
+            self.expectedFailures.append((test, details))
+            self.report(outcome, 'x')
+        else:
+            self.unexpectedSuccesses.append(test)
+            self.report(outcome, 'u')
+        if counted:
+            self.stopTest(test)
+
+    def add_error_text(self, test, outcome, details):
+        if outcome == 'FAIL':
+            self.failures.append((test, details))
+        else:
+            self.errors.append((test, details))
+        self.report(outcome, outcome[0])
+
+    def report(self, long, short):
+        if self.showAll:
+            self.stream.writeln(long)
+        elif self.dots:
+            self.stream.write(short)
+            self.stream.flush()
+
+
+def run_parallel(module, suite, jobs, verbosity=1, stream=sys.stderr):
+    global _module
+    _module = module
+    tests = dict((test_name(t), t) for t in iter_tests(suite))
+    groups, serial_names = {}, []
+    for name in sorted(tests):
+        if is_serial(tests[name]):
+            serial_names.append(name)
+        else:
+            groups.setdefault(type(tests[name]).__name__, []).append(name)
+
+    result = MergedResult(unittest.runner._WritelnDecorator(stream),
+                          True, verbosity)
+    def merge(records):
+        for name, outcome, details in records:
+            test = tests.get(name) or RecordedName(name)
+            result.add_record(test, outcome, details)
+
+    t0 = time.time()
+    pool = multiprocessing.Pool(min(jobs, len(groups)) or 1)
+    try:
+        for records in pool.imap_unordered(_run_group, groups.values()):
+            merge(records)
+    finally:
+        pool.close()
+        pool.join()
+    if serial_names:
+        merge(_run_group(serial_names))
+    elapsed = time.time() - t0
+
+    result.printErrors()
+    result.stream.writeln(result.separator2)
+    run = result.testsRun
+    result.stream.writeln("Ran %d test%s in %.3fs" %
+                          (run, run != 1 and "s" or "", elapsed))
+    result.stream.writeln()
+    infos = []
+    for label, items in [('failures', result.failures),
+                         ('errors', result.errors),
+                         ('skipped', result.skipped),
+                         ('expected failures', result.expectedFailures),
+                         ('unexpected successes', result.unexpectedSuccesses)]:
+        if items:
+            infos.append('%s=%d' % (label, len(items)))
+    status = 'OK' if result.wasSuccessful() else 'FAILED'
+    if infos:
+        status += ' (%s)' % (', '.join(infos),)
+    result.stream.writeln(status)
+    return result
+
+
+_server = None
+
+# Url of the server under test: the reference server when `--server`
+# is given, `SOCKJS_URL` otherwise.
+def test_top_url(default='http://localhost:8081'):
+    global _server
+    if '--server' in sys.argv:
+        if _server is None:
+            import server
+            _server = server.start(response_limit=4096)
+            atexit.register(_server.stop)
+            os.environ['SOCKJS_URL'] = _server.url
+        return _server.url
+    return os.environ.get('SOCKJS_URL', default)
+
+
+# Drop-in replacement for `unittest.main()`. Without `-j` (or with
+# `-j 1`) the tests are run sequentially by unittest itself.
+def main(module='__main__', argv=None):
+    if isinstance(module, basestring):
+        module = sys.modules[module]
+    argv = list(sys.argv if argv is None else argv)
+    jobs, rest = 1, [argv[0]]
+    args = iter(argv[1:])
+    for arg in args:
+        if arg in ('-j', '--jobs'):
+            jobs = int(next(args))
+        elif arg.startswith('--jobs='):
+            jobs = int(arg.split('=', 1)[1])
+        elif arg.startswith('-j') and arg[2:].isdigit():
+            jobs = int(arg[2:])
+        elif arg == '--server':
+            continue
+        else:
+            rest.append(arg)
+    if jobs <= 1:
+        return unittest.main(module=module, argv=rest)
+
+    verbosity = 1
+    names = []
+    for arg in rest[1:]:
+        if arg in ('-v', '--verbose'):
+            verbosity = 2
+        elif arg in ('-q', '--quiet'):
+            verbosity = 0
+        else:
+            names.append(arg)
+    loader = unittest.defaultTestLoader
+    if names:
+        suite = loader.loadTestsFromNames(names, module)
+    else:
+        suite = loader.loadTestsFromModule(module)
+    result = run_parallel(module, suite, jobs, verbosity)
+    sys.exit(not result.wasSuccessful())
@@ -0,0 +1,1018 @@
+#!/usr/bin/env python
+# Reference server
+# ================
+#
+# A small SockJS server on the event loop, with only the services the
+# protocol suite needs: `echo`, `close`, `disabled_websocket_echo` and
+# `cookie_needed_echo`, over every transport. It makes the suite
+# runnable without setting up a server, and gives the load tools a
+# server that costs next to nothing, to see where the harness itself
+# tops out:
+#
+#     ./venv/bin/python server.py --port 8081
+#
+# `sockjs-protocol.py --server` starts one in a thread, on an
+# ephemeral port.
+import argparse
+import base64
+import collections
+import Cookie
+import email.utils
+import errno
+import hashlib
+import httplib
+import json
+import os
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+import urlparse
+import rfc6455
+from asyncclient import CaseInsensitiveDict, WS_GUID
+from rfc6455 import OP_TEXT, OP_CLOSE, OP_PING, OP_PONG
+from ioloop import IOLoop, IOStream, Future, coroutine, Return, StreamClosedError
+
+
+TEXT = 'text/plain; charset=UTF-8'
+JAVASCRIPT = 'application/javascript; charset=UTF-8'
+YEAR = 365 * 24 * 60 * 60
+
+SOCKJS_URL = 'https://cdn.jsdelivr.net/npm/sockjs-client@1/dist/sockjs.min.js'
+
+IFRAME = '''<!DOCTYPE html>
+<html>
+<head>
+  <meta http-equiv="X-UA-Compatible" content="IE=edge" />
+  <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />
+  <script src="%s"></script>
+  <script>
+    document.domain = document.domain;
+    SockJS.bootstrap_iframe();
+  </script>
+</head>
+<body>
+  <h2>Don't panic!</h2>
+  <p>This is a SockJS hidden iframe. It's used for cross domain magic.</p>
+</body>
+</html>'''
+
+HTMLFILE = '''<!doctype html>
+<html><head>
+  <meta http-equiv="X-UA-Compatible" content="IE=edge" />
+  <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />
+</head><body><h2>Don't panic!</h2>
+  <script>
+    document.domain = document.domain;
+    var c = parent.%s;
+    c.start();
+    function p(d) {c.message(d);};
+    window.onload = function() {c.stop();};
+  </script>'''
+
+
+def encode(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+def close_frame(code, reason):
+    return 'c' + encode([code, reason])
+
+def tokens(value):
+    return [t.strip().lower() for t in value.split(',')]
+
+
+# Http
+# ----
+class HttpError(Exception):
+    def __init__(self, status, body=''):
+        super(HttpError, self).__init__(status, body)
+        self.status = status
+        self.body = body
+
+
+class Request(object):
+    def __init__(self, method, uri, version, headers, body):
+        self.method = method
+        self.uri = uri
+        self.version = version
+        self.headers = headers
+        self.body = body
+        u = urlparse.urlsplit(uri)
+        self.path = u.path
+        self.query = urlparse.parse_qs(u.query, keep_blank_values=True)
+
+    def arg(self, name):
+        values = self.query.get(name)
+        return values[0] if values else None
+
+
+# A response is either sent at once with `send()`, or streamed with
+# `start()`, `write()` and `finish()`: chunked for HTTP/1.1, and
+# delimited by closing the connection for HTTP/1.0.
+class Response(object):
+    def __init__(self, stream, request):
+        self.stream = stream
+        self.request = request
+        self.headers = []
+        self.chunked = False
+        self.upgraded = False
+        self.watching = False
+        self.finished = Future()
+        connection = tokens(request.headers.get('Connection', ''))
+        if request.version == 'HTTP/1.1':
+            self.keep_alive = 'close' not in connection
+        else:
+            self.keep_alive = 'keep-alive' in connection
+
+    def set_header(self, name, value):
+        self.headers.append((name, value))
+
+    def head(self, status, extra=(), reason=None):
+        lines = ['HTTP/1.1 %d %s' % (status,
+                                     reason or httplib.responses[status])]
+        for name, value in self.headers + list(extra):
+            lines.append('%s: %s' % (name, value))
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+    def send(self, status, body='', content_type=None):
+        if content_type:
+            self.set_header('Content-Type', content_type)
+        extra = []
+        if status not in (204, 304):
+            extra.append(('Content-Length', str(len(body))))
+        if self.request.version == 'HTTP/1.0' and self.keep_alive:
+            extra.append(('Connection', 'keep-alive'))
+        elif not self.keep_alive:
+            extra.append(('Connection', 'close'))
+        self.stream.write(self.head(status, extra) + body)
+        self._finish()
+
+    def start(self, status, content_type=None):
+        if content_type:
+            self.set_header('Content-Type', content_type)
+        if self.request.version == 'HTTP/1.1':
+            self.chunked = True
+            extra = [('Transfer-Encoding', 'chunked')]
+        else:
+            self.keep_alive = False
+            extra = [('Connection', 'close')]
+        self.stream.write(self.head(status, extra))
+
+    def write(self, data):
+        if self.chunked:
+            data = '%x\r\n%s\r\n' % (len(data), data)
+        return self.stream.write(data)
+
+    def finish(self):
+        if self.finished.done():
+            return
+        if self.chunked:
+            self.stream.write('0\r\n\r\n')
+        self._finish()
+
+    # The connection is handed over, to a websocket.
+    def upgrade(self, status, reason):
+        self.upgraded = True
+        self.stream.write(self.head(status, reason=reason))
+        self._finish()
+
+    def _finish(self):
+        self.stop_watching()
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+    # Calls `callback` if the client goes away before the response is
+    # finished. Data the client sends in the meantime (a pipelined
+    # request) is left in the buffer.
+    def watch_close(self, callback):
+        self.watching = True
+        def closed(f):
+            if self.watching:
+                self.watching = False
+                callback()
+        self.stream.read_until_close().add_done_callback(closed)
+
+    def stop_watching(self):
+        if self.watching:
+            self.watching = False
+            self.stream.cancel_read()
+
+
+class HttpConnection(object):
+    def __init__(self, server, stream):
+        self.server = server
+        self.stream = stream
+
+    @coroutine
+    def serve(self):
+        while True:
+            try:
+                request = yield self.read_request()
+            except (socket.error, ValueError):
+                break
+            response = Response(self.stream, request)
+            self.server.handle(request, response)
+            yield response.finished
+            if response.upgraded:
+                return
+            if not response.keep_alive:
+                break
+        try:
+            # Let the last response out before closing.
+            yield self.stream.write('')
+        except socket.error:
+            pass
+        self.stream.close()
+
+    @coroutine
+    def read_request(self):
+        head = yield self.stream.read_until('\r\n\r\n')
+        lines = head.lstrip('\r\n').split('\r\n')
+        method, uri, version = lines[0].split(' ', 2)
+        headers = CaseInsensitiveDict()
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip()] = value.strip()
+        body = ''
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                line = yield self.stream.read_until('\r\n')
+                size = int(line.split(';')[0], 16)
+                chunk = yield self.stream.read_bytes(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            body = ''.join(chunks)
+        elif headers.get('Content-Length'):
+            body = yield self.stream.read_bytes(int(headers['Content-Length']))
+        raise Return(Request(method, uri, version, headers, body))
+
+
+# WebSockets
+# ----------
+#
+# Both rfc 6455 (hybi) and the older hixie-76 are supported, the former
+# with `permessage-deflate` when the client offers it. `recv()` returns
+# the next message, or None once the connection is closed.
+def server_frame(opcode, data):
+    return rfc6455.encode_frame(opcode, data, masked=False)
+
+class Hybi(object):
+    def __init__(self, stream, deflate=None):
+        self.stream = stream
+        self.deflate = deflate
+        self.decoder = rfc6455.Decoder(deflate)
+        self.messages = collections.deque()
+        self.close_sent = False
+
+    def start(self):
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def send(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if not self.stream.closed:
+            self.stream.write(rfc6455.encode_message(
+                OP_TEXT, data, masked=False, deflate=self.deflate))
+
+    @coroutine
+    def recv(self):
+        while True:
+            try:
+                opcode, payload = yield self.read_message()
+            except socket.error:
+                raise Return(None)
+            except rfc6455.ProtocolError:
+                self.close(1002)
+                raise Return(None)
+            if opcode == OP_CLOSE:
+                code = 1000
+                if len(payload) >= 2:
+                    code = struct.unpack('!H', payload[:2])[0]
+                self.close(code)
+                raise Return(None)
+            elif opcode == OP_PING:
+                self.stream.write(server_frame(OP_PONG, payload))
+            elif opcode == OP_TEXT:
+                raise Return(payload.decode('utf-8'))
+            elif opcode != OP_PONG:
+                raise Return(payload)
+
+    @coroutine
+    def read_message(self):
+        while not self.messages:
+            data = yield self.stream.read_some()
+            if not data:
+                raise StreamClosedError('Connection closed')
+            self.messages.extend(self.decoder.feed(data))
+        raise Return(self.messages.popleft())
+
+    # Sends a close frame, the connection is closed once it's written.
+    def close(self, code=1000, reason=''):
+        if self.close_sent or self.stream.closed:
+            return
+        self.close_sent = True
+        payload = struct.pack('!H', code) + reason.encode('utf-8')
+        f = self.stream.write(server_frame(OP_CLOSE, payload))
+        f.add_done_callback(lambda f: self.stream.close())
+
+    def abort(self):
+        self.stream.close()
+
+
+class Hixie76(Hybi):
+    def __init__(self, stream, key1, key2):
+        super(Hixie76, self).__init__(stream)
+        self.key1, self.key2 = key1, key2
+
+    @staticmethod
+    def key_number(key):
+        digits = int(''.join(c for c in key if c.isdigit()))
+        return digits // key.count(' ')
+
+    # The nonce comes after the response headers were written.
+    @coroutine
+    def start(self):
+        nonce = yield self.stream.read_bytes(8)
+        challenge = struct.pack('>II', self.key_number(self.key1),
+                                self.key_number(self.key2)) + nonce
+        self.stream.write(hashlib.md5(challenge).digest())
+
+    def send(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if not self.stream.closed:
+            self.stream.write('\x00' + data + '\xff')
+
+    @coroutine
+    def recv(self):
+        try:
+            frame_type = yield self.stream.read_bytes(1)
+            if frame_type == '\x00':
+                data = yield self.stream.read_until('\xff')
+                raise Return(data[:-1].decode('utf-8'))
+            yield self.stream.read_bytes(1)
+        except socket.error:
+            pass
+        self.abort()
+        raise Return(None)
+
+    def close(self, code=1000, reason=''):
+        if self.close_sent or self.stream.closed:
+            return
+        self.close_sent = True
+        f = self.stream.write('\xff\x00')
+        f.add_done_callback(lambda f: self.stream.close())
+
+
+# Sessions
+# --------
+#
+# A session outlives the requests receiving its frames. It keeps the
+# messages until a receiver comes, sends heartbeats while one is
+# there, and is forgotten `disconnect_delay` seconds after the last
+# one went away.
+class Session(object):
+    NEW, OPEN, CLOSED = range(3)
+
+    def __init__(self, service, session_id):
+        self.service = service
+        self.id = session_id
+        self.loop = service.loop
+        self.handler = service.handler
+        self.state = Session.NEW
+        self.receiver = None
+        self.queue = []
+        self.close_frame = None
+        self.heartbeat_timer = None
+        self.timeout_timer = None
+
+    def register(self, receiver):
+        # The previous receiver may be gone without the loop having
+        # noticed yet.
+        if self.receiver is not None and not self.receiver.alive():
+            self.receiver.abort()
+        if self.receiver is not None:
+            receiver.send_frame(close_frame(2010, 'Another connection still open'))
+            receiver.finish()
+            return
+        if self.state == Session.CLOSED:
+            receiver.send_frame(self.close_frame)
+            receiver.finish()
+            return
+        self.receiver = receiver
+        if self.timeout_timer:
+            self.loop.remove_timeout(self.timeout_timer)
+            self.timeout_timer = None
+        self.schedule_heartbeat()
+        if self.state == Session.NEW:
+            self.state = Session.OPEN
+            receiver.send_frame('o')
+            self.handler.on_open(self)
+        self.flush()
+
+    def unregister(self):
+        self.receiver = None
+        if self.heartbeat_timer:
+            self.loop.remove_timeout(self.heartbeat_timer)
+            self.heartbeat_timer = None
+        if self.timeout_timer is None:
+            self.timeout_timer = self.loop.call_later(
+                self.service.server.disconnect_delay, self.timed_out)
+
+    def schedule_heartbeat(self):
+        self.heartbeat_timer = self.loop.call_later(
+            self.service.server.heartbeat_delay, self.heartbeat)
+
+    def heartbeat(self):
+        self.heartbeat_timer = None
+        if self.receiver:
+            self.receiver.send_frame('h')
+        if self.receiver:
+            self.schedule_heartbeat()
+
+    def timed_out(self):
+        self.timeout_timer = None
+        if self.receiver:
+            return
+        if self.service.sessions.get(self.id) is self:
+            del self.service.sessions[self.id]
+        if self.state != Session.CLOSED:
+            self.state = Session.CLOSED
+            self.handler.on_close(self)
+
+    def receive(self, messages):
+        for message in messages:
+            if self.state != Session.OPEN:
+                break
+            self.handler.on_message(self, message)
+
+    def flush(self):
+        if self.receiver and self.queue:
+            messages, self.queue = self.queue, []
+            self.receiver.send_frame('a' + encode(messages))
+
+    # Application side: `send()` and `close()`.
+    def send(self, message):
+        if self.state == Session.CLOSED:
+            return
+        self.queue.append(message)
+        self.flush()
+
+    def close(self, code=3000, reason='Go away!'):
+        if self.state == Session.CLOSED:
+            return
+        self.state = Session.CLOSED
+        self.close_frame = close_frame(code, reason)
+        if self.receiver:
+            receiver = self.receiver
+            receiver.send_frame(self.close_frame)
+            receiver.finish()
+        self.handler.on_close(self)
+
+    # The receiving connection went away.
+    def abort(self):
+        self.unregister()
+        self.close(1002, 'Connection interrupted')
+
+
+# Receivers send frames to the client, one per request for polling
+# transports, until `response_limit` bytes for streaming ones.
+class Receiver(object):
+    content_type = JAVASCRIPT
+    prelude = None
+
+    def __init__(self, service, request, response, callback=None):
+        self.service = service
+        self.request = request
+        self.response = response
+        self.callback = callback
+        self.session = None
+        self.sent = 0
+        self.done = False
+
+    def attach(self, session):
+        self.session = session
+        self.response.watch_close(self.abort)
+        if self.prelude is not None:
+            self.response.start(200, self.content_type)
+            self.response.write(self.prelude)
+        session.register(self)
+
+    def alive(self):
+        stream = self.response.stream
+        if stream.closed or stream.eof:
+            return False
+        try:
+            return stream.socket.recv(1, socket.MSG_PEEK) != ''
+        except socket.error as e:
+            return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+    def abort(self):
+        self.done = True
+        if self.session.receiver is self:
+            self.session.abort()
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        if self.session.receiver is self:
+            self.session.unregister()
+        self.response.finish()
+
+class PollingReceiver(Receiver):
+    def send_frame(self, frame):
+        if self.done:
+            return
+        self.response.send(200, self.format(frame), self.content_type)
+        self.finish()
+
+class StreamingReceiver(Receiver):
+    def send_frame(self, frame):
+        if self.done:
+            return
+        data = self.format(frame)
+        self.response.write(data)
+        self.sent += len(data)
+        if self.sent >= self.service.server.response_limit:
+            self.finish()
+
+class XhrPollingReceiver(PollingReceiver):
+    def format(self, frame):
+        return frame + '\n'
+
+class JsonpReceiver(PollingReceiver):
+    def format(self, frame):
+        return '/**/%s(%s);\r\n' % (self.callback, json.dumps(frame))
+
+class XhrStreamingReceiver(StreamingReceiver):
+    prelude = 'h' * 2048 + '\n'
+
+    def format(self, frame):
+        return frame + '\n'
+
+class EventSourceReceiver(StreamingReceiver):
+    content_type = 'text/event-stream'
+    prelude = '\r\n'
+
+    def format(self, frame):
+        return 'data: ' + frame + '\r\n\r\n'
+
+class HtmlFileReceiver(StreamingReceiver):
+    content_type = 'text/html; charset=UTF-8'
+
+    def __init__(self, *args):
+        super(HtmlFileReceiver, self).__init__(*args)
+        head = HTMLFILE % (self.callback,)
+        self.prelude = head + ' ' * max(0, 1024 - len(head)) + '\r\n\r\n'
+
+    def format(self, frame):
+        return '<script>\np(%s);\n</script>\r\n' % (json.dumps(frame),)
+
+class WebsocketReceiver(object):
+    def __init__(self, ws):
+        self.ws = ws
+        self.session = None
+
+    def send_frame(self, frame):
+        self.ws.send(frame)
+
+    def finish(self):
+        if self.session.receiver is self:
+            self.session.unregister()
+        self.ws.close()
+
+
+# The raw websocket endpoint gives the application the same interface
+# as a session.
+class RawConnection(object):
+    def __init__(self, ws):
+        self.ws = ws
+        self.closed = False
+
+    def send(self, message):
+        self.ws.send(message)
+
+    def close(self, code=3000, reason='Go away!'):
+        self.closed = True
+        self.ws.close(code, reason)
+
+
+# Services
+# --------
+class EchoHandler(object):
+    def on_open(self, session):
+        pass
+
+    def on_message(self, session, message):
+        session.send(message)
+
+    def on_close(self, session):
+        pass
+
+class CloseHandler(EchoHandler):
+    def on_open(self, session):
+        session.close(3000, 'Go away!')
+
+
+IFRAME_RE = re.compile(r'^/iframe[0-9\-.a-z_]*\.html$')
+SESSION_RE = re.compile(r'^/([^/.]+)/([^/.]+)/([^/.]+)$')
+CALLBACK_RE = re.compile(r'[^a-zA-Z0-9\-_.]')
+
+class Service(object):
+    # Transport: (receiver class, method), or the name of a handler.
+    transports = {
+        'xhr': (XhrPollingReceiver, 'POST'),
+        'jsonp': (JsonpReceiver, 'GET'),
+        'xhr_streaming': (XhrStreamingReceiver, 'POST'),
+        'eventsource': (EventSourceReceiver, 'GET'),
+        'htmlfile': (HtmlFileReceiver, 'GET'),
+        'xhr_send': 'xhr_send',
+        'jsonp_send': 'jsonp_send',
+        'websocket': 'websocket',
+    }
+    cors_transports = ('xhr', 'xhr_send', 'xhr_streaming')
+
+    def __init__(self, server, handler, websocket=True, cookie_needed=False):
+        self.server = server
+        self.loop = server.loop
+        self.handler = handler
+        self.websocket_enabled = websocket
+        self.cookie_needed = cookie_needed
+        self.sessions = {}
+        self.iframe = IFRAME % (server.sockjs_url,)
+        self.etag = '"%s"' % (hashlib.md5(self.iframe).hexdigest(),)
+
+    def handle(self, request, response, path):
+        if path in ('', '/'):
+            return self.greeting(request, response)
+        if IFRAME_RE.match(path):
+            return self.iframe_page(request, response)
+        if path == '/info':
+            return self.info(request, response)
+        if path == '/websocket':
+            return self.raw_websocket(request, response)
+        m = SESSION_RE.match(path)
+        transport = m and self.transports.get(m.group(3))
+        if not transport:
+            raise HttpError(404)
+        session_id = m.group(2)
+        if transport == 'websocket':
+            return self.websocket(request, response)
+        name = m.group(3)
+        if request.method == 'OPTIONS' and name in self.cors_transports:
+            return self.options(request, response, 'OPTIONS, POST')
+        if isinstance(transport, str):
+            if request.method != 'POST':
+                raise HttpError(404)
+            return getattr(self, transport)(request, response, session_id)
+        receiver_class, method = transport
+        if request.method != method:
+            raise HttpError(404)
+        return self.receive(receiver_class, name, request, response,
+                            session_id)
+
+    # Headers
+    def no_cache(self, response):
+        response.set_header('Cache-Control', 'no-store, no-cache, '
+                            'no-transform, must-revalidate, max-age=0')
+
+    def cache_for_a_year(self, response):
+        response.set_header('Cache-Control', 'public, max-age=%d' % YEAR)
+        response.set_header('Expires', email.utils.formatdate(
+            time.time() + YEAR, usegmt=True))
+
+    def cors(self, request, response):
+        origin = request.headers.get('Origin')
+        if origin:
+            response.set_header('Access-Control-Allow-Origin', origin)
+            response.set_header('Access-Control-Allow-Credentials', 'true')
+        else:
+            response.set_header('Access-Control-Allow-Origin', '*')
+        headers = request.headers.get('Access-Control-Request-Headers')
+        if headers:
+            response.set_header('Access-Control-Allow-Headers', headers)
+
+    def cookie(self, request, response):
+        if not self.cookie_needed:
+            return
+        value = 'dummy'
+        try:
+            c = Cookie.SimpleCookie(request.headers.get('Cookie', ''))
+            if 'JSESSIONID' in c:
+                value = c['JSESSIONID'].value
+        except Cookie.CookieError:
+            pass
+        response.set_header('Set-Cookie', 'JSESSIONID=%s; path=/' % (value,))
+
+    # Static urls
+    def greeting(self, request, response):
+        if request.method != 'GET':
+            raise HttpError(404)
+        response.send(200, 'Welcome to SockJS!\n', TEXT)
+
+    def iframe_page(self, request, response):
+        if request.method != 'GET':
+            raise HttpError(404)
+        self.cache_for_a_year(response)
+        response.set_header('ETag', self.etag)
+        if request.headers.get('If-None-Match') == self.etag:
+            return response.send(304)
+        response.send(200, self.iframe, 'text/html; charset=UTF-8')
+
+    def info(self, request, response):
+        if request.method == 'OPTIONS':
+            return self.options(request, response, 'OPTIONS, GET')
+        if request.method != 'GET':
+            raise HttpError(404)
+        self.no_cache(response)
+        self.cors(request, response)
+        response.send(200, json.dumps({
+            'websocket': self.websocket_enabled,
+            'cookie_needed': self.cookie_needed,
+            'origins': ['*:*'],
+            'entropy': random.randint(0, 2 ** 32 - 1),
+        }), 'application/json; charset=UTF-8')
+
+    def options(self, request, response, methods):
+        self.cache_for_a_year(response)
+        self.cors(request, response)
+        response.set_header('Access-Control-Allow-Methods', methods)
+        response.set_header('Access-Control-Max-Age', str(YEAR))
+        response.send(204)
+
+    # Receiving transports
+    def receive(self, receiver_class, name, request, response, session_id):
+        callback = None
+        if name in ('jsonp', 'htmlfile'):
+            callback = request.arg('c')
+            if not callback:
+                raise HttpError(500, '"callback" parameter required')
+            if CALLBACK_RE.search(callback):
+                raise HttpError(500, 'invalid "callback" parameter')
+        self.cookie(request, response)
+        if name in self.cors_transports:
+            self.cors(request, response)
+        self.no_cache(response)
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = Session(self, session_id)
+        receiver_class(self, request, response, callback).attach(session)
+
+    # Sending transports
+    def decode(self, data):
+        if not data:
+            raise HttpError(500, 'Payload expected.')
+        try:
+            messages = json.loads(data)
+        except ValueError:
+            raise HttpError(500, 'Broken JSON encoding.')
+        if not isinstance(messages, list):
+            messages = [messages]
+        return messages
+
+    def xhr_send(self, request, response, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise HttpError(404)
+        session.receive(self.decode(request.body))
+        self.cookie(request, response)
+        self.cors(request, response)
+        self.no_cache(response)
+        response.send(204, '', TEXT)
+
+    def jsonp_send(self, request, response, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise HttpError(404)
+        data = request.body
+        content_type = request.headers.get('Content-Type', '')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            form = urlparse.parse_qs(data, keep_blank_values=True)
+            data = form.get('d', [''])[0]
+        session.receive(self.decode(data))
+        self.cookie(request, response)
+        self.no_cache(response)
+        response.send(200, 'ok', TEXT)
+
+    # Websockets
+    def handshake(self, request, response):
+        if not self.websocket_enabled:
+            raise HttpError(404)
+        if request.method != 'GET':
+            response.set_header('Allow', 'GET')
+            return response.send(405)
+        if request.headers.get('Upgrade', '').lower() != 'websocket':
+            raise HttpError(400, 'Can "Upgrade" only to "WebSocket".')
+        if 'upgrade' not in tokens(request.headers.get('Connection', '')):
+            raise HttpError(400, '"Connection" must be "Upgrade".')
+        h = request.headers
+        if 'Sec-WebSocket-Key1' in h and 'Sec-WebSocket-Key2' in h:
+            response.set_header('Upgrade', 'WebSocket')
+            response.set_header('Connection', 'Upgrade')
+            response.set_header('Sec-WebSocket-Origin', h.get('Origin', ''))
+            response.set_header('Sec-WebSocket-Location',
+                                'ws://' + h.get('Host', '') + request.uri)
+            response.upgrade(101, 'WebSocket Protocol Handshake')
+            return Hixie76(response.stream, h['Sec-WebSocket-Key1'],
+                           h['Sec-WebSocket-Key2'])
+        if h.get('Sec-WebSocket-Version') not in ('7', '8', '13'):
+            response.set_header('Sec-WebSocket-Version', '13')
+            raise HttpError(400, 'Unsupported WebSocket version.')
+        key = h.get('Sec-WebSocket-Key', '')
+        response.set_header('Upgrade', 'websocket')
+        response.set_header('Connection', 'Upgrade')
+        response.set_header('Sec-WebSocket-Accept', base64.b64encode(
+            hashlib.sha1(key + WS_GUID).digest()))
+        deflate = rfc6455.negotiate_deflate(rfc6455.parse_extensions(
+            h.get('Sec-WebSocket-Extensions', '')))
+        if deflate is not None:
+            response.set_header('Sec-WebSocket-Extensions',
+                                rfc6455.format_extension(rfc6455.DEFLATE,
+                                                         deflate))
+            deflate = rfc6455.Deflate(deflate, client=False)
+        response.upgrade(101, 'Switching Protocols')
+        return Hybi(response.stream, deflate)
+
+    # A websocket session lives as long as its connection, and is not
+    # kept with the other sessions: the same id may be used again.
+    @coroutine
+    def websocket(self, request, response):
+        ws = self.handshake(request, response)
+        if ws is None:
+            return
+        yield ws.start()
+        session = Session(self, None)
+        receiver = WebsocketReceiver(ws)
+        receiver.session = session
+        session.register(receiver)
+        while session.state != Session.CLOSED:
+            try:
+                data = yield ws.recv()
+            except (socket.error, ValueError):
+                data = None
+            if data is None:
+                break
+            if not data:
+                continue
+            try:
+                messages = json.loads(data)
+            except ValueError:
+                ws.abort()
+                break
+            if not isinstance(messages, list):
+                messages = [messages]
+            session.receive(messages)
+        if session.receiver is receiver:
+            session.unregister()
+        session.close()
+
+    @coroutine
+    def raw_websocket(self, request, response):
+        ws = self.handshake(request, response)
+        if ws is None:
+            return
+        yield ws.start()
+        conn = RawConnection(ws)
+        self.handler.on_open(conn)
+        while not conn.closed:
+            try:
+                data = yield ws.recv()
+            except (socket.error, ValueError):
+                data = None
+            if data is None:
+                break
+            self.handler.on_message(conn, data)
+        conn.closed = True
+        self.handler.on_close(conn)
+
+
+class Server(object):
+    services = [
+        ('echo', EchoHandler, {}),
+        ('close', CloseHandler, {}),
+        ('disabled_websocket_echo', EchoHandler, {'websocket': False}),
+        ('cookie_needed_echo', EchoHandler, {'cookie_needed': True}),
+    ]
+
+    def __init__(self, loop=None, response_limit=128 * 1024,
+                 heartbeat_delay=25, disconnect_delay=5,
+                 sockjs_url=SOCKJS_URL):
+        self.loop = loop or IOLoop.instance()
+        self.response_limit = response_limit
+        self.heartbeat_delay = heartbeat_delay
+        self.disconnect_delay = disconnect_delay
+        self.sockjs_url = sockjs_url
+        self.socket = None
+        self.url = None
+        self.prefixes = dict((name, Service(self, handler(), **options))
+                             for name, handler, options in self.services)
+
+    def listen(self, port=0, address='127.0.0.1'):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((address, port))
+        s.listen(1024)
+        s.setblocking(False)
+        self.socket = s
+        self.url = 'http://%s:%d' % s.getsockname()
+        self.loop.add_handler(s.fileno(), self.accept, IOLoop.READ)
+        return self.url
+
+    def accept(self, fd, events):
+        while True:
+            try:
+                conn, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.args[0] == errno.ECONNABORTED:
+                    continue
+                raise
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            HttpConnection(self, IOStream(conn, loop=self.loop)).serve()
+
+    def handle(self, request, response):
+        try:
+            m = re.match(r'^/([^/]+)(/.*)?$', request.path)
+            service = m and self.prefixes.get(m.group(1))
+            if not service:
+                raise HttpError(404)
+            f = service.handle(request, response, m.group(2) or '')
+        except Exception:
+            return self.error(response, sys.exc_info())
+        if isinstance(f, Future):
+            f.add_done_callback(lambda f: f.exception() is not None and
+                                self.error(response, f._exc_info))
+
+    def error(self, response, exc_info):
+        if response.finished.done():
+            if not isinstance(exc_info[1], HttpError):
+                traceback.print_exception(*exc_info)
+        elif isinstance(exc_info[1], HttpError):
+            e = exc_info[1]
+            response.send(e.status, e.body, TEXT if e.body else None)
+        else:
+            traceback.print_exception(*exc_info)
+            response.keep_alive = False
+            response.send(500, 'Internal Server Error', TEXT)
+
+
+# A server running in a thread, with its own loop. The loop is woken
+# up through a pipe to be stopped from another thread.
+class ServerThread(object):
+    def __init__(self, server):
+        self.server = server
+        self.url = server.url
+        self.wakeup = os.pipe()
+        server.loop.add_handler(self.wakeup[0], self.wake, IOLoop.READ)
+        self.thread = threading.Thread(target=server.loop.start,
+                                       name='sockjs-server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wake(self, fd, events):
+        self.server.loop.stop()
+
+    def stop(self):
+        if self.thread.is_alive():
+            os.write(self.wakeup[1], 'x')
+            self.thread.join()
+            self.server.socket.close()
+            for fd in self.wakeup:
+                os.close(fd)
+
+# Starts a server running in a thread, `stop()` it when done.
+def start(port=0, address='127.0.0.1', **settings):
+    server = Server(IOLoop(), **settings)
+    server.listen(port, address)
+    return ServerThread(server)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SockJS reference server.')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--response-limit', type=int, default=4096,
+                        help='bytes sent on a streaming request before '
+                        'it is closed, the protocol suite expects 4096')
+    parser.add_argument('--heartbeat-delay', type=float, default=25)
+    parser.add_argument('--disconnect-delay', type=float, default=5)
+    options = parser.parse_args(argv)
+    server = Server(response_limit=options.response_limit,
+                    heartbeat_delay=options.heartbeat_delay,
+                    disconnect_delay=options.disconnect_delay)
+    print ' [*] Listening on', server.listen(options.port, options.address)
+    server.loop.start()
+
+if __name__ == '__main__':
+    main()
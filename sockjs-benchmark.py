@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+"""
+The protocol suite tells if a server works, this tells how fast it
+is. The benchmarks talk to the `echo` service, like the tests, and
+are organized the same way: a class for every transport.
+
+All the numbers depend on the machine, the network and the harness
+itself as much as on the server. They are meant to compare transports
+of one server, or servers run on the same box, not to be quoted on
+their own.
+
+Run a single class with `./venv/bin/python sockjs-benchmark.py
+Websocket`, the measurements can be made shorter with `-s` and the
+sweeps changed with `--sizes` and `--batches`.
+"""
+import json
+import os
+import random
+import socket
+import uuid
+import asyncclient
+import bench
+import utils
+from bench import Benchmark, EchoSession, IdleSession
+from histogram import Histogram
+from ioloop import coroutine, gather, sleep, Return, monotonic
+
+
+# Throughput
+# ==========
+
+"""
+A session sends a batch of messages and waits for all of them to be
+echoed, then sends the next batch, for a couple of seconds. This is
+repeated for a range of message and batch sizes, every time with a
+new session. The batch is a single request for the http transports,
+a single frame for `Websocket` (a json array can carry many messages)
+and a frame per message for `RawWebsocket`.
+
+Payload bytes are counted, not the bytes on the wire.
+"""
+class Throughput(Benchmark):
+    abstract = True
+
+    def bench_throughput(self):
+        seconds = self.options.seconds
+        for size in self.sizes:
+            for batch in self.batches:
+                session = EchoSession(self.transport, self.base_url)
+                try:
+                    self.run_sync(session.open(), timeout=10)
+                    count, elapsed = self.run_sync(
+                        self.echo_rate(session, size, batch, seconds),
+                        timeout=seconds + 30)
+                finally:
+                    session.close()
+                self.record(size=size, batch=batch,
+                            msgs_per_sec=count / elapsed,
+                            bytes_per_sec=count * size / elapsed)
+
+
+# Overhead
+# ========
+
+"""
+How many bytes a transport spends besides the messages themselves. A
+session echoes batches of messages twenty times, and everything its
+connections send and receive is counted at the socket level, from
+opening the session until the last echo. The bytes are split into:
+
+* `header_bytes`: http request and response heads, the websocket
+  handshake included,
+* `framing_bytes`: everything else that isn't a message: chunk size
+  lines, `data: ` and `<script>p(...)</script>` wrappers, the `o` and
+  `a[...]` frames with their json quoting, padding and heartbeats,
+  websocket frame headers,
+* `payload_bytes`: the messages, utf-8 encoded, both ways.
+
+`efficiency` is the payload share of all the bytes, in percent.
+Streaming transports reconnect once a response reaches the server's
+size limit, which shows as more header bytes for larger messages.
+"""
+class Overhead(Benchmark):
+    abstract = True
+    roundtrips = 20
+
+    def bench_overhead(self):
+        for size in self.sizes:
+            for batch in self.batches:
+                with asyncclient.Traffic() as traffic:
+                    session = EchoSession(self.transport, self.base_url)
+                    try:
+                        self.run_sync(session.open(), timeout=10)
+                        self.run_sync(self.echo_n(session, size, batch),
+                                      timeout=60)
+                    finally:
+                        session.close()
+                t = traffic.totals()
+                total = t['sent'] + t['received']
+                header = t['header_sent'] + t['header_received']
+                payload = 2 * size * batch * self.roundtrips
+                if total - header < payload:
+                    raise Exception('Bytes missing from the count: %d '
+                                    'total, %d header, %d payload' % (
+                                        total, header, payload))
+                self.record(size=size, batch=batch, header_bytes=header,
+                            framing_bytes=total - header - payload,
+                            payload_bytes=payload,
+                            efficiency=100.0 * payload / total)
+
+    @coroutine
+    def echo_n(self, session, size, batch):
+        msgs = ['x' * size] * batch
+        for i in xrange(self.roundtrips):
+            yield session.roundtrip(msgs)
+
+
+# Idle sessions
+# =============
+
+"""
+Most sessions of a real server do nothing but wait, and the server
+sends them a heartbeat `h` frame every 25 seconds or so. What such a
+session costs is measured by ramping up to `--sessions` of them, by
+`--step` at a time. After every step the sessions are held for
+`--hold` seconds, which should be longer than the heartbeat interval.
+
+For every step we record how fast the new sessions were opened, the
+gaps between frames received by a session (which would be the
+heartbeat interval on an idle server, anything above that is jitter),
+how many sessions have been closed and how many didn't see a frame
+for 1.5 heartbeat intervals. Given `--server-rss` (a pid or a
+`/proc/<pid>` path) the memory used by the server is recorded too.
+
+It takes a while, so it's only run when asked for:
+`./venv/bin/python sockjs-benchmark.py bench_idle_sessions`.
+"""
+class IdleSessions(Benchmark):
+    abstract = True
+
+    @bench.explicit
+    def bench_idle_sessions(self):
+        options = self.options
+        gaps = Histogram()
+        sessions = []
+        rss0 = options.server_rss and bench.read_rss(options.server_rss)
+        try:
+            while len(sessions) < options.sessions:
+                count = min(options.step, options.sessions - len(sessions))
+                new = [IdleSession(self.transport, self.base_url, gaps,
+                                   self.loop) for i in range(count)]
+                sessions.extend(new)
+                t0 = self.loop.time()
+                opened = sum(self.run_sync(self.open_sessions(new)))
+                setup = self.loop.time() - t0
+                gaps.reset()
+                self.run_sync(sleep(options.hold, self.loop))
+                self.record_step(sessions, opened, count - opened, setup, gaps,
+                                 rss0)
+        finally:
+            for s in sessions:
+                s.close()
+
+    @coroutine
+    def open_sessions(self, sessions):
+        n = self.options.concurrency
+        opened = []
+        for i in range(0, len(sessions), n):
+            opened += yield gather([s.open(self.options.connect_timeout)
+                                    for s in sessions[i:i + n]])
+        raise Return(opened)
+
+    def record_step(self, sessions, opened, failed, setup, gaps, rss0):
+        now = self.loop.time()
+        stale_after = self.options.heartbeat * 1.5
+        fields = dict(
+            sessions=len(sessions),
+            setup_per_sec=opened / setup,
+            failed=failed,
+            closed=sum(1 for s in sessions if s.closed),
+            stale=sum(1 for s in sessions if not s.closed and
+                      s.last is not None and now - s.last > stale_after),
+            heartbeats=gaps.count)
+        if gaps.count:
+            fields.update(gap_p50_ms=gaps.percentile(50) / 1000.0,
+                          gap_p99_ms=gaps.percentile(99) / 1000.0,
+                          gap_max_ms=gaps.max / 1000.0,
+                          gap_dev_ms=gaps.stddev() / 1000.0)
+        if self.options.server_rss:
+            rss = bench.read_rss(self.options.server_rss)
+            fields.update(rss_kb=rss)
+            if rss0 is not None:
+                fields.update(rss_per_session_kb=
+                              float(rss - rss0) / len(sessions))
+        self.record(**fields)
+
+
+# Compression
+# ===========
+
+"""
+What `permessage-deflate` saves on the wire and what it costs. Json
+messages are echoed one at a time by the raw websocket endpoint of
+`echo`, for a couple of seconds, for every message size: without the
+extension, with it, and with it but without context takeover. The
+messages are all different, or context takeover would make a repeated
+one next to free.
+
+For every run we record the compression ratio (payload bytes over
+bytes on the wire, both ways), the bytes on the wire per message and
+the cpu time per message in microseconds, of the harness and, given
+`--server-rss`, of the server. The cpu time covers a whole round trip:
+one message compressed and one decompressed on each side. A server
+declining the extension shows up as `deflate=declined`.
+"""
+class WebsocketDeflate(Benchmark):
+    modes = (
+        ('off', None),
+        ('on', {}),
+        ('no_context_takeover', {'server_no_context_takeover': None,
+                                 'client_no_context_takeover': None}),
+    )
+
+    def bench_deflate(self):
+        url = 'ws:' + self.base_url.split(':', 1)[1] + '/websocket'
+        for size in self.sizes:
+            msgs = json_messages(size)
+            for mode, offer in self.modes:
+                ws = self.run_sync(asyncclient.websocket_connect(
+                    url, timeout=10, deflate=offer), timeout=10)
+                try:
+                    fields = self.run_sync(
+                        self.echo_cost(ws, msgs, self.options.seconds),
+                        timeout=self.options.seconds + 30)
+                finally:
+                    ws.close()
+                if offer is not None and ws.deflate is None:
+                    mode = 'declined'
+                self.record(deflate=mode, size=size, **fields)
+
+    @coroutine
+    def echo_cost(self, ws, msgs, seconds):
+        server = self.options.server_rss
+        yield ws.send(msgs[-1])
+        yield ws.recv()
+        wire0 = ws.bytes_sent + ws.bytes_received
+        cpu0 = cpu_time()
+        server0 = server and bench.read_cpu(server)
+        count = 0
+        t0 = monotonic()
+        deadline = t0 + seconds
+        while monotonic() < deadline:
+            yield ws.send(msgs[count % len(msgs)])
+            yield ws.recv()
+            count += 1
+        elapsed = monotonic() - t0
+        wire = ws.bytes_sent + ws.bytes_received - wire0
+        fields = dict(
+            ratio=2.0 * len(msgs[0]) * count / wire,
+            wire_bytes_per_msg=float(wire) / count / 2,
+            cpu_us_per_msg=(cpu_time() - cpu0) * 1000000 / count,
+            msgs_per_sec=count / elapsed)
+        if server:
+            fields.update(server_cpu_us_per_msg=(
+                bench.read_cpu(server) - server0) * 1000000 / count)
+        raise Return(fields)
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+# Consecutive pieces of `size` bytes cut out of a json document, a
+# list of made up events. There are enough of them that no piece is
+# still in the compression window when it comes round again, and the
+# same size gives the same pieces.
+def json_messages(size):
+    rnd = random.Random(size)
+    events = []
+    for i in range(max(64 * size, 1 << 17) // 90):
+        events.append({
+            'id': i,
+            'user': 'user%d' % rnd.randint(1, 500),
+            'type': rnd.choice(['click', 'view', 'scroll', 'submit']),
+            'time': 1500000000 + rnd.randint(0, 86400 * 365),
+            'value': round(rnd.random() * 100, 2),
+        })
+    text = json.dumps(events)
+    return [text[i:i + size] for i in range(0, len(text) - size + 1, size)]
+
+
+# Pipelining
+# ==========
+
+"""
+Requests a second on a single keep-alive connection, for `/info` and
+`xhr_send`, with `batch` requests written at once before their
+responses are read. A batch of 1 is plain keep-alive, one request at a
+time. Proxies that reuse their connections to the server send it
+traffic like this.
+
+The echos of `xhr_send` are polled for once a second, on another
+connection and off the clock, so that the session stays open.
+"""
+class Pipelining(Benchmark):
+    def bench_pipelining(self):
+        for kind in ('info', 'xhr_send'):
+            for batch in self.batches:
+                self.record(request=kind, batch=batch,
+                            reqs_per_sec=self.request_rate(kind, batch))
+
+    def request_rate(self, kind, batch):
+        url = self.base_url + '/000/' + str(uuid.uuid4())
+        if kind == 'info':
+            requests = [('GET', self.base_url + '/info')] * batch
+            status = 200
+        else:
+            utils.POST(url + '/xhr')
+            requests = [('POST', url + '/xhr_send', {}, '["x"]')] * batch
+            status = 204
+        c = utils.RawHttpConnection(url)
+        try:
+            count, elapsed = 0, 0.0
+            poll = monotonic() + 1
+            while elapsed < self.options.seconds:
+                t0 = monotonic()
+                for r in c.pipeline(requests):
+                    if r.status != status:
+                        raise Exception('Unexpected response %r' % (r,))
+                elapsed += monotonic() - t0
+                count += batch
+                if kind == 'xhr_send' and monotonic() > poll:
+                    utils.POST(url + '/xhr')
+                    poll = monotonic() + 1
+        finally:
+            c.close()
+        return count / elapsed
+
+
+# Slow consumers
+# ==============
+
+"""
+What a server does with a client that stops reading. A streaming
+session is opened on a connection with a 4KiB receive buffer, which
+then isn't read from, while `xhr_send` requests push batches of 1KiB
+messages to it for `-s` seconds or up to `--flood` MiB. The server
+can:
+
+* close the session: `xhr_send` fails with a 404, or the connection,
+* push back: `xhr_send` isn't answered within a second,
+* reject the messages with another status,
+* accept everything. Given `--server-rss`, that is `growing` if the
+  server's memory grew by half of what was pushed or more, and
+  `bounded` otherwise.
+
+The reader then resumes, and `delivered_kb` counts the messages it
+gets before the response ends or goes quiet. `session` tells if a
+last `xhr_send` still finds the session open. Note that a server with
+a small response limit, like the test servers, ends the response
+early on and keeps the messages in the session until it times out.
+Processes seldom give freed memory back to the system either, so
+memory figures only hold for the first run against a fresh server:
+
+    ./venv/bin/python sockjs-benchmark.py XhrStreaming.bench_slow_consumer --server-rss 1234
+"""
+class SlowConsumer(Benchmark):
+    abstract = True
+    requests = {
+        'xhr_streaming': ('POST', '/xhr_streaming'),
+        'eventsource': ('GET', '/eventsource'),
+        'htmlfile': ('GET', '/htmlfile?c=callback'),
+    }
+    size = 1024
+    batch = 64
+
+    def bench_slow_consumer(self):
+        pid = self.options.server_rss
+        url = self.base_url + '/000/' + str(uuid.uuid4())
+        method, path = self.requests[self.transport]
+        reader = utils.RawHttpConnection(url, rcvbuf=4096)
+        sender = utils.RawHttpConnection(url)
+        try:
+            r = reader.request(method, url + path)
+            if r.status != 200:
+                raise Exception('Unexpected response %r' % (r,))
+            rss0 = pid and bench.read_rss(pid)
+            t0 = monotonic()
+            outcome, pushed = self.flood(sender, url, t0 + self.options.seconds)
+            fields = dict(outcome=outcome, pushed_kb=pushed // 1024,
+                          seconds=monotonic() - t0)
+            if pid:
+                growth = bench.read_rss(pid) - rss0
+                fields.update(rss_growth_kb=growth)
+                if outcome == 'accepted':
+                    fields.update(outcome='growing' if growth * 2048 >= pushed
+                                  else 'bounded')
+            fields.update(delivered_kb=self.drain(reader) * self.size // 1024,
+                          session=self.session_state(url))
+        finally:
+            reader.close()
+            sender.close()
+        self.record(**fields)
+
+    # `(outcome, bytes pushed)`
+    def flood(self, sender, url, deadline):
+        body = json.dumps(['x' * self.size] * self.batch)
+        limit = self.options.flood * 1024 * 1024
+        pushed = 0
+        while pushed < limit and monotonic() < deadline:
+            try:
+                r = sender.request('POST', url + '/xhr_send', body=body)
+                sender.read_body(r, 'POST')
+            except socket.timeout:
+                return 'blocked', pushed
+            except socket.error:
+                return 'closed', pushed
+            if r.status == 404:
+                return 'closed', pushed
+            if r.status != 204:
+                return 'rejected %d' % (r.status,), pushed
+            pushed += self.size * self.batch
+        return 'accepted', pushed
+
+    # Messages read until the response ends or nothing comes for a
+    # second, within ten seconds.
+    def drain(self, reader):
+        msg = 'x' * self.size
+        count, carry = 0, ''
+        deadline = monotonic() + 10
+        while monotonic() < deadline:
+            try:
+                data = reader.read()
+            except socket.error:
+                break
+            if not data:
+                break
+            text = carry + data
+            count += text.count(msg)
+            carry = text[-(len(msg) - 1):]
+        return count
+
+    def session_state(self, url):
+        try:
+            r = utils.POST(url + '/xhr_send', body='["x"]')
+        except Exception:
+            return 'unknown'
+        return 'open' if r.status == 204 else 'closed'
+
+
+# Large messages
+# ==============
+
+"""
+How long a single large message takes to be echoed, from sending it
+until it's back, for sizes from 1KiB to 4MiB (or `--sizes`). A
+session echoes one message at a time for a couple of seconds, at
+least three times. Streaming transports end their response after
+every message larger than the limit, and the time to open the next
+one is part of the cost.
+
+`bytes_per_sec` counts the message once for each echo.
+"""
+class LargeMessages(Benchmark):
+    abstract = True
+    large_sizes = (1024, 16 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+
+    def bench_large_messages(self):
+        seconds = self.options.seconds
+        for size in self.options.sizes or self.large_sizes:
+            session = EchoSession(self.transport, self.base_url)
+            try:
+                self.run_sync(session.open(), timeout=10)
+                times = self.run_sync(self.echo_times(session, size, seconds),
+                                      timeout=seconds + 60)
+            finally:
+                session.close()
+            times.sort()
+            self.record(size=size, echos=len(times),
+                        echo_ms_p50=times[len(times) // 2] * 1000,
+                        echo_ms_max=times[-1] * 1000,
+                        bytes_per_sec=size * len(times) / sum(times))
+
+    @coroutine
+    def echo_times(self, session, size, seconds):
+        msgs = ['x' * size]
+        times = []
+        deadline = monotonic() + seconds
+        while len(times) < 3 or monotonic() < deadline:
+            t0 = monotonic()
+            yield session.roundtrip(msgs)
+            times.append(monotonic() - t0)
+        raise Return(times)
+
+
+# Transports
+# ----------
+#
+# Polling transports have no idle sessions to speak of, and raw
+# websockets have no heartbeats.
+class XhrPolling(Throughput, Overhead, LargeMessages):
+    transport = 'xhr'
+
+class XhrStreaming(Throughput, Overhead, IdleSessions, SlowConsumer,
+                   LargeMessages):
+    transport = 'xhr_streaming'
+
+class EventSource(Throughput, Overhead, IdleSessions, SlowConsumer,
+                  LargeMessages):
+    transport = 'eventsource'
+
+class HtmlFile(Throughput, Overhead, IdleSessions, SlowConsumer,
+               LargeMessages):
+    transport = 'htmlfile'
+
+class JsonPolling(Throughput, Overhead, LargeMessages):
+    transport = 'jsonp'
+
+class Websocket(Throughput, Overhead, IdleSessions, LargeMessages):
+    transport = 'websocket'
+
+class RawWebsocket(Throughput, Overhead, LargeMessages):
+    transport = 'raw_websocket'
+
+
+if __name__ == '__main__':
+    bench.main()
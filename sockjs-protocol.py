@@ -18,10 +18,16 @@ import random
 import time
 import json
 import re
+import string
+import urllib
 import unittest2 as unittest
 from utils import GET, GET_async, POST, POST_async, OPTIONS, old_POST_async
 from utils import WebSocket8Client
 from utils import RawHttpConnection
+from ioloop import monotonic
+import escaping
+import fixtures
+import runner
 import uuid
 
 
@@ -55,8 +61,14 @@ following services:
 This tests should not be run more often than once in five seconds -
 many tests operate on the same (named) sessions and they need to have
 enough time to timeout.
+
+Test classes can be run in parallel with `-j <jobs>`. Tests marked as
+`serial` depend on timing and are always run on their own.
+
+With `--server` the tests are run against the reference server in
+`server.py`, started on an ephemeral port, instead of `SOCKJS_URL`.
 """
-test_top_url = os.environ.get('SOCKJS_URL', 'http://localhost:8081')
+test_top_url = runner.test_top_url()
 base_url = test_top_url + '/echo'
 close_base_url = test_top_url + '/close'
 wsoff_base_url = test_top_url + '/disabled_websocket_echo'
@@ -426,6 +438,7 @@ class Protocol(Test):
     # recognize that as request for a new session. When server opens a
     # new sesion it must immediately send an frame containing a letter
     # `o`.
+    @runner.serial
     def test_simpleSession(self):
         trans_url = base_url + '/000/' + str(uuid.uuid4())
         r = POST(trans_url + '/xhr')
@@ -1240,6 +1253,256 @@ class RawWebsocket(Test):
         ws.close()
 
 
+# WebSocket compression
+# ---------------------
+#
+# Most SockJS traffic is json, which compresses well. Servers may
+# support the `permessage-deflate` extension
+# ([RFC 7692](https://tools.ietf.org/html/rfc7692)), and the client
+# can offer it with parameters to restrict context takeover and the
+# compression window. The extension is optional: the tests are skipped
+# for a server that declines it. A server that accepts it must answer
+# with the parameters asked for, and nothing the client didn't offer.
+class WebsocketDeflate(Test):
+    # Answering an offer with parameters that don't fit it is a failure,
+    # declining it isn't.
+    def connect(self, url, offer, fragment_size=None):
+        try:
+            ws = WebSocket8Client(url.replace('http', 'ws'), deflate=offer,
+                                  fragment_size=fragment_size)
+        except WebSocket8Client.HandshakeError as e:
+            self.fail('Bad permessage-deflate handshake: %s' % (e,))
+        if ws.deflate is None:
+            ws.close()
+            self.skipTest('permessage-deflate declined')
+        return ws
+
+    def session_url(self):
+        return base_url + '/000/' + str(uuid.uuid4()) + '/websocket'
+
+    # A client that doesn't offer the extension mustn't get it.
+    def test_not_offered(self):
+        ws = WebSocket8Client(base_url.replace('http', 'ws') + '/websocket')
+        self.assertFalse(ws.extensions)
+        ws.close()
+
+    def test_transport(self):
+        ws = self.connect(self.session_url(), {})
+        self.assertEqual(ws.recv(), u'o')
+        msg = json.dumps({'id': 1, 'text': u'Hello world!\uffff' * 50})
+        ws.send(json.dumps([msg]))
+        self.assertEqual(ws.recv(), u'a' + json.dumps([msg]))
+        ws.close()
+
+    # The first frame of a compressed message is flagged, not the
+    # continuation frames.
+    def test_fragmented(self):
+        ws = self.connect(base_url + '/websocket', {}, fragment_size=16)
+        msg = u'Hello world!\uffff ' + u'abc' * 1000
+        ws.send(msg)
+        self.assertEqual(ws.recv(), msg)
+        ws.close()
+
+    # Without context takeover, every message is compressed on its own:
+    # the same message takes the same bytes every time.
+    def test_no_context_takeover(self):
+        ws = self.connect(base_url + '/websocket',
+                          {'server_no_context_takeover': None,
+                           'client_no_context_takeover': None})
+        self.assertIn('server_no_context_takeover', ws.deflate.params)
+        msg = u'["a", "b", "c"]' * 100
+        sizes = set()
+        for i in range(3):
+            ws.send(msg)
+            received, size = ws.recv_sized()
+            self.assertEqual(received, msg)
+            sizes.add(size)
+        self.assertEqual(len(sizes), 1)
+        ws.close()
+
+    def test_max_window_bits(self):
+        ws = self.connect(base_url + '/websocket',
+                          {'server_max_window_bits': '10',
+                           'client_max_window_bits': None})
+        self.assertIn('server_max_window_bits', ws.deflate.params)
+        self.assertTrue(int(ws.deflate.params['server_max_window_bits']) <= 10)
+        msg = u''.join(unichr(random.randint(32, 126)) for i in range(2048))
+        ws.send(msg * 4)
+        self.assertEqual(ws.recv(), msg * 4)
+        ws.close()
+
+
+# Latency
+# -------
+#
+# A message must go out as soon as it's sent, whatever the transport.
+# Small writes are where servers lose time: without `TCP_NODELAY`,
+# Nagle's algorithm holds back a small write while an earlier one
+# isn't acknowledged, and clients delay their ACKs by 40ms or more. A
+# frame written in pieces, a chunk size and then its data say, stalls
+# that way. A server buffering frames before flushing them is slow in
+# the same way.
+#
+# Small messages are echoed over the streaming transports, and the
+# median time from sending one to receiving it back must stay well
+# below a delayed ACK. On localhost an echo takes a millisecond or
+# two. If they fail, check that the http client of this suite isn't
+# the slow one with `harness.py`.
+@runner.serial
+class Latency(Test):
+    rounds = 20
+    # In seconds.
+    budget = 0.02
+
+    def verify_latency(self, echo):
+        echo()
+        samples = []
+        for i in range(self.rounds):
+            t0 = monotonic()
+            echo()
+            samples.append(monotonic() - t0)
+        samples.sort()
+        median = samples[len(samples) // 2]
+        self.assertLess(median, self.budget,
+                        'Median echo latency of %.1fms (max %.1fms): small '
+                        'writes are held back or buffered, is TCP_NODELAY '
+                        'set?' % (median * 1000, samples[-1] * 1000))
+
+    def verify_streaming(self, transport, method, frame):
+        url = base_url + '/000/' + str(uuid.uuid4())
+        r = method(url + '/' + transport)
+        self.assertEqual(r.status, 200)
+        r.read() # prelude
+        self.assertEqual(r.read(), frame('o'))
+        def echo():
+            r1 = POST(url + '/xhr_send', body='["x"]')
+            self.assertEqual(r1.status, 204)
+            self.assertEqual(r.read(), frame('a["x"]'))
+        self.verify_latency(echo)
+        r.close()
+
+    def test_xhr_streaming(self):
+        self.verify_streaming('xhr_streaming', POST_async,
+                              lambda f: f + '\n')
+
+    def test_eventsource(self):
+        self.verify_streaming('eventsource', GET_async,
+                              lambda f: 'data: ' + f + '\r\n\r\n')
+
+    def test_htmlfile(self):
+        self.verify_streaming('htmlfile?c=callback', GET_async,
+                              lambda f: '<script>\np(%s);\n</script>\r\n'
+                              % (json.dumps(f),))
+
+    def test_websocket(self):
+        ws = WebSocket8Client(base_url.replace('http', 'ws') + '/000/' +
+                              str(uuid.uuid4()) + '/websocket')
+        self.assertEqual(ws.recv(), u'o')
+        def echo():
+            ws.send(u'["x"]')
+            self.assertEqual(ws.recv(), u'a["x"]')
+        self.verify_latency(echo)
+        ws.close()
+
+# Large messages
+# --------------
+#
+# Messages of hundreds of kilobytes are common. They must make it
+# through `xhr_send`, `jsonp_send` and websockets whole. A frame
+# larger than the response limit of a streaming transport isn't split
+# either: it is sent in one piece, after which the response ends and
+# the next messages wait for the next request.
+#
+# The messages are made of a random block repeated, so that a piece
+# lost or sent twice shows.
+def large_message(size):
+    rnd = random.Random(size)
+    chars = string.ascii_letters + string.digits
+    block = ''.join(rnd.choice(chars) for i in range(1021))
+    return (block * (size // len(block) + 1))[:size]
+
+class LargeMessages(Test):
+    sizes = (1024, 64 * 1024, 1024 * 1024)
+
+    def test_xhr_send(self):
+        url = base_url + '/000/' + str(uuid.uuid4())
+        r = POST(url + '/xhr')
+        self.assertEqual(r.body, 'o\n')
+        for size in self.sizes:
+            payload = json.dumps([large_message(size)])
+            r = POST(url + '/xhr_send', body=payload)
+            self.assertEqual(r.status, 204)
+            r = POST(url + '/xhr')
+            self.assertEqual(r.body, 'a' + payload + '\n')
+
+    # The `/**/` prefix is left to `JsonPolling`.
+    def test_jsonp_send(self):
+        url = base_url + '/000/' + str(uuid.uuid4())
+        r = GET(url + '/jsonp?c=callback')
+        self.assertTrue(r.body.endswith('callback("o");\r\n'))
+        for size in self.sizes:
+            payload = json.dumps([large_message(size)])
+            r = POST(url + '/jsonp_send', body='d=' + urllib.quote(payload),
+                     headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            self.assertEqual(r.status, 200)
+            self.assertEqual(r.body, 'ok')
+            r = GET(url + '/jsonp?c=callback')
+            self.assertTrue(r.body.endswith('callback(%s);\r\n' % (
+                json.dumps('a' + payload),)))
+
+    def test_websocket(self):
+        ws = WebSocket8Client(base_url.replace('http', 'ws') + '/000/' +
+                              str(uuid.uuid4()) + '/websocket')
+        self.assertEqual(ws.recv(), u'o')
+        for size in self.sizes:
+            payload = json.dumps([large_message(size)])
+            ws.send(payload)
+            self.assertEqual(ws.recv(), u'a' + payload)
+        ws.close()
+
+    def test_raw_websocket(self):
+        ws = WebSocket8Client(base_url.replace('http', 'ws') + '/websocket')
+        for size in self.sizes:
+            msg = large_message(size)
+            ws.send(msg)
+            self.assertEqual(ws.recv(), msg)
+        ws.close()
+
+    # The test server has a response limit of 4096 bytes.
+    def verify_response_limit(self, transport, method, frame):
+        msgs = [large_message(16 * 1024 + i) for i in range(3)]
+        url = base_url + '/000/' + str(uuid.uuid4())
+        r = method(url + '/' + transport)
+        r.read() # prelude
+        self.assertEqual(r.read(), frame('o'))
+        r1 = POST(url + '/xhr_send', body=json.dumps(msgs[:1]))
+        self.assertEqual(r1.status, 204)
+        self.assertEqual(r.read(), frame('a' + json.dumps(msgs[:1])))
+        self.assertFalse(r.read())
+
+        for msg in msgs[1:]:
+            r1 = POST(url + '/xhr_send', body=json.dumps([msg]))
+            self.assertEqual(r1.status, 204)
+        received = []
+        while len(received) < len(msgs) - 1:
+            r = method(url + '/' + transport)
+            r.read() # prelude
+            while True:
+                data = r.read()
+                if not data:
+                    break
+                self.assertEqual(data, frame(data[data.index('a['):].rstrip()))
+                received.extend(json.loads(data[data.index('a[') + 1:]))
+        self.assertEqual(received, msgs[1:])
+
+    def test_response_limit_xhr_streaming(self):
+        self.verify_response_limit('xhr_streaming', POST_async,
+                                   lambda f: f + '\n')
+
+    def test_response_limit_eventsource(self):
+        self.verify_response_limit('eventsource', GET_async,
+                                   lambda f: 'data: ' + f + '\r\n\r\n')
+
 
 # JSON Unicode Encoding
 # =====================
@@ -1258,24 +1521,25 @@ class RawWebsocket(Test):
 # (SockJS-node), but can't really work for servers supporting unicode
 # properly (Python).
 #
+# Strings with every char of a set escaped are built when the tests
+# below first need them, and cached.
+
 # The browser must escape quite a list of chars, this is due to
-# browser mangling outgoing chars on transports like XHR.
-escapable_by_client = re.compile(u"[\\\"\x00-\x1f\x7f-\x9f\u00ad\u0600-\u0604\u070f\u17b4\u17b5\u2000-\u20ff\ufeff\ufff0-\uffff\x00-\x1f\ufffe\uffff\u0300-\u0333\u033d-\u0346\u034a-\u034c\u0350-\u0352\u0357-\u0358\u035c-\u0362\u0374\u037e\u0387\u0591-\u05af\u05c4\u0610-\u0617\u0653-\u0654\u0657-\u065b\u065d-\u065e\u06df-\u06e2\u06eb-\u06ec\u0730\u0732-\u0733\u0735-\u0736\u073a\u073d\u073f-\u0741\u0743\u0745\u0747\u07eb-\u07f1\u0951\u0958-\u095f\u09dc-\u09dd\u09df\u0a33\u0a36\u0a59-\u0a5b\u0a5e\u0b5c-\u0b5d\u0e38-\u0e39\u0f43\u0f4d\u0f52\u0f57\u0f5c\u0f69\u0f72-\u0f76\u0f78\u0f80-\u0f83\u0f93\u0f9d\u0fa2\u0fa7\u0fac\u0fb9\u1939-\u193a\u1a17\u1b6b\u1cda-\u1cdb\u1dc0-\u1dcf\u1dfc\u1dfe\u1f71\u1f73\u1f75\u1f77\u1f79\u1f7b\u1f7d\u1fbb\u1fbe\u1fc9\u1fcb\u1fd3\u1fdb\u1fe3\u1feb\u1fee-\u1fef\u1ff9\u1ffb\u1ffd\u2000-\u2001\u20d0-\u20d1\u20d4-\u20d7\u20e7-\u20e9\u2126\u212a-\u212b\u2329-\u232a\u2adc\u302b-\u302c\uaab2-\uaab3\uf900-\ufa0d\ufa10\ufa12\ufa15-\ufa1e\ufa20\ufa22\ufa25-\ufa26\ufa2a-\ufa2d\ufa30-\ufa6d\ufa70-\ufad9\ufb1d\ufb1f\ufb2a-\ufb36\ufb38-\ufb3c\ufb3e\ufb40-\ufb41\ufb43-\ufb44\ufb46-\ufb4e]")
-#
+# browser mangling outgoing chars on transports like XHR. The list is
+# in `escaping.py`.
+@fixtures.fixture(escaping.escapable_by_client)
+def client_killer_string_esc():
+    return escaping.client.killer_string()
+
 # The server is able to send much more chars verbatim. But, it can't
 # send Unicode surrogates over Websockets, also various \u2xxxx chars
 # get mangled. Additionally, if the server is capable of handling
 # UCS-2 (ie: 16 bit character size), it should be able to deal with
 # Unicode surrogates 0xD800-0xDFFF:
 # http://en.wikipedia.org/wiki/Mapping_of_Unicode_characters#Surrogates
-escapable_by_server = re.compile(u"[\x00-\x1f\u200c-\u200f\u2028-\u202f\u2060-\u206f\ufff0-\uffff]")
-
-client_killer_string_esc = '"' + ''.join([
-        r'\u%04x' % (i) for i in range(65536)
-            if escapable_by_client.match(unichr(i))]) + '"'
-server_killer_string_esc = '"' + ''.join([
-        r'\u%04x'% (i) for i in range(255, 65536)
-            if escapable_by_server.match(unichr(i))]) + '"'
+@fixtures.fixture(escaping.escapable_by_server)
+def server_killer_string_esc():
+    return escaping.server.killer_string(start=255)
 
 class JSONEncoding(Test):
     def test_xhr_server_encodes(self):
@@ -1286,7 +1550,7 @@ class JSONEncoding(Test):
         self.assertEqual(r.body, 'o\n')
         self.assertEqual(r.status, 200)
 
-        payload = '["' + json.loads(server_killer_string_esc) + '"]'
+        payload = '["' + json.loads(server_killer_string_esc()) + '"]'
         r = POST(trans_url + '/xhr_send', body=payload)
         self.assertEqual(r.status, 204)
 
@@ -1296,7 +1560,7 @@ class JSONEncoding(Test):
         recv = r.body.strip()[2:-1]
 
         # Received string is indeed what we sent previously, aka - escaped.
-        self.assertEqual(recv, server_killer_string_esc)
+        self.assertEqual(recv, server_killer_string_esc())
 
     def test_xhr_server_decodes(self):
         # Make sure that server decodes the chars we're customly
@@ -1306,7 +1570,7 @@ class JSONEncoding(Test):
         self.assertEqual(r.body, 'o\n')
         self.assertEqual(r.status, 200)
 
-        payload = '[' + client_killer_string_esc + ']' # Sending escaped
+        payload = '[' + client_killer_string_esc() + ']' # Sending escaped
         r = POST(trans_url + '/xhr_send', body=payload)
         self.assertEqual(r.status, 204)
 
@@ -1318,7 +1582,7 @@ class JSONEncoding(Test):
         # Received string is indeed what we sent previously. We don't
         # really need to know what exactly got escaped and what not.
         a = json.loads(recv)
-        b = json.loads(client_killer_string_esc)
+        b = json.loads(client_killer_string_esc())
         self.assertEqual(a, b)
 
 
@@ -1397,6 +1661,7 @@ class HandlingClose(Test):
         r3.close()
 
     # The same for polling transports
+    @runner.serial
     def test_abort_xhr_polling(self):
         url = base_url + '/000/' + str(uuid.uuid4())
         r1 = POST(url + '/xhr')
@@ -1537,10 +1802,64 @@ class Http11(Test):
         self.assertEqual(c.read_chunk(), 'c[3000,"Go away!"]\n')
         self.assertEqual(c.read_chunk(), '')
 
+# HTTP/1.1 pipelining
+# -------------------
+#
+# A client may send several requests on a connection without waiting
+# for the responses, and the server must answer them in the order they
+# came. Browsers hardly ever pipeline, but proxies reusing connections
+# to the server may, and a server mixing responses up would deliver
+# them to the wrong clients.
+class Pipelining(Test):
+    def test_info(self):
+        c = RawHttpConnection(base_url)
+        for r in c.pipeline([('GET', base_url + '/info')] * 20):
+            self.assertEqual(r.status, 200)
+            self.assertTrue('entropy' in json.loads(r.body))
+        c.close()
+
+    def test_xhr_send(self):
+        url = base_url + '/000/' + str(uuid.uuid4())
+        r = POST(url + '/xhr')
+        self.assertEqual(r.body, 'o\n')
+        c = RawHttpConnection(url)
+        msgs = [str(i) for i in range(20)]
+        responses = c.pipeline([('POST', url + '/xhr_send', {}, json.dumps([m]))
+                                for m in msgs])
+        self.assertEqual([r.status for r in responses], [204] * len(msgs))
+        c.close()
+
+        # The messages are received in the order they were sent.
+        received = []
+        while len(received) < len(msgs):
+            r = POST(url + '/xhr')
+            self.assertEqual(r.body[0], 'a')
+            received.extend(json.loads(r.body[1:]))
+        self.assertEqual(received, msgs)
+
+    def test_order(self):
+        url = base_url + '/000/' + str(uuid.uuid4())
+        c = RawHttpConnection(url)
+        responses = c.pipeline([
+            ('GET', base_url),
+            ('POST', url + '/xhr'),
+            ('GET', base_url + '/info'),
+            ('POST', url + '/xhr_send', {}, '["x"]'),
+            ('POST', url + '/xhr'),
+        ])
+        self.assertEqual([r.status for r in responses],
+                         [200, 200, 200, 204, 200])
+        self.assertEqual(responses[0].body, 'Welcome to SockJS!\n')
+        self.assertEqual(responses[1].body, 'o\n')
+        self.assertTrue('entropy' in json.loads(responses[2].body))
+        self.assertFalse(responses[3].body)
+        self.assertEqual(responses[4].body, 'a["x"]\n')
+        c.close()
+
 
 # Footnote
 # ========
 
 # Make this script runnable.
 if __name__ == '__main__':
-    unittest.main()
+    runner.main()
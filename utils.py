@@ -1,25 +1,48 @@
 import urlparse
 import httplib_fork as httplib
-from ws4py.client.threadedclient import WebSocketClient
-import Queue
 import socket
+import os
 import re
+import select
+import asyncclient
+from asyncclient import CaseInsensitiveDict, Response, ConnectionPool
+from ioloop import IOLoop, ReceiveBuffer, TimeoutError
+
+
+# Keep-alive can be switched off for servers that don't handle it,
+# by setting `SOCKJS_KEEPALIVE=0`.
+KEEPALIVE = os.environ.get('SOCKJS_KEEPALIVE', '1') != '0'
+httplib_pool = ConnectionPool()
+
 
 class HttpResponse:
     def __init__(self, method, url,
-                 headers={}, body=None, async=False, load=True):
+                 headers={}, body=None, async=False, load=True,
+                 keepalive=KEEPALIVE):
         headers = headers.copy()
         u = urlparse.urlparse(url)
         kwargs = {'timeout': 1.0}
-        if u.scheme == 'http':
-            conn = httplib.HTTPConnection(u.netloc, **kwargs)
-        elif u.scheme == 'https':
-            conn = httplib.HTTPSConnection(u.netloc, **kwargs)
-        else:
-            assert False, "Unsupported scheme " + u.scheme
+        # Only fully loaded responses may give the connection back.
+        self.keepalive = keepalive and load and not async
+        self.key = (u.scheme, u.netloc)
+        conn = httplib_pool.get(self.key) if self.keepalive else None
+        if conn is None:
+            if u.scheme == 'http':
+                conn = httplib.HTTPConnection(u.netloc, **kwargs)
+            elif u.scheme == 'https':
+                conn = httplib.HTTPSConnection(u.netloc, **kwargs)
+            else:
+                assert False, "Unsupported scheme " + u.scheme
         assert u.fragment == ''
         path = u.path + ('?' + u.query if u.query else '')
         self.conn = conn
+        self.timings = asyncclient.Timings(method, url)
+        if conn.sock is None:
+            self.timings.mark('connect_start')
+            conn.connect()
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.timings.mark('connect_end')
+        self.timings.mark('request_start')
         if not body:
             if method is 'POST':
                 # The spec says: "Applications SHOULD use this field
@@ -34,6 +57,7 @@ class HttpResponse:
             if isinstance(body, unicode):
                 body = body.encode('utf-8')
             conn.request(method, path, headers=headers, body=body)
+        self.timings.mark('request_sent')
 
         if load:
             if not async:
@@ -48,28 +72,44 @@ class HttpResponse:
     def __getitem__(self, key):
         return self.headers.get(key.lower())
 
-    def _load(self):
-        # That works for Content-Length responses.
+    # httplib reads the status line and the headers in one go, the
+    # first byte is waited for before.
+    def _getresponse(self):
+        select.select([self.conn.sock], [], [], self.conn.timeout)
+        self.timings.mark('first_byte')
         self.res = self.conn.getresponse()
         self.headers = dict( (k.lower(), v) for k, v in self.res.getheaders() )
+        self.timings.mark('headers')
+
+    def _load(self):
+        # That works for Content-Length responses.
+        self._getresponse()
         self.body = self.res.read()
+        self.timings.finish()
+        # A chunked body may not be all read yet.
+        if self.keepalive and not self.res.will_close and self.res.isclosed():
+            httplib_pool.put(self.key, self.conn, self.conn.sock)
+            self.conn = None
         self.close()
 
     def close(self):
+        self.timings.finish(complete=False)
         if self.conn:
             self.conn.close()
             self.conn = None
 
     def _async_load(self):
         # That works for Transfer-Encoding: Chunked
-        self.res = self.conn.getresponse()
-        self.headers = dict( (k.lower(), v) for k, v in self.res.getheaders() )
+        self._getresponse()
+        self.buf = bytearray(10240)
 
+    # A chunk at a time, like `read()`, into a buffer reused across chunks.
     def read(self):
-        data =  self.res.read(10240)
-        if data:
-            return data
+        n = self.res.readinto(self.buf)
+        if n:
+            return str(self.buf[:n])
         else:
+            self.timings.finish()
             self.close()
             return None
 
@@ -77,108 +117,126 @@ def old_POST_async(url, **kwargs):
     return HttpResponse('POST', url, async=True, **kwargs)
 
 
+# Synchronous websocket client, on top of the one in `asyncclient`.
+# Connections share the event loop, there is no thread per
+# connection. `recv()` times out after a second, a failure closes the
+# connection. Keyword arguments go to `websocket_connect()`, `deflate`
+# and `fragment_size` in particular.
 class WebSocket8Client(object):
-    class ConnectionClosedException(Exception): pass
-
-    def __init__(self, url):
-        queue = Queue.Queue()
-        self.queue = queue
-        class IntWebSocketClient(WebSocketClient):
-            def received_message(self, m):
-                queue.put(unicode(str(m), 'utf-8'))
-            def closed(self, code, reason):
-                queue.put((code, reason))
-            # def read_from_connection(self, amount):
-            #     r = super(IntWebSocketClient, self).read_from_connection(amount)
-            #     if self.stream.closing:
-            #         queue.put((self.stream.closing.code, self.stream.closing.reason[2:]))
-            #     elif not r:
-            #         queue.put((1000, ""))
-            #     return r
-        self.client = IntWebSocketClient(url)
-        self.client.connect()
+    ConnectionClosedException = asyncclient.WebSocket.ConnectionClosedException
+    HandshakeError = asyncclient.HandshakeError
+
+    def __init__(self, url, **kwargs):
+        self.ws = run_sync(asyncclient.websocket_connect(url, timeout=TIMEOUT,
+                                                         **kwargs))
+        self.deflate = self.ws.deflate
+        self.extensions = self.ws.response['Sec-WebSocket-Extensions']
 
     def close(self):
-        if self.client:
-            self.client.running = False
-            self.client.close()
-            self.client._th.join()
-            self.client = None
+        if self.ws:
+            try:
+                IOLoop.instance().run_sync(self.ws.close(), timeout=TIMEOUT)
+            except TimeoutError:
+                self.ws.stream.close()
+            self.ws = None
 
     def send(self, data):
-        self.client.send(data)
+        run_sync(self.ws.send(data))
 
     def recv(self):
         try:
-            r = self.queue.get(timeout=1.0)
-            if isinstance(r, tuple):
-                ce = self.ConnectionClosedException()
-                (ce.code, ce.reason) = r
-                raise ce
-            return r
+            return IOLoop.instance().run_sync(self.ws.recv(), timeout=TIMEOUT)
         except:
             self.close()
             raise
 
-def recvline(s):
-    b = []
-    c = None
-    while c != '\n':
-        c = s.recv(1)
-        b.append( c )
-    return ''.join(b)
-
-
-class CaseInsensitiveDict(object):
-    def __init__(self, *args, **kwargs):
-        self.lower = {}
-        self.d = dict(*args, **kwargs)
-        for k in self.d:
-            self[k] = self.d[k]
-
-    def __getitem__(self, key, *args, **kwargs):
-        pkey = self.lower.setdefault(key.lower(), key)
-        return self.d.__getitem__(pkey, *args, **kwargs)
-
-    def __setitem__(self, key, *args, **kwargs):
-        pkey = self.lower.setdefault(key.lower(), key)
-        return self.d.__setitem__(pkey, *args, **kwargs)
-
-    def items(self):
-        for k in self.lower.values():
-            yield (k, self[k])
-
-    def __repr__(self): return repr(self.d)
-    def __str__(self): return str(self.d)
-
-    def get(self, key, *args, **kwargs):
-        pkey = self.lower.setdefault(key.lower(), key)
-        return self.d.get(pkey, *args, **kwargs)
-
-    def __contains__(self, key):
-        pkey = self.lower.setdefault(key.lower(), key)
-        return pkey in self.d
-
-class Response(object):
-    def __repr__(self):
-        return '<Response HTTP/%s %s %r %r>' % (
-            self.http, self.status, self.description, self.headers)
-
-    def __str__(self): return repr(self)
+    # The next message, and the bytes read off the wire to get it.
+    def recv_sized(self):
+        n = self.ws.bytes_received
+        msg = self.recv()
+        return msg, self.ws.bytes_received - n
+
+# `socket.create_connection()`, with a second of timeout and the
+# receive buffer set first.
+def create_connection(address, rcvbuf=None):
+    if rcvbuf is None:
+        return socket.create_connection(address, timeout=1)
+    addresses = socket.getaddrinfo(address[0], address[1], 0,
+                                   socket.SOCK_STREAM)
+    for i, (family, socktype, proto, _, sockaddr) in enumerate(addresses):
+        s = socket.socket(family, socktype, proto)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        s.settimeout(1)
+        try:
+            s.connect(sockaddr)
+            return s
+        except socket.error:
+            s.close()
+            if i == len(addresses) - 1:
+                raise
+
+# Blocking reads on top of `ReceiveBuffer`: lines and fixed-length
+# reads are served from the buffer, which is filled with large
+# `recv_into` calls. `received` counts the bytes off the socket.
+class SocketBuffer(ReceiveBuffer):
+    def __init__(self, s, size=65536):
+        super(SocketBuffer, self).__init__(size)
+        self.s = s
+        self.received = 0
+
+    def fill(self):
+        n = self.recv_into(self.s)
+        self.received += n
+        return n
+
+    def readline(self):
+        offset = 0
+        while True:
+            i = self.find('\n', offset)
+            if i != -1:
+                return self.take(i + 1)
+            offset = len(self)
+            if not self.fill():
+                return self.take(len(self))
+
+    def read(self, size):
+        while len(self) < size:
+            if not self.fill():
+                raise Exception('Socket closed!')
+        return self.take(size)
 
-    def __getitem__(self, key):
-        return self.headers.get(key)
+    def read_some(self):
+        if not len(self):
+            self.fill()
+        return self.take(len(self))
 
-    def get(self, key, default):
-        return self.headers.get(key, default)
+    def read_till_eof(self):
+        while self.fill():
+            pass
+        return self.take(len(self))
 
 
+# Counts bytes like `asyncclient.HttpConnection`: `sent` and
+# `received()` at the socket level, `header_sent` and `header_received`
+# for the heads. `rcvbuf` sets the size of the socket receive buffer,
+# before connecting as the TCP window depends on it.
 class RawHttpConnection(object):
-    def __init__(self, url):
+    def __init__(self, url, rcvbuf=None):
         u = urlparse.urlparse(url)
-        self.s = socket.create_connection((u.hostname, u.port), timeout=1)
+        self.s = create_connection((u.hostname, u.port), rcvbuf)
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buf = SocketBuffer(self.s)
+        self.sent = self.header_sent = self.header_received = 0
+
+    def received(self):
+        return self.buf.received
 
     def request(self, method, url, headers={}, body=None, timeout=1, http="1.1"):
+        self.send(self.format_request(method, url, headers, body, http))
+        return self.read_response()
+
+    # Head and body in one go, see `asyncclient.HttpConnection`.
+    def format_request(self, method, url, headers={}, body=None, http="1.1"):
         headers = CaseInsensitiveDict(headers)
         if method == 'POST':
             body = (body or '').encode('utf-8')
@@ -194,12 +252,15 @@ class RawHttpConnection(object):
             req.append( "%s: %s" % (k, v) )
         req.append('')
         req.append('')
-        self.send('\r\n'.join(req))
-
-        if body:
-            self.send(body)
-
-        head = recvline(self.s)
+        head = '\r\n'.join(req)
+        self.header_sent += len(head)
+        return head + body if body else head
+
+    def read_response(self):
+        head = self.buf.readline()
+        if not head:
+            raise socket.error('Connection closed')
+        self.header_received += len(head)
         r = re.match(r'HTTP/(?P<version>\S+) (?P<status>\S+) (?P<description>.*)', head)
 
         resp = Response()
@@ -209,7 +270,8 @@ class RawHttpConnection(object):
 
         resp.headers = CaseInsensitiveDict()
         while True:
-            header = recvline(self.s)
+            header = self.buf.readline()
+            self.header_received += len(header)
             if header in ['\n', '\r\n']:
                 break
             k, _, v = header.partition(':')
@@ -217,75 +279,81 @@ class RawHttpConnection(object):
 
         return resp
 
+    # The whole body of `r`, framed by Content-Length, chunks or the end
+    # of the connection.
+    def read_body(self, r, method='GET'):
+        if method == 'HEAD' or r.status in (204, 304):
+            return ''
+        if r.headers.get('content-length') is not None:
+            return self.read(int(r.headers['content-length']))
+        if r.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                chunk = self.read_chunk()
+                if not chunk:
+                    return ''.join(chunks)
+                chunks.append(chunk)
+        return self.read_till_eof()
+
+    # HTTP/1.1 pipelining: all the `requests` are written at once, then
+    # the responses are read in order, each with its `body`. A request
+    # is a tuple of arguments to `request()`: `(method, url[, headers[,
+    # body]])`.
+    def pipeline(self, requests):
+        self.send(''.join(self.format_request(*req) for req in requests))
+        responses = []
+        for req in requests:
+            r = self.read_response()
+            r.body = self.read_body(r, req[0])
+            responses.append(r)
+        return responses
+
     def read(self, size=None):
         if size is None:
             # A single packet by default
-            return self.s.recv(999999)
-        data = []
-        while size > 0:
-            c = self.s.recv(size)
-            if not c:
-                raise Exception('Socket closed!')
-            size -= len(c)
-            data.append( c )
-        return ''.join(data)
+            return self.buf.read_some()
+        return self.buf.read(size)
 
     def read_till_eof(self):
-        data = []
-        while True:
-            c = self.s.recv(999999)
-            if not c:
-                break
-            data.append( c )
-        return ''.join(data)
+        return self.buf.read_till_eof()
 
     def closed(self):
         # To check if socket is being closed, we need to recv and see
         # if the response is empty. If it is not - we're in trouble -
         # abort.
-        t = self.s.settimeout(0.1)
-        r = self.s.recv(1) == ''
+        t = self.s.gettimeout()
+        self.s.settimeout(0.1)
+        r = not self.buf and self.buf.fill() == 0
         if not r:
             raise Exception('Socket not closed!')
         self.s.settimeout(t)
         return r
 
     def read_chunk(self):
-        line = recvline(self.s).rstrip('\r\n')
+        line = self.buf.readline().rstrip('\r\n')
         bytes = int(line, 16) + 2 # Additional \r\n
         return self.read(bytes)[:-2]
 
     def send(self, data):
         self.s.sendall(data)
+        self.sent += len(data)
 
     def close(self):
         self.s.close()
 
 
-def SynchronousHttpRequest(method, url, **kwargs):
-    c = RawHttpConnection(url)
-    r = c.request(method, url, **kwargs)
-    if r.get('Transfer-Encoding', '').lower() == 'chunked':
-        chunks = []
-        while True:
-            chunk = c.read_chunk()
-            if len(chunk) == 0:
-                break
-            chunks.append( chunk )
-        r.body = ''.join(chunks)
-    elif r.get('Content-Length', ''):
-        cl = int(r['Content-Length'])
-        r.body = c.read(cl)
-    elif 'close' in [k.strip() for k in r.get('Connection', '').lower().split(',')]:
-        r.body = c.read_till_eof()
-    else:
-        # Whitelist statuses that may not need a response
-        if r.status in [101, 304, 204] or (r.status == 200 and method == 'OPTIONS'):
-            r.body = ''
-        else:
-            raise Exception(str(r.status) + ' '+str(r.headers) + " No Transfer-Encoding:chunked nor Content-Length nor Connection:Close!")
-    c.close()
-    return r
+# The synchronous helpers run the coroutines from `asyncclient` on
+# the event loop. Every socket operation times out after a second.
+# Responses carry their `timings`, see `asyncclient.Timings`.
+TIMEOUT = 1.0
+
+def run_sync(future):
+    return IOLoop.instance().run_sync(future)
+
+def SynchronousHttpRequest(method, url, keepalive=KEEPALIVE, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    return run_sync(asyncclient.HttpRequest(method, url, keepalive=keepalive,
+                                            **kwargs))
 
 def GET(url, **kwargs):
     return SynchronousHttpRequest('GET', url, **kwargs)
@@ -297,27 +365,12 @@ def OPTIONS(url, **kwargs):
     return SynchronousHttpRequest('OPTIONS', url, **kwargs)
 
 def AsynchronousHttpRequest(method, url, **kwargs):
-    c = RawHttpConnection(url)
-    r = c.request(method, url, **kwargs)
-    if r.get('Transfer-Encoding', '').lower() == 'chunked':
-        def read():
-            return c.read_chunk()
-        r.read = read
-    elif r.get('Content-Length', ''):
-        cl = int(r['Content-Length'])
-        def read():
-            return c.read(cl)
-        r.read = read
-    elif ('close' in [k.strip() for k in r.get('Connection', '').lower().split(',')]
-          or r.status == 101):
-        def read():
-            return c.read()
-        r.read = read
-    else:
-        raise Exception(str(r.status) + ' '+str(r.headers) + " No Transfer-Encoding:chunked nor Content-Length nor Connection:Close!")
-    def close():
-        c.close()
-    r.close = close
+    kwargs.setdefault('timeout', TIMEOUT)
+    r = run_sync(asyncclient.StreamingHttpRequest(method, url, **kwargs))
+    read = r.read
+    def read_sync():
+        return run_sync(read())
+    r.read = read_sync
     return r
 
 def GET_async(url, **kwargs):